@@ -0,0 +1,200 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import sqlite3
+import hashlib
+import threading
+
+from ratelimit import RateLimitExceededException
+from metrics import Metrics
+from log import get_logger
+
+logger = get_logger("apikeys")
+
+# Flickr error codes which mean the key, rather than the call, is at fault
+INVALID_KEY_CODES = frozenset([100])
+UNAVAILABLE_CODES = frozenset([105])
+
+# An invalid key is left out of rotation for the rest of the day
+INVALID_KEY_COOLDOWN = 86400.0
+
+
+class ApiKeyPool:
+    """
+    Spreads API calls over several keys, round robin among the keys that are in rotation. Every key draws from
+    its own rate limit bucket, so a call goes to the next key with a token to spare. A key the service throttles,
+    rejects or keeps failing on is taken out of rotation for a while, and requests and errors are counted per key.
+    The times keys are out of rotation until are kept in a SQLite file, next to the rate limit buckets, so that
+    one-shot runs do not retry a rejected key. Keys are identified in buckets, metrics, logs and the file by a
+    short hash, never by the key itself.
+    """
+
+    def __init__(self, keys, rate_limiter=None, failure_threshold=3, cooldown=300.0, path=None):
+        if len(keys) == 0:
+            raise Exception("No API keys configured")
+        self.__keys = [{
+            "key": key,
+            "label": hashlib.sha1(key.encode("utf-8")).hexdigest()[:8],
+            "requests": 0,
+            "errors": 0,
+            "failures": 0,
+            "unavailable_until": 0.0
+        } for key in keys]
+        self.__rate_limiter = rate_limiter
+        self.__failure_threshold = failure_threshold
+        self.__cooldown = float(cooldown)
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+        # A single key is used whatever its state, so only a pool needs its cooldowns kept
+        self.__conn = None
+        if path is not None and len(self.__keys) > 1:
+            self.__conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.__conn.execute("""CREATE TABLE IF NOT EXISTS key_cooldowns (
+                                        label TEXT PRIMARY KEY,
+                                        unavailable_until REAL NOT NULL)""")
+            self.__conn.commit()
+            cooldowns = dict(self.__conn.execute("SELECT label, unavailable_until FROM key_cooldowns").fetchall())
+            for entry in self.__keys:
+                entry["unavailable_until"] = cooldowns.get(entry["label"], 0.0)
+
+    @staticmethod
+    def from_config(config, rate_limiter=None):
+        """
+        Builds the key pool from the [flickr] section of the configuration. flickr.keys, or flickr.key, holds a
+        comma separated list of keys.
+        :param config: A configuration instance
+        :param rate_limiter: The Flickr rate limiter, or None if rate limiting is disabled
+        :return: A key pool. Its cooldowns are kept in the file at ratelimit.path.
+        """
+        keys = config.get("flickr", "flickr.keys", fallback=None) or config.get("flickr", "flickr.key")
+        return ApiKeyPool([key.strip() for key in keys.split(",") if len(key.strip()) > 0],
+                          rate_limiter=rate_limiter,
+                          failure_threshold=config.getint("flickr", "flickr.key_failure_threshold", fallback=3),
+                          cooldown=config.getfloat("flickr", "flickr.key_cooldown", fallback=300),
+                          path=config.get("ratelimit", "ratelimit.path", fallback="ratelimit.db"))
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __bucket(self, entry):
+        # A single key keeps using the limiter's own bucket
+        return None if len(self.__keys) == 1 else entry["label"]
+
+    def __rotation(self):
+        """
+        :return: The keys in rotation, starting from the next one in turn. If every key is out of rotation, all
+                 keys, soonest available first.
+        """
+        now = time.time()
+        with self.__lock:
+            available = [entry for entry in self.__keys if entry["unavailable_until"] <= now]
+            start = self.__next
+            self.__next += 1
+        if len(available) == 0:
+            return sorted(self.__keys, key=lambda entry: entry["unavailable_until"])
+        start %= len(available)
+        return available[start:] + available[:start]
+
+    def acquire(self, priority, max_wait=None):
+        """
+        Picks the key for the next call and takes a token from its bucket, waiting for the first key in turn
+        if no key has a token to spare
+        :param priority: RateLimiter.PRIORITY_SCHEDULED or RateLimiter.PRIORITY_MENTION
+        :param max_wait: Seconds to wait at most, or None for the maximum wait of the priority
+        :return: The key entry, passed back to record
+        """
+        rotation = self.__rotation()
+        if self.__rate_limiter is None:
+            return rotation[0]
+        if len(rotation) > 1:
+            for entry in rotation:
+                try:
+                    self.__rate_limiter.acquire(priority, bucket=self.__bucket(entry), max_wait=0)
+                    return entry
+                except RateLimitExceededException:
+                    continue
+        self.__rate_limiter.acquire(priority, bucket=self.__bucket(rotation[0]), max_wait=max_wait)
+        return rotation[0]
+
+    def record(self, entry, status_code, error_code=None, retry_after=None):
+        """
+        Counts the outcome of a call made with a key and takes the key out of rotation if it was throttled,
+        rejected or has failed failure_threshold times in a row
+        :param entry: The key entry returned by acquire
+        :param status_code: HTTP status code of the response
+        :param error_code: The service's error code, if the call failed
+        :param retry_after: Seconds the service asked us to wait, for a 429
+        """
+        throttled = status_code == 429
+        failed = throttled or status_code >= 500 or error_code in INVALID_KEY_CODES or error_code in UNAVAILABLE_CODES
+        now = time.time()
+        with self.__lock:
+            entry["requests"] += 1
+            if failed:
+                entry["errors"] += 1
+                entry["failures"] += 1
+            else:
+                entry["failures"] = 0
+
+            cooldown = 0.0
+            if error_code in INVALID_KEY_CODES:
+                cooldown = INVALID_KEY_COOLDOWN
+            elif throttled:
+                cooldown = retry_after if retry_after is not None else 60.0
+            elif entry["failures"] >= self.__failure_threshold:
+                cooldown = self.__cooldown
+            if cooldown > 0:
+                entry["unavailable_until"] = now + cooldown
+                entry["failures"] = 0
+                if self.__conn is not None:
+                    self.__conn.execute("INSERT OR REPLACE INTO key_cooldowns (label, unavailable_until) VALUES (?, ?)",
+                                        (entry["label"], entry["unavailable_until"]))
+                    self.__conn.commit()
+
+        Metrics.increment("flickr_key_requests_total", key=entry["label"])
+        if failed:
+            Metrics.increment("flickr_key_errors_total", key=entry["label"])
+        if cooldown > 0:
+            Metrics.increment("flickr_key_cooldowns_total", key=entry["label"])
+            if error_code in INVALID_KEY_CODES:
+                logger.error("Flickr API key %s was rejected, taking it out of rotation", entry["label"])
+            else:
+                logger.warning("Taking Flickr API key %s out of rotation for %.0f seconds", entry["label"], cooldown)
+            if throttled and self.__rate_limiter is not None:
+                self.__rate_limiter.penalize(cooldown, bucket=self.__bucket(entry))
+
+    def usage(self):
+        """
+        :return: A list of per key usage, each a dict of the key's label, requests, errors and whether it is in
+                 rotation
+        """
+        now = time.time()
+        with self.__lock:
+            return [{
+                "key": entry["label"],
+                "requests": entry["requests"],
+                "errors": entry["errors"],
+                "available": entry["unavailable_until"] <= now
+            } for entry in self.__keys]
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
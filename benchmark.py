@@ -0,0 +1,434 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import subprocess
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+from configparser import ConfigParser
+
+import yaml
+from TwitterAPI import TwitterAPI
+
+import hourlyplanet as hp
+import twitter
+from fakeservers import FakeImageCDN, FakeFlickr, FakeTwitter, FakeMastodon
+from fastjson import FastJson
+
+
+class LocalTwitterAPI(TwitterAPI):
+    """
+    TwitterAPI client which sends every request to a local stand-in server
+    """
+
+    base_url = None
+
+    def _prepare_url(self, subdomain, path):
+        return "%s/1.1/%s.json" % (LocalTwitterAPI.base_url, path)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+    :param values: Sample values
+    :param p: Percentile, 0-100
+    :return: The percentile value, or 0 for an empty sample
+    """
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(p / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+# Modules which must not be imported until a destination or feature needs them
+DEFERRED_MODULES = ("requests", "yaml", "TwitterAPI", "mastodon", "unidecode", "cProfile")
+
+
+def measure_startup(module="hourlyplanet", runs=5):
+    """
+    Measures the import time of a module in fresh interpreters using -X importtime
+    :param module: Module to import
+    :param runs: Number of interpreter launches
+    :return: A list of cumulative import times in seconds, and the set of modules that were imported
+    """
+    times = []
+    imported = set()
+    for i in range(0, runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            fields = line[len("import time:"):].split("|")
+            name = fields[2].strip()
+            imported.add(name)
+            if name == module:
+                times.append(int(fields[1]) / 1000000.0)
+    return times, imported
+
+
+def summarize(name, latencies, elapsed):
+    return {
+        "name": name,
+        "count": len(latencies),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50": round(percentile(latencies, 50), 5),
+        "p99": round(percentile(latencies, 99), 5)
+    }
+
+
+class Benchmark:
+    """
+    Drives load_sources, find_and_post_image and respond_to_mentions against local stand-ins for Flickr,
+    the image CDN, Twitter and Mastodon
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="hourlyplanet-bench-")
+        failure = dict(latency=args.latency, failure_rate=args.failure_rate)
+
+        self.cdn = FakeImageCDN(payload_size=args.payload_size, **failure).start()
+        self.flickr_server = FakeFlickr(self.cdn, photos_per_user=args.photos_per_user, **failure).start()
+
+        self.twitter_server = FakeTwitter(**failure).start()
+        self.mastodon_server = FakeMastodon(**failure).start()
+
+        self.config = self.make_config()
+        self.sources_path = self.make_sources(args.sources)
+
+        hp.Flickr.REST_BASE_URL = self.flickr_server.rest_url
+        LocalTwitterAPI.base_url = self.twitter_server.url
+        twitter.TwitterAPI = LocalTwitterAPI
+
+    @staticmethod
+    def make_mention_texts(count):
+        texts = []
+        for i in range(0, count):
+            if i % 3 == 0:
+                texts.append("@hourlycosmos can I have a picture of saturn please")
+            else:
+                texts.append("@hourlycosmos another image please")
+        return texts
+
+    def make_config(self):
+        config = ConfigParser()
+        config.read_dict({
+            "flickr": {
+                "flickr.key": "benchmark",
+                "flickr.secret": "benchmark",
+                "flickr.page_size": str(self.args.page_size),
+                "flickr.image_url_attribute": "url_z"
+            },
+            "twitter": {
+                "twitter.consumer_key": "benchmark",
+                "twitter.consumer_secret": "benchmark",
+                "twitter.access_token": "benchmark",
+                "twitter.access_secret": "benchmark"
+            },
+            "mastodon": {
+                "mastodon.baseurl": self.mastodon_server.url,
+                "mastodon.access_token": "benchmark"
+            },
+            "history": {
+                "history.window_hours": "0"
+            },
+            "ratelimit": {
+                "ratelimit.calls_per_hour": "0"
+            },
+            "cache": {
+                "cache.path": os.path.join(self.workdir, "flickr_cache.db"),
+                "cache.max_size_mb": "64" if self.args.cache else "0"
+            },
+            "images": {
+                "images.max_size_mb": "0"
+            },
+            # The fake CDN serves random bytes, not images
+            "transcode": {
+                "transcode.enabled": "false"
+            }
+        })
+        return config
+
+    def make_sources(self, count):
+        sources = []
+        for i in range(0, count):
+            source = {
+                "flickr_id": "%d@N0%d" % (100000 + i, i % 10),
+                "twitter_id": "@source%d" % i,
+                "mastodon_id": "@source%d@example.social" % i
+            }
+            if i % 4 == 0:
+                source["albums"] = [72157700000000000 + i * 10 + n for n in range(0, 3)]
+            sources.append(source)
+
+        path = os.path.join(self.workdir, "sources.yaml")
+        with open(path, "w") as f:
+            yaml.dump({"sources": sources}, f)
+        return path
+
+    def make_social(self):
+        return hp.create_social(self.config, self.args.destination)
+
+    def run_load_sources(self):
+        latencies = []
+        start = time.perf_counter()
+        for i in range(0, self.args.iterations):
+            t = time.perf_counter()
+            sources = hp.load_sources(self.sources_path, hp.Flickr(self.config))
+            latencies.append(time.perf_counter() - t)
+        return summarize("load_sources", latencies, time.perf_counter() - start), sources
+
+    def timed_find_and_post_image(self, latencies):
+        original = hp.find_and_post_image
+
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - t)
+        return wrapper
+
+    def run_posts(self, sources, flickr, social):
+        latencies = []
+        post = self.timed_find_and_post_image(latencies)
+        start = time.perf_counter()
+        for i in range(0, self.args.posts):
+            try:
+                post(self.config, sources, flickr, social)
+            except Exception as ex:
+                print("Post %d failed: %s" % (i, ex), file=sys.stderr)
+        return summarize("find_and_post_image", latencies, time.perf_counter() - start)
+
+    def deliver_mentions(self, first_id, count):
+        """
+        Makes a batch of new mentions visible on the stand-in for the selected destination
+        """
+        for i, text in enumerate(Benchmark.make_mention_texts(count)):
+            mention_id = first_id + i
+            if self.args.destination == "twitter":
+                self.twitter_server.mentions.append(FakeTwitter.make_mention(mention_id, "user%d" % (mention_id % 50), text))
+            else:
+                self.mastodon_server.mentions.append(FakeMastodon.make_mention(mention_id, "user%d@example.social" % (mention_id % 50), text))
+
+    def run_mentions(self, sources, translations, flickr, social):
+        """
+        Mentions arrive in batches of up to 100, the most a single run fetches, and each batch is answered
+        by a respond_to_mentions run that starts from the previous run's since id
+        """
+        latencies = []
+        original = hp.find_and_post_image
+        hp.find_and_post_image = self.timed_find_and_post_image(latencies)
+        since_id = 0
+        start = time.perf_counter()
+        try:
+            for first in range(0, self.args.mentions, 100):
+                self.deliver_mentions(first + 1, min(100, self.args.mentions - first))
+                try:
+                    since_id = hp.respond_to_mentions(self.config, sources, translations, flickr, social, since_id=since_id)
+                except Exception as ex:
+                    print("Mention run failed: %s" % ex, file=sys.stderr)
+        finally:
+            hp.find_and_post_image = original
+        return summarize("respond_to_mentions", latencies, time.perf_counter() - start)
+
+    def run_parse(self, flickr, page_size):
+        """
+        Decodes a listing page of page_size photos with every image size with the standard library in full, and
+        a page with the image sizes the Flickr class asks for the way it does, measuring the time and the memory
+        allocated at peak and still held by the decoded page
+        """
+        def page(extras=None):
+            return json.dumps({"photos": self.flickr_server.page_of("1@N00", page_size, 1, page_size, extras=extras), "stat": "ok"}).encode("utf-8")
+
+        decoders = (
+            ("parse_%d_json" % page_size, page(), json.loads),
+            ("parse_%d_projected" % page_size, page(",".join(flickr.image_url_extras)),
+             lambda content: FastJson.project(FastJson.loads(content), "photos", flickr.photo_fields))
+        )
+        results = []
+        for name, body, decode in decoders:
+            latencies = []
+            start = time.perf_counter()
+            for i in range(0, self.args.parse_runs):
+                t = time.perf_counter()
+                decode(body)
+                latencies.append(time.perf_counter() - t)
+            result = summarize(name, latencies, time.perf_counter() - start)
+
+            tracemalloc.start()
+            data = decode(body)
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del data
+            result["peak_kb"] = round(peak / 1024.0, 1)
+            result["held_kb"] = round(held / 1024.0, 1)
+            results.append(result)
+        return results
+
+    def run(self):
+        results = []
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result, sources = self.run_load_sources()
+            results.append(result)
+
+            flickr = hp.Flickr(self.config)
+            social = self.make_social()
+            translations = hp.load_translations(self.args.translations)
+
+            results.append(self.run_posts(sources, flickr, social))
+            results.append(self.run_mentions(sources, translations, flickr, social))
+            for page_size in (100, 500):
+                results.extend(self.run_parse(flickr, page_size))
+        return results
+
+    def close(self):
+        hp.close_social_clients()
+        for server in (self.cdn, self.flickr_server, self.twitter_server, self.mastodon_server):
+            server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def parse_ratios(results):
+    """
+    :param results: Benchmark results
+    :return: For every page size, the p50 of the projected parse as a fraction of the p50 of the full parse
+    """
+    by_name = dict((r["name"], r) for r in results)
+    ratios = {}
+    for name, result in by_name.items():
+        if name.startswith("parse_") and name.endswith("_projected"):
+            full = by_name.get(name[:-len("_projected")] + "_json")
+            if full is not None and full["p50"] > 0:
+                ratios[name] = result["p50"] / full["p50"]
+    return ratios
+
+
+def compare_to_baseline(results, baseline, tolerance, min_tolerance=0.0):
+    """
+    Compares results to a stored baseline. The parse scenarios take well under a millisecond, so their times
+    are only compared as the projected parse's fraction of the full parse, which holds across machines; their
+    memory is compared as is.
+    :param results: Benchmark results
+    :param baseline: Baseline results
+    :param tolerance: Allowed fractional regression, e.g. 0.2 for 20%
+    :param min_tolerance: Seconds a latency, or the time per operation, may grow by in any case, absorbing timer
+                          and scheduling noise
+    :return: A list of regression descriptions
+    """
+    regressions = []
+    baseline_by_name = dict((r["name"], r) for r in baseline["results"])
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        if base is None:
+            continue
+        if not result["name"].startswith("parse_"):
+            for field in ("p50", "p99"):
+                if base[field] > 0 and result[field] > max(base[field] * (1.0 + tolerance), base[field] + min_tolerance):
+                    regressions.append("%s %s %.5fs exceeds baseline %.5fs" % (result["name"], field, result[field], base[field]))
+            if base["throughput"] > 0 and result["throughput"] < base["throughput"] * (1.0 - tolerance) \
+                    and 1.0 / max(result["throughput"], 1e-9) - 1.0 / base["throughput"] > min_tolerance:
+                regressions.append("%s throughput %.2f/s below baseline %.2f/s" % (result["name"], result["throughput"], base["throughput"]))
+        for field in ("peak_kb", "held_kb"):
+            if base.get(field, 0) > 0 and result.get(field, 0) > base[field] * (1.0 + tolerance):
+                regressions.append("%s %s %.1fKB exceeds baseline %.1fKB" % (result["name"], field, result[field], base[field]))
+
+    baseline_ratios = parse_ratios(baseline["results"])
+    for name, ratio in sorted(parse_ratios(results).items()):
+        base = baseline_ratios.get(name)
+        if base is not None and ratio > base * (1.0 + tolerance):
+            regressions.append("%s takes %.2f of the full parse, baseline %.2f" % (name, ratio, base))
+    return regressions
+
+
+def print_results(results):
+    print("%-22s %8s %10s %12s %10s %10s %10s %10s" % ("scenario", "count", "seconds", "throughput", "p50 (ms)", "p99 (ms)", "peak (KB)", "held (KB)"))
+    for r in results:
+        print("%-22s %8d %10.3f %10.2f/s %10.2f %10.2f %10s %10s" % (r["name"], r["count"], r["seconds"], r["throughput"], r["p50"] * 1000.0, r["p99"] * 1000.0,
+                                                                     r.get("peak_kb", "-"), r.get("held_kb", "-")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against local Flickr, image CDN, Twitter and Mastodon stand-ins")
+    parser.add_argument("-d", "--destination", help="Destination social media (twitter, mastodon)", type=str, default="mastodon")
+    parser.add_argument("--sources", help="Number of configured sources", type=int, default=100)
+    parser.add_argument("--mentions", help="Number of mentions to respond to", type=int, default=1000)
+    parser.add_argument("--posts", help="Number of scheduled posts", type=int, default=100)
+    parser.add_argument("--iterations", help="Number of load_sources iterations", type=int, default=3)
+    parser.add_argument("--photos-per-user", help="Photos in each fake photostream", type=int, default=1000)
+    parser.add_argument("--page-size", help="flickr.page_size", type=int, default=100)
+    parser.add_argument("--payload-size", help="Image size in bytes", type=int, default=200000)
+    parser.add_argument("--latency", help="Added latency per fake server request in seconds", type=float, default=0.0)
+    parser.add_argument("--failure-rate", help="Fraction of fake server requests that fail", type=float, default=0.0)
+    parser.add_argument("--cache", help="Enable the Flickr response cache", action="store_true")
+    parser.add_argument("--parse-runs", help="Number of decodes of each listing page in the parse scenarios", type=int, default=50)
+    parser.add_argument("--startup-budget-ms", help="Maximum median import time of hourlyplanet in milliseconds", type=float, default=100.0)
+    parser.add_argument("-i", "--translations", help="Translations yaml file", type=str, default="translations.yaml")
+    parser.add_argument("--baseline", help="Baseline results file to compare against", type=str, default="benchmark_baseline.json")
+    parser.add_argument("--tolerance", help="Allowed fractional regression against the baseline", type=float, default=0.25)
+    parser.add_argument("--min-tolerance-ms", help="Milliseconds a latency may regress by in any case", type=float, default=10.0)
+    parser.add_argument("--save-baseline", help="Write the results as the new baseline", action="store_true")
+    args = parser.parse_args()
+
+    startup_times, imported = measure_startup()
+    startup = summarize("startup_import", startup_times, sum(startup_times))
+
+    benchmark = Benchmark(args)
+    try:
+        results = [startup] + benchmark.run()
+    finally:
+        benchmark.close()
+
+    print_results(results)
+
+    startup_failures = []
+    if startup["p50"] * 1000.0 > args.startup_budget_ms:
+        startup_failures.append("median import time %.1fms exceeds the %.1fms budget" % (startup["p50"] * 1000.0, args.startup_budget_ms))
+    for module in DEFERRED_MODULES:
+        if module in imported:
+            startup_failures.append("%s is imported at startup" % module)
+    for failure in startup_failures:
+        print("STARTUP: %s" % failure)
+    if len(startup_failures) > 0:
+        sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Baseline written to %s" % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_tolerance_ms / 1000.0)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
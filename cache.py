@@ -0,0 +1,181 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sqlite3
+import time
+from fastjson import FastJson
+from urllib.parse import urlencode
+
+
+class CachedResponse:
+    """
+    Stands in for a requests response when the body was served from, or has already been decoded for, the cache
+    """
+
+    def __init__(self, data, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self.__data = data
+
+    def json(self):
+        return self.__data
+
+
+class ResponseCache:
+    """
+    On-disk cache of API responses shared by every process using the same database file. The database runs in
+    WAL mode so readers never block behind a writer. Entries expire after a per-method TTL and the least
+    recently used entries are evicted once the cache grows past its size limit.
+    """
+
+    # Parameters that do not change the response and must not be part of the key
+    IGNORED_PARAMS = ("api_key", "format", "nojsoncallback")
+
+    DEFAULT_TTLS = {
+        "flickr.people.getinfo": 86400,
+        "flickr.photosets.getinfo": 3600,
+        "flickr.people.getpublicphotos": 3600,
+        "flickr.photosets.getphotos": 3600,
+        "flickr.groups.getinfo": 86400,
+        "flickr.groups.pools.getphotos": 900,
+        "flickr.photos.search": 900,
+        "flickr.photos.getallcontexts": 86400,
+        "flickr.photos.getinfo": 86400
+    }
+
+    def __init__(self, path, max_size_bytes, ttls=None):
+        self.__max_size_bytes = max_size_bytes
+        self.__ttls = dict(ResponseCache.DEFAULT_TTLS)
+        if ttls is not None:
+            self.__ttls.update(ttls)
+        self.__puts = 0
+        self.__conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                    key TEXT PRIMARY KEY,
+                                    body TEXT NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    expires_at REAL NOT NULL,
+                                    accessed_at REAL NOT NULL)""")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS accessed_at_idx ON responses (accessed_at)")
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds a response cache from the [cache] section of the configuration. Per-method TTLs in seconds are
+        read from options named cache.ttl.<api method>, e.g. cache.ttl.flickr.people.getInfo=86400
+        :param config: A configuration instance
+        :return: A response cache, or None if caching is disabled
+        """
+        max_size_mb = config.getfloat("cache", "cache.max_size_mb", fallback=64)
+        if max_size_mb <= 0:
+            return None
+
+        ttls = {}
+        if config.has_section("cache"):
+            for option, value in config.items("cache"):
+                if option.startswith("cache.ttl."):
+                    ttls[option[len("cache.ttl."):].lower()] = float(value)
+
+        return ResponseCache(config.get("cache", "cache.path", fallback="flickr_cache.db"),
+                             int(max_size_mb * 1024 * 1024),
+                             ttls)
+
+    @staticmethod
+    def make_key(method, params):
+        """
+        Builds a cache key from the API method and its parameters, ignoring parameter order and
+        parameters which do not affect the response
+        """
+        normalized = sorted((str(k), str(v).strip()) for k, v in params.items() if k not in ResponseCache.IGNORED_PARAMS and k != "method")
+        return "%s?%s" % (method.lower(), urlencode(normalized))
+
+    def ttl_for(self, method):
+        return self.__ttls.get(method.lower(), 0)
+
+    def get(self, method, params):
+        """
+        Fetches a cached response
+        :param method: The API method name
+        :param params: The request parameters
+        :return: The decoded response, or None if there is no unexpired entry
+        """
+        if self.ttl_for(method) <= 0:
+            return None
+
+        key = ResponseCache.make_key(method, params)
+        now = time.time()
+        row = self.__conn.execute("SELECT body FROM responses WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+
+        try:
+            self.__conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.OperationalError:
+            # Another process holds the write lock. Recency is advisory so skip the update.
+            pass
+        return FastJson.loads(row[0])
+
+    def put(self, method, params, body):
+        """
+        Stores a response body
+        :param method: The API method name
+        :param params: The request parameters
+        :param body: The raw response text
+        """
+        ttl = self.ttl_for(method)
+        if ttl <= 0:
+            return
+
+        key = ResponseCache.make_key(method, params)
+        now = time.time()
+        self.__conn.execute("INSERT OR REPLACE INTO responses (key, body, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                            (key, body, len(body), now + ttl, now))
+
+        self.__puts += 1
+        if self.__puts % 16 == 1:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries, then least recently used entries until the cache fits within its size limit
+        """
+        now = time.time()
+        self.__conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.__conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            total = self.__conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.__max_size_bytes:
+                excess = total - self.__max_size_bytes
+                freed = 0
+                victims = []
+                for key, size in self.__conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+                    victims.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                self.__conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+            self.__conn.execute("COMMIT")
+        except:
+            self.__conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        self.__conn.close()
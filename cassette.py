@@ -0,0 +1,216 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import gzip
+import json
+import time
+import base64
+import threading
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from log import get_logger
+
+logger = get_logger("cassette")
+
+# Query parameters holding credentials, left out of the cassette
+SECRET_PARAMS = frozenset(["api_key", "access_token", "oauth_token", "oauth_signature", "oauth_consumer_key"])
+
+# Response headers kept in the cassette
+KEPT_HEADERS = ("content-type", "retry-after", "x-rate-limit-remaining", "x-rate-limit-reset",
+                "x-ratelimit-limit", "x-ratelimit-remaining", "x-ratelimit-reset")
+
+
+class CassetteException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def normalize_url(url):
+    """
+    Strips credentials from a URL and sorts its query so that the same request always gives the same URL
+    """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Transport adapter which sends requests as usual and writes every response, or connection error, to a cassette
+    """
+
+    def __init__(self, cassette, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.__cassette = cassette
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = HTTPAdapter.send(self, request, **kwargs)
+            # Reads the body so its transfer counts towards the recorded time
+            content = response.content
+        except requests.exceptions.RequestException as ex:
+            self.__cassette.write({"method": request.method, "url": normalize_url(request.url),
+                                   "elapsed": time.perf_counter() - start,
+                                   "error": ex.__class__.__name__, "message": str(ex)})
+            raise
+        self.__cassette.write({"method": request.method, "url": normalize_url(request.url),
+                               "elapsed": time.perf_counter() - start,
+                               "status": response.status_code, "reason": response.reason,
+                               "headers": dict((k, v) for k, v in response.headers.items() if k.lower() in KEPT_HEADERS),
+                               "body": base64.b64encode(content).decode("ascii")})
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Transport adapter which answers requests from a cassette without touching the network
+    """
+
+    def __init__(self, cassette, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.__cassette = cassette
+
+    def send(self, request, **kwargs):
+        entry = self.__cassette.next_response(request.method, request.url)
+        if entry["elapsed"] > 0 and self.__cassette.scale > 0:
+            time.sleep(entry["elapsed"] * self.__cassette.scale)
+        if "error" in entry:
+            error_class = getattr(requests.exceptions, entry["error"], requests.exceptions.ConnectionError)
+            raise error_class(entry["message"], request=request)
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry.get("reason")
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(entry["body"])
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+class Cassette:
+    """
+    Gzipped JSON lines file of the HTTP exchanges and random picks of a run. In record mode every pooled
+    session sends its traffic through a RecordingAdapter; in replay mode through a ReplayAdapter which serves the
+    recorded responses in order, sleeping for their recorded time multiplied by scale, and Util.randint returns
+    the recorded picks so the run takes the same path. Credentials are not recorded.
+    """
+
+    RECORD = "record"
+    REPLAY = "replay"
+
+    def __init__(self, path, mode, scale=1.0):
+        self.path = path
+        self.mode = mode
+        self.scale = scale
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__responses = {}
+        self.__responses_by_path = {}
+        self.__randoms = deque()
+        if mode == Cassette.RECORD:
+            self.__file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            self.__load(path)
+
+    @staticmethod
+    def record(path):
+        logger.info("Recording API traffic to %s", path)
+        return Cassette(path, Cassette.RECORD)
+
+    @staticmethod
+    def replay(path, scale=1.0):
+        logger.info("Replaying API traffic from %s at %.2fx the recorded timings", path, scale)
+        return Cassette(path, Cassette.REPLAY, scale=scale)
+
+    def __load(self, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("type") == "random":
+                    self.__randoms.append(entry["value"])
+                    continue
+                entry["used"] = False
+                self.__responses.setdefault((entry["method"], entry["url"]), deque()).append(entry)
+                self.__responses_by_path.setdefault((entry["method"], entry["url"].split("?", 1)[0]), deque()).append(entry)
+
+    def write(self, entry):
+        with self.__lock:
+            self.__file.write(json.dumps(entry, separators=(",", ":")))
+            self.__file.write("\n")
+
+    def adapter(self, pool_size):
+        """
+        :return: The transport adapter sessions mount while this cassette is in use
+        """
+        adapter_class = RecordingAdapter if self.mode == Cassette.RECORD else ReplayAdapter
+        return adapter_class(self, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    @staticmethod
+    def __take(queue):
+        while len(queue) > 0:
+            entry = queue.popleft()
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+        return None
+
+    def next_response(self, method, url):
+        """
+        Finds the recorded response for a request: the next unused one for the same URL, else the next unused one
+        for the same path, as requests with timestamps in their query never repeat exactly
+        :raises CassetteException: If the cassette has no response left for the request
+        """
+        url = normalize_url(url)
+        with self.__lock:
+            entry = Cassette.__take(self.__responses.get((method, url), deque()))
+            if entry is None:
+                entry = Cassette.__take(self.__responses_by_path.get((method, url.split("?", 1)[0]), deque()))
+        if entry is None:
+            raise CassetteException("No recorded response for %s %s" % (method, url))
+        return entry
+
+    def random_value(self, value, min, max):
+        """
+        Records a random pick, or replaces it with the recorded one when replaying
+        :param value: The pick made by this run
+        :param min: Lowest allowed pick, recorded picks are clamped to the range of this run's pick
+        :param max: Highest allowed pick
+        """
+        with self.__lock:
+            if self.mode == Cassette.RECORD:
+                self.__file.write(json.dumps({"type": "random", "value": value}, separators=(",", ":")))
+                self.__file.write("\n")
+            elif len(self.__randoms) > 0:
+                value = sorted((min, self.__randoms.popleft(), max))[1]
+        return value
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
@@ -0,0 +1,404 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from email.parser import BytesParser
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm would delay on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.fake.connected()
+
+    def __respond(self):
+        parsed = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length > 0 else b""
+
+        status, content_type, payload = self.server.fake.dispatch(self.command, parsed.path, params, body, self.headers)
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.__respond()
+
+    def do_POST(self):
+        self.__respond()
+
+
+class FakeServer:
+    """
+    Local HTTP stand-in for a remote service with configurable latency and failure rate. Delays appended to
+    stalls are added to the next requests, one each. Subclasses implement handle() for the routes of the service
+    they imitate.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.connections = 0
+        self.stalls = []
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServerHandler)
+        self.__server.daemon_threads = True
+        self.__server.fake = self
+        self.__thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.__server.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, args=(0.05,), daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def connected(self):
+        with self.__lock:
+            self.connections += 1
+
+    def dispatch(self, method, path, params, body, headers):
+        with self.__lock:
+            self.requests += 1
+            fail = self.__random.random() < self.failure_rate
+            stall = self.stalls.pop(0) if len(self.stalls) > 0 else 0.0
+        if self.latency + stall > 0:
+            time.sleep(self.latency + stall)
+        if fail:
+            return 503, "text/plain", b"Injected failure"
+        return self.handle(method, path, params, body, headers)
+
+    def handle(self, method, path, params, body, headers):
+        raise NotImplementedError()
+
+    @staticmethod
+    def json_response(data, status=200):
+        return status, "application/json", json.dumps(data).encode("utf-8")
+
+
+class FakeImageCDN(FakeServer):
+    """
+    Serves JPEG-sized blobs of payload_size bytes at /images/<photo id>.jpg
+    """
+
+    def __init__(self, payload_size=200000, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.payload = b"\xff\xd8\xff\xe0" + b"\x00" * max(0, payload_size - 6) + b"\xff\xd9"
+
+    def image_url(self, photo_id):
+        return "%s/images/%s.jpg" % (self.url, photo_id)
+
+    def handle(self, method, path, params, body, headers):
+        if path.startswith("/images/"):
+            return 200, "image/jpeg", self.payload
+        return 404, "text/plain", b"Not found"
+
+
+class FakeFlickr(FakeServer):
+    """
+    Imitates the subset of the Flickr REST API used by the Flickr class. Every user has photos_per_user photos
+    and albums_per_user albums; photo descriptions are description_size characters long. Calls are counted per
+    API key in key_requests; keys in invalid_keys are rejected and keys in throttled_keys answered with a 429.
+    """
+
+    def __init__(self, cdn, photos_per_user=1000, albums_per_user=3, description_size=200, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.cdn = cdn
+        self.key_requests = {}
+        self.invalid_keys = set()
+        self.throttled_keys = set()
+        self.photos_per_user = photos_per_user
+        self.albums_per_user = albums_per_user
+        self.description_size = description_size
+
+    @property
+    def rest_url(self):
+        return "%s/services/rest/" % self.url
+
+    # Photo n of every user was uploaded at FIRST_UPLOAD + n * UPLOAD_INTERVAL
+    FIRST_UPLOAD = 1600000000
+    UPLOAD_INTERVAL = 60
+
+    # Image sizes Flickr can return in a listing, each with its url_, width_ and height_ fields. A listing only
+    # returns the sizes its extras ask for.
+    IMAGE_SIZES = (("sq", 75), ("t", 100), ("s", 240), ("q", 150), ("m", 500), ("n", 320), ("z", 640),
+                   ("c", 800), ("l", 1024), ("o", 4096))
+
+    def photo(self, user_id, number, extras=None):
+        photo_id = str(zlib.crc32(("%s/%d" % (user_id, number)).encode("utf-8")) + 1)
+        url = self.cdn.image_url(photo_id)
+        photo = {
+            "id": photo_id,
+            "secret": "%010x" % (int(photo_id) * 7919 % 0xffffffffff),
+            "server": "65535",
+            "farm": 66,
+            "ispublic": 1,
+            "isfriend": 0,
+            "isfamily": 0,
+            "owner": user_id,
+            "ownername": "User %s" % user_id,
+            "title": "Photo %d of %s" % (number, user_id),
+            "description": {"_content": ("<b>Description</b> " * (self.description_size // 19 + 1))[:self.description_size]},
+            "tags": "saturn jupiter galaxy nebula moon",
+            "license": str(number % 10),
+            "dateupload": str(FakeFlickr.FIRST_UPLOAD + number * FakeFlickr.UPLOAD_INTERVAL)
+        }
+        for size, edge in FakeFlickr.IMAGE_SIZES:
+            if extras is not None and "url_%s" % size not in extras:
+                continue
+            photo["url_%s" % size] = url
+            photo["width_%s" % size] = edge
+            photo["height_%s" % size] = edge * 2 // 3
+        return photo
+
+    def page_of(self, user_id, total, page, per_page, first=0, extras=None):
+        per_page = int(per_page) if per_page else 100
+        page = max(1, int(page) if page else 1)
+        start = (page - 1) * per_page
+        # Only the image sizes asked for are returned, as Flickr does
+        extras = None if extras is None else [extra.strip() for extra in extras.split(",")]
+        photos = [self.photo(user_id, first + n, extras) for n in range(start, min(total, start + per_page))] if per_page > 0 else []
+        return {
+            "page": page,
+            "pages": int(math.ceil(float(total) / per_page)) if per_page > 0 else 0,
+            "perpage": per_page,
+            "total": str(total),
+            "photo": photos
+        }
+
+    def handle(self, method, path, params, body, headers):
+        api_method = params.get("method")
+        user_id = params.get("user_id", "0@N00")
+
+        api_key = params.get("api_key")
+        self.key_requests[api_key] = self.key_requests.get(api_key, 0) + 1
+        if api_key in self.invalid_keys:
+            return FakeServer.json_response({"stat": "fail", "code": 100, "message": "Invalid API Key (Key not found)"})
+        if api_key in self.throttled_keys:
+            return FakeServer.json_response({"stat": "fail", "code": 429, "message": "Too many requests"}, status=429)
+
+        if api_method == "flickr.test.echo":
+            return FakeServer.json_response({"stat": "ok"})
+        elif api_method == "flickr.people.getInfo":
+            return FakeServer.json_response({
+                "person": {
+                    "id": user_id,
+                    "username": {"_content": "user_%s" % user_id},
+                    "realname": {"_content": "User %s" % user_id},
+                    "photos": {"count": {"_content": self.photos_per_user}}
+                },
+                "stat": "ok"
+            })
+        elif api_method == "flickr.people.getPublicPhotos":
+            return FakeServer.json_response({"photos": self.page_of(user_id, self.photos_per_user, params.get("page"), params.get("per_page"), extras=params.get("extras")), "stat": "ok"})
+        elif api_method == "flickr.photos.search" and "min_upload_date" in params:
+            first = max(0, -(-(int(params["min_upload_date"]) - FakeFlickr.FIRST_UPLOAD) // FakeFlickr.UPLOAD_INTERVAL))
+            total = max(0, self.photos_per_user - first)
+            return FakeServer.json_response({"photos": self.page_of(user_id, total, params.get("page"), params.get("per_page"), first, extras=params.get("extras")), "stat": "ok"})
+        elif api_method == "flickr.photos.search":
+            total = self.photos_per_user // 10
+            owner = params.get("group_id", user_id)
+            return FakeServer.json_response({"photos": self.page_of(owner, total, params.get("page"), params.get("per_page"), extras=params.get("extras")), "stat": "ok"})
+        elif api_method == "flickr.groups.getInfo":
+            return FakeServer.json_response({
+                "group": {
+                    "id": params.get("group_id"),
+                    "name": {"_content": "Group %s" % params.get("group_id")},
+                    "pool_count": {"_content": self.photos_per_user}
+                },
+                "stat": "ok"
+            })
+        elif api_method == "flickr.groups.pools.getPhotos":
+            group_id = params.get("group_id")
+            return FakeServer.json_response({"photos": self.page_of(group_id, self.photos_per_user, params.get("page"), params.get("per_page"), extras=params.get("extras")), "stat": "ok"})
+        elif api_method == "flickr.photosets.getInfo":
+            return FakeServer.json_response({
+                "photoset": {
+                    "id": params.get("photoset_id"),
+                    "owner": user_id,
+                    "photos": self.photos_per_user // self.albums_per_user,
+                    "title": {"_content": "Album %s" % params.get("photoset_id")}
+                },
+                "stat": "ok"
+            })
+        elif api_method == "flickr.photosets.getPhotos":
+            page = self.page_of(params.get("photoset_id"), self.photos_per_user // self.albums_per_user, params.get("page"), params.get("per_page"), extras=params.get("extras"))
+            page["id"] = params.get("photoset_id")
+            return FakeServer.json_response({"photoset": page, "stat": "ok"})
+        elif api_method == "flickr.photos.getAllContexts":
+            return FakeServer.json_response({"set": [{"id": "1"}], "stat": "ok"})
+        elif api_method == "flickr.photos.getInfo":
+            return FakeServer.json_response({"photo": {"id": params.get("photo_id")}, "stat": "ok"})
+        return FakeServer.json_response({"stat": "fail", "code": 112, "message": "Method not found"})
+
+
+class FakeTwitter(FakeServer):
+    """
+    Imitates the Twitter v1.1 endpoints used by the Twitter class. The mentions timeline returns the
+    configured mentions, newest first. Chunked uploads are checked for completeness on FINALIZE, and APPEND
+    fails with a 503 for segment indexes in failing_segments.
+    """
+
+    def __init__(self, mentions=None, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.mentions = mentions if mentions is not None else []
+        self.statuses = []
+        self.uploads = []
+        self.commands = []
+        self.failing_segments = set()
+        self.__media = {}
+        self.__next_id = 1000
+
+    @staticmethod
+    def form_fields(body, headers):
+        content_type = headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return dict((k, v[0]) for k, v in parse_qs(body.decode("utf-8")).items())
+        message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode("utf-8") + b"\r\n\r\n" + body)
+        fields = {}
+        for part in message.get_payload():
+            value = part.get_payload(decode=True)
+            fields[part.get_param("name", header="content-disposition")] = value if part.get_filename() is not None else value.decode("utf-8")
+        return fields
+
+    def __upload(self, fields):
+        command = fields.get("command")
+        self.commands.append((command, fields.get("segment_index")))
+        if command == "INIT":
+            self.__next_id += 1
+            self.__media[str(self.__next_id)] = {"total_bytes": int(fields["total_bytes"]), "segments": {}}
+            return FakeServer.json_response({"media_id": self.__next_id, "media_id_string": str(self.__next_id), "expires_after_secs": 86400})
+        media = self.__media.get(fields.get("media_id"))
+        if media is None:
+            return 400, "application/json", b'{"errors": [{"code": 324, "message": "Invalid media id"}]}'
+        if command == "APPEND":
+            segment_index = int(fields["segment_index"])
+            if segment_index in self.failing_segments:
+                return 503, "text/plain", b"Injected failure"
+            media["segments"][segment_index] = fields["media"]
+            return 204, "text/plain", b""
+        elif command == "FINALIZE":
+            data = b"".join(media["segments"][i] for i in sorted(media["segments"].keys()))
+            if len(data) != media["total_bytes"]:
+                return 400, "application/json", b'{"errors": [{"code": 324, "message": "File size mismatch"}]}'
+            self.uploads.append(len(data))
+            return FakeServer.json_response({"media_id": int(fields["media_id"]), "media_id_string": fields["media_id"], "size": len(data)})
+        return 400, "application/json", b'{"errors": [{"message": "Bad command"}]}'
+
+    def handle(self, method, path, params, body, headers):
+        if path == "/1.1/account/verify_credentials.json":
+            return FakeServer.json_response({"id": 1, "screen_name": "hourlycosmos"})
+        elif path == "/1.1/media/upload.json":
+            return self.__upload(FakeTwitter.form_fields(body, headers))
+        elif path == "/1.1/statuses/update.json":
+            self.__next_id += 1
+            self.statuses.append(parse_qs(body.decode("utf-8")))
+            return FakeServer.json_response({"id": self.__next_id})
+        elif path == "/1.1/statuses/mentions_timeline.json":
+            since_id = int(params.get("since_id", 0))
+            count = int(params.get("count", 20))
+            mentions = [m for m in self.mentions if m["id"] > since_id]
+            return FakeServer.json_response(sorted(mentions, key=lambda m: -m["id"])[:count])
+        return 404, "application/json", b'{"errors": [{"message": "Not found"}]}'
+
+    @staticmethod
+    def make_mention(mention_id, screen_name, text):
+        return {"id": mention_id, "text": text, "user": {"screen_name": screen_name}}
+
+
+class FakeMastodon(FakeServer):
+    """
+    Imitates the Mastodon endpoints used by the MastodonClient class. Uploaded media stays processing for
+    processing_polls polls of its attachment.
+    """
+
+    def __init__(self, mentions=None, processing_polls=0, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.mentions = mentions if mentions is not None else []
+        self.processing_polls = processing_polls
+        self.statuses = []
+        self.uploads = []
+        self.media_polls = 0
+        self.__processing = {}
+        self.__next_id = 1000
+
+    def handle(self, method, path, params, body, headers):
+        if path.startswith("/api/v1/instance") or path.startswith("/api/v2/instance"):
+            return FakeServer.json_response({"version": "4.2.0", "uri": "localhost", "title": "Fake"})
+        elif path == "/api/v1/accounts/verify_credentials":
+            return FakeServer.json_response({"id": "1", "acct": "hourlycosmos", "username": "hourlycosmos"})
+        elif path in ("/api/v1/media", "/api/v2/media"):
+            self.__next_id += 1
+            self.uploads.append(len(body))
+            media_id = str(self.__next_id)
+            if self.processing_polls > 0 and path == "/api/v2/media":
+                self.__processing[media_id] = self.processing_polls
+                return FakeServer.json_response({"id": media_id, "type": "image", "url": None}, status=202)
+            return FakeServer.json_response({"id": media_id, "type": "image", "url": "%s/media/%s" % (self.url, media_id)})
+        elif path.startswith("/api/v1/media/"):
+            media_id = path.rsplit("/", 1)[1]
+            self.media_polls += 1
+            if self.__processing.get(media_id, 0) > 0:
+                self.__processing[media_id] -= 1
+                return FakeServer.json_response({"id": media_id, "type": "image", "url": None}, status=206)
+            return FakeServer.json_response({"id": media_id, "type": "image", "url": "%s/media/%s" % (self.url, media_id)})
+        elif path == "/api/v1/statuses":
+            self.__next_id += 1
+            self.statuses.append(body)
+            return FakeServer.json_response({"id": str(self.__next_id), "content": ""})
+        elif path == "/api/v1/notifications":
+            since_id = int(params.get("since_id", 0) or 0)
+            limit = int(params.get("limit", 20))
+            mentions = [m for m in self.mentions if int(m["id"]) > since_id]
+            return FakeServer.json_response(sorted(mentions, key=lambda m: -int(m["id"]))[:limit])
+        return 404, "application/json", b'{"error": "Not found"}'
+
+    @staticmethod
+    def make_mention(mention_id, acct, text):
+        return {
+            "id": str(mention_id),
+            "type": "mention",
+            "account": {"id": "2", "acct": acct},
+            "status": {"id": str(mention_id + 1000000), "content": text}
+        }
@@ -0,0 +1,78 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import importlib.util
+
+# Fields of a listed photo the program reads: picking, crediting, captions, links and the search index
+PHOTO_FIELDS = ("id", "owner", "ownername", "title", "description", "license", "tags", "dateupload", "url_m")
+
+
+class FastJson:
+    """
+    Decodes API responses with orjson when it is installed, and the standard library otherwise, and projects
+    photo listings down to the fields the program reads. A page of 500 photos carries ten image sizes with their
+    dimensions for every photo; dropping what is never read keeps pages, cached bodies and index entries small.
+    """
+
+    __loads = None
+    __dumps = None
+
+    @staticmethod
+    def __load_codec():
+        if importlib.util.find_spec("orjson") is not None:
+            import orjson
+            FastJson.__dumps = lambda data: orjson.dumps(data).decode("utf-8")
+            FastJson.__loads = orjson.loads
+        else:
+            FastJson.__dumps = lambda data: json.dumps(data, separators=(",", ":"))
+            FastJson.__loads = json.loads
+
+    @staticmethod
+    def loads(content):
+        """
+        :param content: A JSON document, as bytes or str
+        :return: The decoded document
+        """
+        if FastJson.__loads is None:
+            FastJson.__load_codec()
+        return FastJson.__loads(content)
+
+    @staticmethod
+    def dumps(data):
+        """
+        :return: data encoded as a compact JSON str
+        """
+        if FastJson.__dumps is None:
+            FastJson.__load_codec()
+        return FastJson.__dumps(data)
+
+    @staticmethod
+    def project(data, container, fields):
+        """
+        Drops every field of the photos in a listing page except the given ones
+        :param data: A decoded listing response
+        :param container: Key of the page in the response, photos or photoset
+        :param fields: Names of the photo fields kept
+        :return: data
+        """
+        page = data.get(container)
+        if isinstance(page, dict) and "photo" in page:
+            page["photo"] = [dict((field, photo[field]) for field in fields if field in photo) for photo in page["photo"]]
+        return data
@@ -17,17 +17,19 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import sys
-import os
-import requests
-from configparser import ConfigParser
-import math
-import traceback
-import json
-import argparse
-import re
-import yaml
 from util import Util
+from ratelimit import RateLimiter
+from apikeys import ApiKeyPool
+from hedge import Hedger
+from fastjson import FastJson, PHOTO_FIELDS
+from cache import ResponseCache, CachedResponse
+from metrics import Metrics
+from tracing import Trace
+from imagestore import ImageStore
+
+
+# Every image size Flickr can return in a listing, asked for when listings are not projected
+IMAGE_URL_EXTRAS = ("url_sq", "url_t", "url_s", "url_q", "url_m", "url_n", "url_z", "url_c", "url_l", "url_o")
 
 
 class NoPhotosFoundException(Exception):
@@ -35,6 +37,11 @@ class NoPhotosFoundException(Exception):
         Exception.__init__(self, message)
 
 
+class NoSearchResultsException(NoPhotosFoundException):
+    def __init__(self, message):
+        NoPhotosFoundException.__init__(self, message)
+
+
 class NoAlbumsFoundException(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
@@ -51,17 +58,124 @@ class Flickr:
     PHOTOS_SHORTENED_URL_TEMPLATE = "https://flic.kr/p/{base58photoid}"
 
     def __init__(self, config):
-        self.__apikey = config.get("flickr", "flickr.key")
         self.page_size = config.get("flickr", "flickr.page_size")
+        self.rate_limiter = RateLimiter.from_config(config, "flickr")
+        self.keys = ApiKeyPool.from_config(config, self.rate_limiter)
+        self.priority = RateLimiter.PRIORITY_SCHEDULED
+        self.cache = ResponseCache.from_config(config)
+        self.image_store = ImageStore.from_config(config)
+        self.__session = Util.make_session(pool_size=config.getint("flickr", "flickr.pool_size", fallback=4))
+        self.__timeout = (config.getfloat("flickr", "flickr.connect_timeout", fallback=5),
+                          config.getfloat("flickr", "flickr.read_timeout", fallback=30))
+        self.image_timeout = (config.getfloat("images", "images.connect_timeout", fallback=5),
+                              config.getfloat("images", "images.read_timeout", fallback=60))
+        self.hedger = Hedger.from_config(config, "flickr")
+        self.image_hedger = Hedger.from_config(config, "image")
+        # Fields kept of every photo in a listing, or None to keep them all. Listings only ask for the image
+        # sizes that are kept.
+        self.photo_fields = None
+        self.image_url_extras = IMAGE_URL_EXTRAS
+        if config.getboolean("flickr", "flickr.project_fields", fallback=True):
+            image_url_attribute = config.get("flickr", "flickr.image_url_attribute", fallback="url_z")
+            self.photo_fields = PHOTO_FIELDS + (image_url_attribute,)
+            self.image_url_extras = tuple(sorted(set(("url_m", image_url_attribute))))
+
+    def close(self):
+        """
+        Shuts down the hedgers' threads and closes the key pool, rate limiter and response cache
+        """
+        for hedger in (self.hedger, self.image_hedger):
+            if hedger is not None:
+                hedger.close()
+        self.keys.close()
+        for store in (self.rate_limiter, self.cache):
+            if store is not None:
+                store.close()
+
+    def __extras(self, *fields):
+        """
+        :param fields: Listing extras other than image URLs
+        :return: The extras parameter of a photo listing
+        """
+        return ",".join(self.image_url_extras + fields)
+
+    def __project(self, data, container):
+        if container is None or self.photo_fields is None:
+            return data
+        return FastJson.project(data, container, self.photo_fields)
+
+    def __get(self, params, container=None):
+        """
+        Issues a Flickr REST API call. Responses are served from the shared cache when possible, otherwise
+        the call is made with the next API key of the pool, drawing from that key's rate limit first. A slow
+        call is hedged with a duplicate, which draws from the rate limit too, when hedging is enabled.
+        :param params: Request parameters, without the API key
+        :param container: For photo listings, the key of the page in the response, photos or photoset. Its photos
+                          are projected down to photo_fields, also in the cache.
+        :return: A decoded response, or the HTTP response of a failed call
+        """
+        method = params["method"]
+        cacheable = self.cache is not None and self.cache.ttl_for(method) > 0
+        if cacheable:
+            data = self.cache.get(method, params)
+            if data is not None:
+                Metrics.increment("flickr_cache_hits_total", method=method)
+                return CachedResponse(self.__project(data, container))
+
+        key = self.keys.acquire(self.priority)
+        with Metrics.timer("flickr_request", method=method), Trace.span("flickr_api", method=method):
+            if self.hedger is None:
+                resp = self.__send(params, key)
+            else:
+                resp = self.hedger.call(lambda key: self.__send(params, key), key,
+                                        hedge=lambda: self.keys.acquire(self.priority, max_wait=0))
+
+        if resp.status_code == 200:
+            data = self.__project(FastJson.loads(resp.content), container)
+            if cacheable and data.get("stat") == "ok":
+                self.cache.put(method, params, resp.text if container is None or self.photo_fields is None else FastJson.dumps(data))
+            return CachedResponse(data)
+        return resp
+
+    def __send(self, params, key):
+        """
+        Makes one attempt at a call with the given key and records its outcome in the key pool
+        """
+        try:
+            resp = self.__session.get(Flickr.REST_BASE_URL, params=dict(params, api_key=key["key"]), timeout=self.__timeout)
+        except Exception:
+            Metrics.increment("flickr_request_errors_total", method=params["method"])
+            raise
+        if resp.status_code != 200:
+            Metrics.increment("flickr_request_errors_total", method=params["method"])
+
+        # Key errors come back as short failure responses, so only those are parsed here
+        error_code = None
+        if resp.status_code == 200 and len(resp.content) < 512 and b'"fail"' in resp.content:
+            error_code = resp.json().get("code")
+        retry_after = resp.headers.get("Retry-After")
+        self.keys.record(key, resp.status_code, error_code=error_code,
+                         retry_after=float(retry_after) if retry_after is not None and retry_after.isdigit() else None)
+        return resp
+
+    def fetch_image_to_path(self, url, path):
+        """
+        Downloads an image, through the shared image store when it is enabled
+        :param url: The image URL
+        :param path: Where the image is written
+        :return: path
+        """
+        if self.image_store is not None:
+            return self.image_store.fetch(url, path, timeout=self.image_timeout, hedger=self.image_hedger)
+        return Util.fetch_image_to_path(url, path, timeout=self.image_timeout, hedger=self.image_hedger)
 
     def verify_credentials(self):
         """
         Simple method to verify the Flickr API key is still active and allowed.
         :return: True if the response received an HTTP status code of 200
         """
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.test.echo",
-            "api_key": self.__apikey,
             "format": "json",
             "nojsoncallback": 1
         })
@@ -73,9 +187,8 @@ class Flickr:
         :param user_id: Flickr numeric id
         :return: information about a Flickr user
         """
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.people.getInfo",
-            "api_key": self.__apikey,
             "user_id": user_id,
             "format": "json",
             "nojsoncallback": 1
@@ -95,9 +208,8 @@ class Flickr:
         """
         Fetches info on a particular photo
         """
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.photos.getAllContexts",
-            "api_key": self.__apikey,
             "photo_id": photo_id,
             "format": "json",
             "nojsoncallback": 1
@@ -127,9 +239,8 @@ class Flickr:
         """
         Fetches info on a particular photo
         """
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.photos.getInfo",
-            "api_key": self.__apikey,
             "photo_id": photo_id,
             "format": "json",
             "nojsoncallback": 1
@@ -161,18 +272,17 @@ class Flickr:
         if page_size is None:
             page_size = self.page_size
 
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.photos.search",
-            "api_key": self.__apikey,
             "user_id": user_id,
             "text": text,
             "format": "json",
             "nojsoncallback": 1,
             "privacy_filter": 1,
-            "extras": " url_sq,url_t,url_s,url_q,url_m,url_n,url_z,url_c,url_l,url_o,description,tags,owner_name",
+            "extras": self.__extras("description", "tags", "owner_name"),
             "per_page": page_size,
             "page": page
-        })
+        }, container="photos")
         if resp.status_code != 200:
             raise Exception("Error fetching Flickr search list. Status code: %s"%(resp.status_code))
 
@@ -183,6 +293,38 @@ class Flickr:
 
         return ps
 
+    def get_photos_uploaded_since(self, user_id, min_upload_date, page=1, page_size=500):
+        """
+        Fetches a user's public photos uploaded at or after a time, oldest first
+        :param user_id: Flickr numeric id
+        :param min_upload_date: Unix timestamp of the earliest upload to include
+        :param page: Results page number
+        :param page_size: Number of results per page
+        :return: A list of photos
+        """
+
+        resp = self.__get({
+            "method": "flickr.photos.search",
+            "user_id": user_id,
+            "min_upload_date": int(min_upload_date),
+            "sort": "date-posted-asc",
+            "format": "json",
+            "nojsoncallback": 1,
+            "privacy_filter": 1,
+            "extras": self.__extras("description", "tags", "owner_name", "license", "date_upload"),
+            "per_page": page_size,
+            "page": page
+        }, container="photos")
+        if resp.status_code != 200:
+            raise Exception("Error fetching Flickr photo list. Status code: %s"%(resp.status_code))
+
+        ps = resp.json()
+
+        if ps["stat"] != "ok":
+            raise Exception("Error fetching Flickr photo list. Reason: %s"%ps["message"])
+
+        return ps
+
     def get_photostream(self, user_id, page=1):
         """
         Fetches images from a Flickr user's photostream
@@ -190,16 +332,15 @@ class Flickr:
         :param page: Results page number
         :return: A list of photos
         """
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.people.getPublicPhotos",
-            "api_key": self.__apikey,
             "user_id": user_id,
             "format": "json",
             "nojsoncallback": 1,
-            "extras": " url_sq,url_t,url_s,url_q,url_m,url_n,url_z,url_c,url_l,url_o,description,tags,owner_name",
+            "extras": self.__extras("description", "tags", "owner_name"),
             "per_page": self.page_size,
             "page": page
-        })
+        }, container="photos")
 
         if resp.status_code != 200:
             raise Exception("Error fetching Flickr photostream list. Status code: %s"%(resp.status_code))
@@ -211,6 +352,66 @@ class Flickr:
 
         return ps
 
+    def get_group_info(self, group_id):
+        """
+        Fetches information about a Flickr group, including the number of photos in its pool
+        :param group_id: Group id
+        :return: information about a Flickr group
+        """
+        resp = self.__get({
+            "method": "flickr.groups.getInfo",
+            "group_id": group_id,
+            "format": "json",
+            "nojsoncallback": 1
+        })
+
+        if resp.status_code != 200:
+            raise Exception("Error fetching Flickr group information. Status code: %s"%(resp.status_code))
+
+        group_info = resp.json()
+
+        if group_info["stat"] != "ok":
+            raise Exception("Error fetching Flickr group information. Reason: %s"%group_info["message"])
+
+        return group_info
+
+    def search_group_photos(self, group_id, text, page=1, page_size=None):
+        """
+        Searches group pool photos using full-text search
+        :param group_id: Group id
+        :param text: Full-text search term
+        :param page: Results page number
+        :param page_size: Number of results per page (default determined by config.ini)
+        :return: A list of matching photos
+        """
+
+        if text is None or len(text) == 0:
+            raise Exception("Invalid zero-length search term used.")
+
+        if page_size is None:
+            page_size = self.page_size
+
+        resp = self.__get({
+            "method": "flickr.photos.search",
+            "group_id": group_id,
+            "text": text,
+            "format": "json",
+            "nojsoncallback": 1,
+            "privacy_filter": 1,
+            "extras": self.__extras("description", "tags", "owner_name", "license"),
+            "per_page": page_size,
+            "page": page
+        }, container="photos")
+        if resp.status_code != 200:
+            raise Exception("Error fetching Flickr search list. Status code: %s"%(resp.status_code))
+
+        ps = resp.json()
+
+        if ps["stat"] != "ok":
+            raise Exception("Error fetching Flickr search. Reason: %s"%ps["message"])
+
+        return ps
+
     def get_group_photos(self, group_id, page=1):
         """
         Fetches photos from a Flickr group pool
@@ -219,16 +420,15 @@ class Flickr:
         :return: A list of photos
         """
 
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.groups.pools.getPhotos",
-            "api_key": self.__apikey,
             "group_id": group_id,
             "format": "json",
             "nojsoncallback": 1,
-            "extras": " url_sq,url_t,url_s,url_q,url_m,url_n,url_z,url_c,url_l,url_o,description,tags,owner_name,license",
+            "extras": self.__extras("description", "tags", "owner_name", "license"),
             "per_page": self.page_size,
             "page": page
-        })
+        }, container="photos")
 
         if resp.status_code != 200:
             raise Exception("Error fetching Flickr group photo list. Status code: %s"%(resp.status_code))
@@ -249,9 +449,8 @@ class Flickr:
         :return: Information about the Flickr album
         """
 
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.photosets.getInfo",
-            "api_key": self.__apikey,
             "user_id": user_id,
             "photoset_id": photoset_id,
             "format": "json",
@@ -276,17 +475,16 @@ class Flickr:
         :return: A list of photos
         """
 
-        resp = requests.get(Flickr.REST_BASE_URL, params={
+        resp = self.__get({
             "method": "flickr.photosets.getPhotos",
-            "api_key": self.__apikey,
             "user_id": user_id,
             "photoset_id": photoset_id,
             "format": "json",
             "nojsoncallback": 1,
-            "extras": " url_sq,url_t,url_s,url_q,url_m,url_n,url_z,url_c,url_l,url_o,description,tags,owner_name,license",
+            "extras": self.__extras("description", "tags", "owner_name", "license"),
             "per_page": self.page_size,
             "page": page
-        })
+        }, container="photoset")
 
         if resp.status_code != 200:
             raise Exception("Error fetching Flickr album photo list. Status code: %s"%(resp.status_code))
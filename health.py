@@ -0,0 +1,149 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sqlite3
+import time
+
+from metrics import Metrics
+from log import get_logger
+
+logger = get_logger("health")
+
+
+class SourceHealth:
+    """
+    Persistent circuit breaker per Flickr source. A source whose account lookup or photo listing fails
+    failure_threshold times in a row is opened and no longer picked. Once its cooldown has passed a single
+    probe is let through: success closes the circuit again, failure reopens it with the cooldown doubled,
+    up to max_cooldown_hours.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # How long a half-open probe holds the source before another run may probe it
+    PROBE_TIMEOUT = 600.0
+
+    def __init__(self, path, failure_threshold=3, cooldown_hours=6, max_cooldown_hours=168):
+        self.__failure_threshold = failure_threshold
+        self.__cooldown_seconds = float(cooldown_hours) * 3600.0
+        self.__max_cooldown_seconds = float(max_cooldown_hours) * 3600.0
+        self.__conn = sqlite3.connect(path, timeout=30)
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS source_health (
+                                    flickr_id TEXT PRIMARY KEY,
+                                    state TEXT NOT NULL,
+                                    failures INTEGER NOT NULL,
+                                    opens INTEGER NOT NULL,
+                                    changed_at REAL NOT NULL,
+                                    last_error TEXT)""")
+        self.__conn.commit()
+        self.__circuits = {}
+        for row in self.__conn.execute("SELECT flickr_id, state, failures, opens, changed_at FROM source_health"):
+            self.__circuits[row[0]] = {"state": row[1], "failures": row[2], "opens": row[3], "changed_at": row[4]}
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds a source health tracker from the [health] section of the configuration
+        :param config: A configuration instance
+        :return: A source health tracker, or None if the circuit breaker is disabled
+        """
+        failure_threshold = config.getint("health", "health.failure_threshold", fallback=3)
+        if failure_threshold <= 0:
+            return None
+        return SourceHealth(config.get("health", "health.path", fallback="source_health.db"),
+                            failure_threshold=failure_threshold,
+                            cooldown_hours=config.getfloat("health", "health.cooldown_hours", fallback=6),
+                            max_cooldown_hours=config.getfloat("health", "health.max_cooldown_hours", fallback=168))
+
+    def __save(self, flickr_id, circuit, error=None):
+        self.__circuits[flickr_id] = circuit
+        self.__conn.execute("""INSERT OR REPLACE INTO source_health (flickr_id, state, failures, opens, changed_at, last_error)
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (flickr_id, circuit["state"], circuit["failures"], circuit["opens"], circuit["changed_at"], error))
+        self.__conn.commit()
+
+    def __cooldown(self, circuit):
+        return min(self.__max_cooldown_seconds, self.__cooldown_seconds * (2 ** max(0, circuit["opens"] - 1)))
+
+    def state(self, flickr_id):
+        circuit = self.__circuits.get(str(flickr_id))
+        return SourceHealth.CLOSED if circuit is None else circuit["state"]
+
+    def is_available(self, flickr_id):
+        """
+        Checks whether a source may be used. An open circuit whose cooldown has passed is moved to half-open
+        and this caller becomes its probe.
+        :param flickr_id: The source's Flickr id
+        :return: True if the source may be used
+        """
+        flickr_id = str(flickr_id)
+        circuit = self.__circuits.get(flickr_id)
+        if circuit is None or circuit["state"] == SourceHealth.CLOSED:
+            return True
+
+        now = time.time()
+        if circuit["state"] == SourceHealth.OPEN and now >= circuit["changed_at"] + self.__cooldown(circuit):
+            logger.info("Probing source %s after its cooldown", flickr_id)
+        elif circuit["state"] == SourceHealth.HALF_OPEN and now >= circuit["changed_at"] + SourceHealth.PROBE_TIMEOUT:
+            logger.warning("Probe of source %s never finished, probing again", flickr_id)
+        else:
+            return False
+
+        circuit = dict(circuit, state=SourceHealth.HALF_OPEN, changed_at=now)
+        self.__save(flickr_id, circuit)
+        return True
+
+    def filter_available(self, sources):
+        """
+        :param sources: A list of sources
+        :return: The sources that may be used
+        """
+        return [source for source in sources if self.is_available(source.get_flickr_id())]
+
+    def record_success(self, flickr_id):
+        flickr_id = str(flickr_id)
+        circuit = self.__circuits.get(flickr_id)
+        if circuit is None or (circuit["state"] == SourceHealth.CLOSED and circuit["failures"] == 0):
+            return
+        if circuit["state"] != SourceHealth.CLOSED:
+            logger.info("Source %s recovered", flickr_id)
+        self.__save(flickr_id, {"state": SourceHealth.CLOSED, "failures": 0, "opens": 0, "changed_at": time.time()})
+
+    def record_failure(self, flickr_id, error=None):
+        """
+        Records a failed lookup or listing for a source, opening its circuit when the threshold is reached or
+        when it was being probed
+        :param flickr_id: The source's Flickr id
+        :param error: Description of the failure
+        """
+        flickr_id = str(flickr_id)
+        circuit = self.__circuits.get(flickr_id, {"state": SourceHealth.CLOSED, "failures": 0, "opens": 0, "changed_at": 0})
+        circuit = dict(circuit, failures=circuit["failures"] + 1)
+        if circuit["state"] == SourceHealth.HALF_OPEN or circuit["failures"] >= self.__failure_threshold:
+            circuit["state"] = SourceHealth.OPEN
+            circuit["opens"] += 1
+            circuit["changed_at"] = time.time()
+            logger.warning("Opening circuit for source %s after %d failures, retrying in %.1f hours", flickr_id, circuit["failures"], self.__cooldown(circuit) / 3600.0)
+            Metrics.increment("source_circuit_opened_total")
+        self.__save(flickr_id, circuit, None if error is None else str(error))
+
+    def close(self):
+        self.__conn.close()
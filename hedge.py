@@ -0,0 +1,140 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import threading
+from collections import deque
+
+from ratelimit import RateLimitExceededException
+from metrics import Metrics
+from log import get_logger
+
+logger = get_logger("hedge")
+
+
+class Hedger:
+    """
+    Hedges idempotent requests against tail latency. An attempt that has not answered once the quantile (p95 by
+    default) of recently seen latencies has passed gets a duplicate, and whichever answers first is used. The
+    slower attempt is left to run out within its own timeout and its result is dropped. Until min_samples
+    latencies have been seen, initial_delay stands in for the quantile.
+    """
+
+    def __init__(self, name, quantile=0.95, initial_delay=1.0, min_delay=0.05, min_samples=20, window=200, workers=8):
+        self.name = name
+        self.__quantile = quantile
+        self.__initial_delay = float(initial_delay)
+        self.__min_delay = float(min_delay)
+        self.__min_samples = min_samples
+        self.__latencies = deque(maxlen=window)
+        self.__workers = workers
+        self.__lock = threading.Lock()
+        self.__pool = None
+
+    @staticmethod
+    def from_config(config, name):
+        """
+        Builds a hedger from the [hedge] section of the configuration
+        :param config: A configuration instance
+        :param name: Kind of request hedged, flickr or image
+        :return: A hedger, or None if hedging is disabled
+        """
+        if not config.getboolean("hedge", "hedge.enabled", fallback=False):
+            return None
+        return Hedger(name,
+                      quantile=config.getfloat("hedge", "hedge.quantile", fallback=0.95),
+                      initial_delay=config.getfloat("hedge", "hedge.%s.initial_delay" % name, fallback=1.0),
+                      min_delay=config.getfloat("hedge", "hedge.min_delay", fallback=0.05),
+                      min_samples=config.getint("hedge", "hedge.min_samples", fallback=20),
+                      window=config.getint("hedge", "hedge.window", fallback=200),
+                      workers=config.getint("hedge", "hedge.workers", fallback=8))
+
+    def delay(self):
+        """
+        :return: Seconds to wait for an attempt before sending a duplicate
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if len(latencies) < self.__min_samples:
+            return self.__initial_delay
+        return max(self.__min_delay, latencies[min(len(latencies) - 1, int(self.__quantile * len(latencies)))])
+
+    def __get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.__pool = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="hedge-%s" % self.name)
+            return self.__pool
+
+    def __attempt(self, attempt, arg):
+        # Failed and timed out attempts count too, or a slow failing service would keep a low hedge delay
+        start = time.perf_counter()
+        try:
+            return attempt(arg)
+        finally:
+            with self.__lock:
+                self.__latencies.append(time.perf_counter() - start)
+
+    def call(self, attempt, arg=None, hedge=None):
+        """
+        :param attempt: Makes one attempt, called with arg
+        :param arg: Argument of the first attempt
+        :param hedge: Called before a duplicate is sent and returns its argument, e.g. after drawing from a rate
+                      limiter. If it raises RateLimitExceededException no duplicate is sent. None to send the
+                      duplicate with arg.
+        :return: The result of the first attempt to succeed
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        pool = self.__get_pool()
+        first = pool.submit(self.__attempt, attempt, arg)
+        done, pending = wait([first], timeout=self.delay())
+        if len(done) > 0:
+            return first.result()
+
+        try:
+            hedge_arg = hedge() if hedge is not None else arg
+        except RateLimitExceededException:
+            Metrics.increment("hedges_skipped_total", request=self.name)
+            return first.result()
+        logger.debug("Hedging %s request after %.3f seconds", self.name, self.delay())
+        Metrics.increment("hedges_total", request=self.name)
+        second = pool.submit(self.__attempt, attempt, hedge_arg)
+
+        pending = [first, second]
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        Metrics.increment("hedge_wins_total", request=self.name)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def close(self):
+        """
+        Shuts the attempt threads down. Attempts that have not started are dropped; a losing attempt still
+        running is left to run out within its own timeout.
+        """
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False, cancel_futures=True)
+                self.__pool = None
@@ -0,0 +1,95 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sqlite3
+import time
+
+
+class PostedHistory:
+    """
+    Persistent record of the Flickr photos that have been posted to a destination. The full history is kept
+    in SQLite while the photo ids posted within the no-repeat window are held in memory with their post times so
+    candidate checks are constant time regardless of how large the history grows. A photo leaves the window
+    once its post time is older than the window, also in a long-running process.
+    """
+
+    def __init__(self, path, destination, window_hours=24):
+        self.__destination = destination
+        self.__window_seconds = float(window_hours) * 3600.0
+        self.__conn = sqlite3.connect(path, timeout=30)
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS posted (
+                                    destination TEXT NOT NULL,
+                                    photo_id TEXT NOT NULL,
+                                    posted_at REAL NOT NULL,
+                                    PRIMARY KEY (destination, photo_id))""")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS posted_at_idx ON posted (destination, posted_at)")
+        self.__conn.commit()
+        self.__recent = self.__load_recent()
+
+    @staticmethod
+    def from_config(config, destination):
+        """
+        Builds a history store from the [history] section of the configuration
+        :param config: A configuration instance
+        :param destination: The destination social media name
+        :return: A history store, or None if history tracking is disabled
+        """
+        window_hours = config.getfloat("history", "history.window_hours", fallback=24)
+        if window_hours <= 0:
+            return None
+        path = config.get("history", "history.path", fallback="posted_history.db")
+        return PostedHistory(path, destination.lower(), window_hours)
+
+    def __load_recent(self):
+        if self.__window_seconds <= 0:
+            return {}
+        cutoff = time.time() - self.__window_seconds
+        rows = self.__conn.execute("SELECT photo_id, posted_at FROM posted WHERE destination = ? AND posted_at >= ?",
+                                   (self.__destination, cutoff))
+        return dict((row[0], row[1]) for row in rows)
+
+    def was_recently_posted(self, photo_id):
+        """
+        Checks whether a photo has been posted within the no-repeat window
+        :param photo_id: A Flickr photo id
+        :return: True if the photo was posted within the window
+        """
+        photo_id = str(photo_id)
+        posted_at = self.__recent.get(photo_id)
+        if posted_at is None:
+            return False
+        if time.time() - posted_at >= self.__window_seconds:
+            del self.__recent[photo_id]
+            return False
+        return True
+
+    def record(self, photo_id):
+        """
+        Records a photo as having just been posted
+        :param photo_id: A Flickr photo id
+        """
+        photo_id = str(photo_id)
+        now = time.time()
+        self.__conn.execute("INSERT OR REPLACE INTO posted (destination, photo_id, posted_at) VALUES (?, ?, ?)",
+                            (self.__destination, photo_id, now))
+        self.__conn.commit()
+        self.__recent[photo_id] = now
+
+    def close(self):
+        self.__conn.close()
@@ -19,61 +19,171 @@ limitations under the License.
 
 import sys
 import os
-import requests
-from configparser import ConfigParser
-import math
-import traceback
-import json
+import time
 import argparse
 import re
-import yaml
-from yaml import Loader
-import re
+import json
+import threading
+from configparser import ConfigParser
 
 from util import Util
-from flickr import Flickr, NoAlbumsFoundException, NoPhotosFoundException
-from twitter import Twitter
-from mstdn import MastodonClient
-from source import Source
+from flickr import Flickr, NoAlbumsFoundException, NoPhotosFoundException, NoSearchResultsException
+from source import Source, GroupSource, NoSourcesFoundException
+from history import PostedHistory
+from health import SourceHealth
+from searchindex import SearchIndex, source_key
+from transcode import Transcoder, TranscodeException
+from ratelimit import RateLimiter, RateLimitExceededException
+from metrics import Metrics
+from tracing import Trace
+from snapshot import Snapshot
+from journal import MentionJournal
+from mentionlimit import MentionLimiter
+from outbox import Outbox, QueuedPublisher
+from log import Log, get_logger
+
+logger = get_logger("hourlyplanet")
 
 # https://stackoverflow.com/questions/9662346/python-code-to-remove-html-tags-from-a-string
 CLEANR = re.compile('<.*?>') 
 
+BUSY_REPLY = "I'm a little busy right now. Try again later!"
+
 def strip_html_tags(s):
     cleantext = re.sub(CLEANR, '', s)
     return cleantext
 
-def find_and_post_image(config, sources, flickr, twitter, search_term=None, respond_to_user=None, respond_to_id=None):
+def is_recently_posted(history, image):
+    """
+    Checks a candidate image against the posted history
+    :param history: A posted history store, or None if history tracking is disabled
+    :param image: A candidate Flickr image
+    :return: True if the image was posted within the no-repeat window
+    """
+    if history is None or image is None:
+        return False
+    if history.was_recently_posted(image["id"]):
+        logger.info("Rejecting image %s, already posted within the no-repeat window", image["id"])
+        return True
+    return False
+
+
+def find_indexed_image(index, sources, search_term, history=None, health=None):
+    """
+    Picks a photo matching a search term from the local search index. A source is picked at random among
+    those with matches, then a photo among its matches, as with Flickr search.
+    :param index: A search index
+    :param sources: A list of sources
+    :param search_term: The search term
+    :param history: A posted history store, or None if history tracking is disabled
+    :param health: A source health tracker, or None if the circuit breaker is disabled
+    :return: The source and the photo, or None and None if the index has no match
+    """
+    sources_by_id = {}
+    for source in sources:
+        if health is None or health.state(source.get_flickr_id()) != SourceHealth.OPEN:
+            sources_by_id[source_key(source)] = source
+
+    matches = index.search(search_term, sources_by_id.keys())
+    if history is not None:
+        for source_id in list(matches.keys()):
+            matches[source_id] = [photo_id for photo_id in matches[source_id] if not history.was_recently_posted(photo_id)]
+            if len(matches[source_id]) == 0:
+                del matches[source_id]
+    if len(matches) == 0:
+        return None, None
+
+    source_ids = sorted(matches.keys())
+    source_id = source_ids[Util.randint(0, len(source_ids) - 1)]
+    photo_ids = matches[source_id]
+    photo_id = photo_ids[Util.randint(0, len(photo_ids) - 1)]
+    logger.info("Search index has %d images matching '%s' across %d sources", sum(len(m) for m in matches.values()), search_term, len(matches))
+    return sources_by_id[source_id], index.get_photo(source_id, photo_id)
+
+
+def find_and_post_image(config, sources, flickr, twitter, search_term=None, respond_to_user=None, respond_to_id=None, history=None, health=None, index=None, transcoder=None):
+
+    start_time = time.perf_counter()
+    kind = "post" if respond_to_id is None else "reply"
+    max_attempts = config.getint("flickr", "flickr.max_attempts", fallback=15)
 
     source = None
     random_image = None
-    if search_term is not None:
-        # TODO: Move the retry count to the config
-        for i in range(0, 15):
-            source = get_random_source(sources)
+    if search_term is not None and index is not None:
+        with Trace.span("index_search", search_term=search_term):
+            source, random_image = find_indexed_image(index, sources, search_term, history=history, health=health)
+        Metrics.increment("index_search_total", result="hit" if random_image is not None else "miss")
+
+    # Flickr search is the fallback for terms the index has no match for
+    if search_term is not None and random_image is None:
+        # Sources without a match for this search term are not picked again for it
+        missed = set()
+        for i in range(0, max_attempts):
+            if i > 0:
+                Metrics.increment("selection_retries_total", kind=kind)
+            try:
+                source = get_random_source(sources, health=health, exclude=missed)
+            except NoSourcesFoundException:
+                source = None
+                break
             try:
-                random_image = source.get_random_search_image(text=search_term)
+                with Trace.span("flickr_search", flickr_id=source.get_flickr_id(), attempt=i):
+                    random_image = source.get_random_search_image(text=search_term)
+            except NoSearchResultsException as ex:
+                missed.add(source)
             except NoPhotosFoundException as ex:
+                # e.g. a pick outside the source's albums, another pick from it may still match
                 pass
+            except RateLimitExceededException:
+                raise
+            except Exception as ex:
+                if health is None:
+                    raise
+                health.record_failure(source.get_flickr_id(), ex)
+                missed.add(source)
+            if health is not None and random_image is not None:
+                health.record_success(source.get_flickr_id())
+            if is_recently_posted(history, random_image):
+                random_image = None
             if source is not None and random_image is not None:
                 break
         # If there was no search term or a search yielded no images
         if source is None or random_image is None:
-            print("Couldn't find a suitable result for search term '%s'"%search_term)
-            print("Posting reply to status id %s"%respond_to_id)
+            logger.info("Couldn't find a suitable result for search term '%s'", search_term)
+            logger.info("Posting reply to status id %s", respond_to_id)
             twitter.post_text("Couldn't find your image. Try again!", respond_to_user=respond_to_user, respond_to_id=respond_to_id)
             return
 
     if random_image is None:
-        source = get_random_source(sources)
-        random_image = source.get_random_image()
-        
+        for i in range(0, max_attempts):
+            if i > 0:
+                Metrics.increment("selection_retries_total", kind=kind)
+            source = get_random_source(sources, health=health)
+            try:
+                with Trace.span("flickr_listing", flickr_id=source.get_flickr_id(), attempt=i):
+                    random_image = source.get_random_image()
+            except NoPhotosFoundException as ex:
+                # An empty page, or one without a photo under the source's licenses, says nothing about its health
+                logger.info("No usable photos on the picked page of %s: %s", source.get_flickr_id(), ex)
+                continue
+            except RateLimitExceededException:
+                raise
+            except Exception as ex:
+                if health is None:
+                    raise
+                health.record_failure(source.get_flickr_id(), ex)
+                continue
+            if health is not None:
+                health.record_success(source.get_flickr_id())
+            if not is_recently_posted(history, random_image):
+                break
+            random_image = None
+
     if random_image is None:        
         raise Exception("No images found")
     
-    print("Selected Flickr ID: %s, Social User: %s" % (source.get_flickr_id(), twitter.get_social_id_from_source(source)))
-
-    shortened_image_link = flickr.make_shortened_image_link(random_image)
+    logger.info("Selected Flickr ID: %s, Social User: %s", source.get_flickr_id(), twitter.get_social_id_from_source(source),
+                extra={"flickr_id": source.get_flickr_id(), "photo_id": random_image["id"], "kind": kind})
 
     image_url_attribute = config.get("flickr", "flickr.image_url_attribute")
     if image_url_attribute in random_image:
@@ -82,16 +192,37 @@ def find_and_post_image(config, sources, flickr, twitter, search_term=None, resp
         image_url = random_image["url_m"]
 
     image_title = random_image["title"]
-
-    description = strip_html_tags(random_image["description"]["_content"])
     temp_jpg_file = "image_{pid}.jpg".format(pid=os.getpid())
-    print("Selected image '%s' at %s" % (image_title, image_url))
-    Util.fetch_image_to_path(image_url, temp_jpg_file)
+    logger.info("Selected image '%s' at %s", image_title, image_url)
 
-    twitter.post_image(image_title, source, shortened_image_link, respond_to_user=respond_to_user, respond_to_id=respond_to_id, image_path=temp_jpg_file, alt_text=description)
+    # The caption takes microseconds to prepare and the upload needs the whole file, so nothing is worth
+    # overlapping with the download
+    shortened_image_link = flickr.make_shortened_image_link(random_image)
+    description = strip_html_tags(random_image["description"]["_content"])
+    with Trace.span("image_download", url=image_url):
+        flickr.fetch_image_to_path(image_url, temp_jpg_file)
+    if transcoder is not None:
+        try:
+            transcoder.prepare(temp_jpg_file, random_image["id"], twitter.destination)
+        except TranscodeException as ex:
+            logger.error("Skipping image %s: %s", random_image["id"], ex)
+            Metrics.increment("post_errors_total", kind=kind)
+            os.unlink(temp_jpg_file)
+            return False
+
+    with Trace.span("publish", kind=kind):
+        posted = twitter.post_image(image_title, source, shortened_image_link, respond_to_user=respond_to_user, respond_to_id=respond_to_id, image_path=temp_jpg_file, alt_text=description)
+    if posted and history is not None:
+        history.record(random_image["id"])
+
+    if posted:
+        Metrics.observe("post_seconds", time.perf_counter() - start_time, kind=kind)
+    else:
+        Metrics.increment("post_errors_total", kind=kind)
 
     if os.path.exists(temp_jpg_file):
         os.unlink(temp_jpg_file)
+    return posted
 
 
 
@@ -107,16 +238,15 @@ def check_translations(translations, mention_text, base_word="please"):
     if base_word not in translations["translations"]:
         raise Exception("Baseword '%s' does not exist in the translation struct"%base_word)
 
-    for translation in translations["translations"][base_word]:
-        translation = translation.lower()
+    for translation in get_matchers(translations)["lower"][base_word]:
         if translation in mention_text:
             return True
     return False
 
 
 def find_search_term_of(s, translations):
-    for translation in translations["translations"]["of"]:
-        m = re.search("(?<= %s )[ \w]+"%translation, s)
+    for pattern in get_matchers(translations)["of"]:
+        m = pattern.search(s)
         if m is not None:
             return m
     return None
@@ -137,16 +267,66 @@ def find_search_term(s, translations):
     t = t.lower()
     t = re.sub(r"^(an|a|the) ", "", t)
 
-    for translation in translations["translations"]["please"]:
-        translation = translation.lower()
-        t = re.sub(r" %s"%translation, "", t)
+    for pattern in get_matchers(translations)["please_strip"]:
+        t = pattern.sub("", t)
 
     t = t.strip()
 
     return t
 
 
-def respond_to_mentions(config, sources, translations, flickr, twitter, since_id=None):
+def respond_to_mention(config, sources, translations, flickr, twitter, mention, history=None, health=None, index=None, transcoder=None, limiter=None, options=None):
+    """
+    Responds to a single mention
+    :param mention: The mention
+    :param limiter: A mention limiter deciding which image requests are answered, or None to answer all
+    :param options: The bot's options, whose files a status check reports on, or None for the command line's
+    :return: True if a reply was posted, False if the mention did not ask for anything or was not answered
+    """
+    mention_text = mention["text"].lower()
+    orig_mention_text = mention_text
+    mention_text = re.sub('p+', 'p', mention_text)
+    mention_text = re.sub('l+', 'l', mention_text)
+    mention_text = re.sub('e+', 'e', mention_text)
+    mention_text = re.sub('a+', 'a', mention_text)
+    mention_text = re.sub('s+', 's', mention_text)
+    respond_to_id = mention["status_id"]
+    respond_to_user = "@%s" % mention["user"]["screen_name"]
+    replied = False
+    if check_translations(translations, mention_text):
+        search_term = find_search_term(orig_mention_text, translations)
+        decision = MentionLimiter.ADMIT if limiter is None else limiter.check(mention["user"]["screen_name"], search_term)
+        if decision == MentionLimiter.ADMIT:
+            try:
+                with Trace.span("mention_reply", status_id=respond_to_id, search_term=search_term):
+                    posted = find_and_post_image(config, sources, flickr, twitter, search_term=search_term, respond_to_user=respond_to_user, respond_to_id=respond_to_id, history=history, health=health, index=index, transcoder=transcoder)
+                # Only an image reply that went out makes a repeat of the request a duplicate
+                if posted and limiter is not None:
+                    limiter.record(mention["user"]["screen_name"], search_term)
+            except RateLimitExceededException as ex:
+                logger.warning("Shedding reply to status id %s: %s", respond_to_id, ex)
+                twitter.post_text(BUSY_REPLY, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+            replied = True
+        elif decision == MentionLimiter.SHED:
+            logger.warning("Shedding reply to status id %s, image replies are over their budget", respond_to_id)
+            twitter.post_text(BUSY_REPLY, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+            replied = True
+        else:
+            logger.info("Not answering status id %s from %s: %s", respond_to_id, respond_to_user, decision,
+                        extra={"user": respond_to_user, "decision": decision})
+    if "status check" in mention_text:
+        with Trace.span("status_check"):
+            status = validate(config, options)
+        twitter.post_text(status, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        replied = True
+    if "fantastic, thank you" in mention_text:
+        status = "You're welcome :-)"
+        twitter.post_text(status, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        replied = True
+    return replied
+
+
+def respond_to_mentions(config, sources, translations, flickr, twitter, since_id=None, history=None, journal=None, health=None, index=None, transcoder=None, limiter=None, options=None):
     """
     Checks for and responds to Twitter mentions asking for images. The mention must include 'please' or an internationalized translation
     of the word. It will also attempt (via a simple method) to determine if the user is searching for something specific and return
@@ -157,132 +337,491 @@ def respond_to_mentions(config, sources, translations, flickr, twitter, since_id
     :param flickr: An instance of the Flickr API
     :param twitter: An instance of the Twitter API
     :param since_id: The last seen post id from the previous run
+    :param history: A posted history store, or None if history tracking is disabled
+    :param journal: A mention journal, or None if journaling is disabled. With a journal, mentions finished by
+                    an earlier run are skipped and a mention that fails is journaled instead of ending the run.
+    :param health: A source health tracker, or None if the circuit breaker is disabled
+    :param index: A search index, or None to search Flickr directly
+    :param transcoder: An image transcoder, or None to post images as downloaded
+    :param limiter: A mention limiter deciding which image requests are answered, or None to answer all
+    :param options: The bot's options, whose files a status check reports on, or None for the command line's
     :return: The highest id of the mentions processed during this run
     """
-    mentions = twitter.get_mentions(since_id=since_id)
+    with Trace.span("get_mentions"):
+        mentions = twitter.get_mentions(since_id=since_id)
 
     id = since_id
     for mention in mentions:
-        if mention["notification_id"] > id:
-            id = mention["notification_id"]
-
-        mention_text = mention["text"].lower()
-        orig_mention_text = mention_text
-        mention_text = re.sub('p+', 'p', mention_text)
-        mention_text = re.sub('l+', 'l', mention_text)
-        mention_text = re.sub('e+', 'e', mention_text)
-        mention_text = re.sub('a+', 'a', mention_text)
-        mention_text = re.sub('s+', 's', mention_text)
-        respond_to_id = mention["status_id"]
-        respond_to_user = "@%s" % mention["user"]["screen_name"]
-        if check_translations(translations, mention_text) and mention["notification_id"] > since_id:
-            search_term = find_search_term(orig_mention_text, translations)
-            find_and_post_image(config, sources, flickr, twitter, search_term=search_term, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
-        if "status check" in mention_text and mention["notification_id"] > since_id:
-            status = validate()
-            twitter.post_text(status, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
-        if "fantastic, thank you" in mention_text and mention["notification_id"] > since_id:
-            status = "You're welcome :-)"
-            twitter.post_text(status, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        notification_id = mention["notification_id"]
+        if notification_id > id:
+            id = notification_id
+        if notification_id <= since_id:
+            continue
+
+        if journal is None:
+            respond_to_mention(config, sources, translations, flickr, twitter, mention, history=history, health=health, index=index, transcoder=transcoder, limiter=limiter, options=options)
+            continue
+
+        if not journal.should_process(notification_id):
+            continue
+        journal.record(notification_id, MentionJournal.SEEN)
+        try:
+            replied = respond_to_mention(config, sources, translations, flickr, twitter, mention, history=history, health=health, index=index, transcoder=transcoder, limiter=limiter, options=options)
+        except Exception:
+            logger.exception("Failed to respond to mention %s", notification_id)
+            journal.record(notification_id, MentionJournal.FAILED)
+            continue
+        journal.record(notification_id, MentionJournal.REPLIED if replied else MentionJournal.IGNORED)
     return id
 
 
-def load_sources(source_file, flickr):
+def parse_yaml(content):
+    """
+    Parses YAML content, using the libyaml-backed loader when PyYAML was built with it
+    :param content: YAML text
+    :return: The parsed document
+    """
+    import yaml
+
+    return yaml.load(content, Loader=getattr(yaml, "CLoader", yaml.Loader))
+
+
+def build_source_entries(content):
+    """
+    Parses and validates a sources YAML file into normalized source entries. Disabled sources are dropped,
+    ids and licenses are converted to strings and empty album and license lists are removed.
+    :param content: The sources YAML text
+    :return: A list of source entries
+    """
+    sources_raw = parse_yaml(content)
+    if sources_raw is None or sources_raw.get("sources") is None:
+        raise Exception("Sources file does not contain a 'sources' list")
+
+    entries = []
+    for source_raw in sources_raw["sources"]:
+        if "disabled" in source_raw and source_raw["disabled"] is True:
+            continue
+        if "flickr_id" not in source_raw and "group_id" not in source_raw:
+            raise Exception("Source is missing a flickr_id or group_id: %s"%source_raw)
+        if "flickr_id" in source_raw and "group_id" in source_raw:
+            raise Exception("Source has both a flickr_id and a group_id: %s"%source_raw)
+
+        entry = dict(source_raw)
+        if "group_id" in entry:
+            entry["group_id"] = str(entry["group_id"])
+            if "albums" in entry:
+                raise Exception("Group pool sources cannot have albums: %s"%source_raw)
+        else:
+            entry["flickr_id"] = str(entry["flickr_id"])
+        if entry.get("licenses") is None or len(entry["licenses"]) == 0:
+            entry.pop("licenses", None)
+        else:
+            entry["licenses"] = [str(license) for license in entry["licenses"]]
+        if entry.get("albums") is None or len(entry["albums"]) == 0:
+            entry.pop("albums", None)
+        else:
+            entry["albums"] = [str(album) for album in entry["albums"]]
+        entries.append(entry)
+    return entries
+
+
+def get_source_entry_id(source_entry):
+    """
+    :return: The Flickr user or group id of a source entry
+    """
+    return source_entry["group_id"] if "group_id" in source_entry else source_entry["flickr_id"]
+
+
+def load_sources(source_file, flickr, health=None, loaded=None):
     """
     Loads a sources YAML file
     :param source_file: Path leading to a sources YAML file
     :param flickr: An initialized Flickr instance
+    :param health: A source health tracker, or None if the circuit breaker is disabled. With a tracker, sources
+                   with an open circuit are left out without contacting Flickr and sources that fail to load
+                   are recorded and left out instead of failing the run.
+    :param loaded: A dict of sources already loaded from other sources files, shared between the bots hosted
+                   by one process so each distinct source is only looked up once. Updated with new sources.
     :return: A list of sources
     """
     sources = []
-    with open(source_file) as f:
-        d = f.read()
-        sources_raw = yaml.load(d, Loader=Loader)
-        for source_raw in sources_raw["sources"]:
-            if "disabled" in source_raw and source_raw["disabled"] is True:
-                continue
-            sources.append(Source(source_raw, flickr))
+    for source_entry in Snapshot.load(source_file, "sources", build_source_entries):
+        key = json.dumps(source_entry, sort_keys=True)
+        if loaded is not None and key in loaded:
+            sources.append(loaded[key])
+            continue
+
+        flickr_id = get_source_entry_id(source_entry)
+        if health is not None and not health.is_available(flickr_id):
+            Metrics.increment("sources_skipped_total")
+            continue
+        try:
+            if "group_id" in source_entry:
+                source = GroupSource(source_entry, flickr)
+            else:
+                source = Source(source_entry, flickr)
+        except RateLimitExceededException:
+            raise
+        except Exception as ex:
+            if health is None:
+                raise
+            health.record_failure(flickr_id, ex)
+            continue
+        sources.append(source)
+        if loaded is not None:
+            loaded[key] = source
 
     return sources
 
 
+def build_matchers(translations):
+    """
+    Precomputes the lowercased words and compiled patterns used to match mentions against translations
+    :param translations: A translations dict
+    :return: The matchers
+    """
+    for base_word in ("please", "of"):
+        if base_word not in translations["translations"]:
+            raise Exception("Baseword '%s' does not exist in the translation struct"%base_word)
+
+    return {
+        "lower": dict((base_word, [t.lower() for t in words]) for base_word, words in translations["translations"].items()),
+        "of": [re.compile(r"(?<= %s )[ \w]+"%translation) for translation in translations["translations"]["of"]],
+        "please_strip": [re.compile(r" %s"%translation.lower()) for translation in translations["translations"]["please"]]
+    }
+
+
+def get_matchers(translations):
+    if "matchers" not in translations:
+        translations["matchers"] = build_matchers(translations)
+    return translations["matchers"]
+
+
+def build_translations(content):
+    """
+    Parses and validates a translations YAML file, including its precomputed matchers
+    :param content: The translations YAML text
+    :return: The translations
+    """
+    translations = parse_yaml(content)
+    translations["matchers"] = build_matchers(translations)
+    return translations
+
+
 def load_translations(translations_file):
     """
     Loads a translations YAML file
     :param translations_file: Path leading to a translations YAML file
     :return: The translations
     """
-    with open(translations_file) as f:
-        d = f.read()
-        translations = yaml.load(d, Loader=Loader)
-    return translations
+    return Snapshot.load(translations_file, "translations", build_translations)
+
+
+# Destination clients by destination and credentials, kept for the life of the process so that bots and status
+# checks using the same account share its pooled connections
+social_clients = {}
+social_clients_lock = threading.Lock()
+
+
+def create_social(config, destination):
+    """
+    Returns the client for a destination social media, creating it on first use. Client modules are imported
+    here so that a run only pays the import cost of the destination it uses.
+    :param config: A configuration instance
+    :param destination: Destination social media (twitter, mastodon)
+    :return: A social media client
+    """
+    destination = destination.lower()
+    if destination not in ("twitter", "mastodon"):
+        raise Exception("Unsupported social media: %s"%destination)
+
+    settings = tuple(sorted(config.items(destination, raw=True))) if config.has_section(destination) else ()
+    with social_clients_lock:
+        social = social_clients.get((destination, settings))
+        if social is None:
+            if destination == "twitter":
+                from twitter import Twitter
+                social = Twitter(config)
+            else:
+                from mstdn import MastodonClient
+                social = MastodonClient(config)
+            social_clients[(destination, settings)] = social
+    return social
+
+
+def close_social_clients():
+    """
+    Closes the connections of every destination client created by this process
+    """
+    with social_clients_lock:
+        for social in social_clients.values():
+            social.close()
+        social_clients.clear()
 
 
-def get_random_source(sources):
+def get_random_source(sources, health=None, exclude=None):
     """
     Returns a random source from a list of sources
     :param sources: A list of sources
+    :param health: A source health tracker. Sources whose circuit opened during this run are not picked.
+    :param exclude: Sources not to be picked
     :return: A random source
     """
     if sources is None or len(sources) == 0:
         raise Exception("No sources found")
 
+    if health is not None or exclude:
+        sources = [source for source in sources
+                   if (not exclude or source not in exclude)
+                   and (health is None or health.state(source.get_flickr_id()) != SourceHealth.OPEN)]
+        if len(sources) == 0:
+            raise NoSourcesFoundException("No usable sources left")
+
     return sources[Util.randint(0, len(sources) - 1)]
 
 
-def validate():
+def run_probes(probes, timeout):
     """
-    Performs a basic high-level validation of services
-    :return: A string containing the validation results
+    Runs status probes concurrently, each on its own daemon thread so a hung service cannot hold up the
+    reply or the exit of the process
+    :param probes: A list of (name, function) pairs. Each function returns a list of condition strings.
+    :param timeout: Seconds to wait for all probes to finish
+    :return: The condition strings in probe order. Probes that raise report FAIL, probes that are still running
+             at the deadline report TIMEOUT.
     """
+    results = {}
+
+    def run(name, probe):
+        with Metrics.timer("status_probe", probe=name):
+            try:
+                results[name] = probe()
+            except:
+                results[name] = ["%s: FAIL" % name]
+
+    threads = []
+    for name, probe in probes:
+        thread = threading.Thread(target=run, args=(name, probe), name="probe-%s" % name, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
     conditions = []
+    for name, probe in probes:
+        conditions.extend(results.get(name, ["%s: TIMEOUT" % name]))
+    return conditions
 
-    try:
-        config = ConfigParser.RawConfigParser()
-        config.read(args.config)
-        conditions.append("Configuration: OK")
-    except:
-        conditions.append("Configuration: FAIL")
 
+def check_flickr(config):
+    flickr = Flickr(config)
     try:
-        flickr = Flickr(config)
-        conditions.append("Flickr: OK")
+        conditions = ["Flickr: OK", "Flickr Test: OK" if flickr.verify_credentials() else "Flickr Test: FAIL"]
+        if len(flickr.keys) > 1:
+            # Tries the remaining keys so rejected ones show up as out of rotation
+            for i in range(1, len(flickr.keys)):
+                flickr.verify_credentials()
+            usage = flickr.keys.usage()
+            conditions.append("Flickr Keys: %d of %d in rotation" % (len([key for key in usage if key["available"]]), len(usage)))
+    finally:
+        flickr.close()
+    return conditions
 
-        if flickr.verify_credentials():
-            conditions.append("Flickr Test: OK")
-        else:
-            conditions.append("Flickr Test: FAIL")
-    except:
-        conditions.append("Flickr: FAIL")
 
-    
+def check_translations_file(translations_file):
+    load_translations(translations_file)
+    return ["Translations: OK"]
 
-    try:
-        translations = load_translations(args.translations)
-        conditions.append("Translations: OK")
-    except:
-        conditions.append("Translations: FAIL")
 
+def check_sources_file(config, source_file):
+    """
+    Checks the sources file parses and reports how many sources the circuit breaker has taken out of rotation.
+    Unlike load_sources, this makes no Flickr calls.
+    """
+    entries = Snapshot.load(source_file, "sources", build_source_entries)
+    if len(entries) == 0:
+        return ["Sources: FAIL"]
+    health = SourceHealth.from_config(config)
+    if health is None:
+        return ["Sources: OK"]
     try:
-        sources = load_sources(args.sources, flickr)
-        conditions.append("Sources: OK")
-    except:
-        conditions.append("Sources: FAIL")
+        unavailable = len([e for e in entries if health.state(get_source_entry_id(e)) != SourceHealth.CLOSED])
+    finally:
+        health.close()
+    return ["Sources: OK (%d of %d available)" % (len(entries) - unavailable, len(entries))]
 
-    try:
-        twitter = Twitter(config)
-        conditions.append("Twitter: OK")
 
-        if twitter.verify_credentials():
-            conditions.append("Twitter Test: OK")
-        else:
-            conditions.append("Twitter Test: FAIL")
-    except:
-        conditions.append("Twitter: FAIL")
+def check_social(config, destination):
+    label = destination.capitalize()
+    social = create_social(config, destination)
+    return ["%s: OK" % label, "%s Test: %s" % (label, "OK" if social.verify_credentials() else "FAIL")]
 
 
+def validate(config=None, options=None):
+    """
+    Performs a basic high-level validation of services. The probes run concurrently with a timeout and the
+    result is cached for a short time so repeated status checks are answered without calling every service again.
+    :param config: The configuration to check, or None to read the command line's configuration file
+    :param options: Options naming the sources and translations files to check, and for a hosted bot its name,
+                    or None for the command line's
+    :return: A string containing the validation results
+    """
+    if config is None:
+        try:
+            config = ConfigParser()
+            if len(config.read(args.config)) == 0:
+                return "Configuration: FAIL"
+        except:
+            return "Configuration: FAIL"
+    if options is None:
+        options = args
+
+    # A hosted bot caches its own status, as it checks its own files and credentials
+    bot_name = getattr(options, "name", None)
+    cache_path = config.get("status", "status.cache_path", fallback="status_check.json" if bot_name is None else "status_check_%s.json" % bot_name)
+    cache_ttl = config.getfloat("status", "status.cache_ttl", fallback=300)
+    if cache_ttl > 0 and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if time.time() - cached["checked_at"] < cache_ttl:
+                Metrics.increment("status_cache_hits_total")
+                return cached["status"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    probes = [
+        ("Flickr", lambda: check_flickr(config)),
+        ("Translations", lambda: check_translations_file(options.translations)),
+        ("Sources", lambda: check_sources_file(config, options.sources))
+    ]
+    for destination in ("twitter", "mastodon"):
+        if config.has_section(destination):
+            probes.append((destination.capitalize(), lambda destination=destination: check_social(config, destination)))
+
+    conditions = ["Configuration: OK"]
+    conditions.extend(run_probes(probes, config.getfloat("status", "status.timeout", fallback=10)))
+    status = "\n".join(conditions)
+
+    if cache_ttl > 0:
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"checked_at": time.time(), "status": status}, f)
+            os.replace(tmp_path, cache_path)
+        except (IOError, OSError):
+            logger.warning("Unable to write status check cache %s", cache_path)
+    return status
+
+
+def get_bot_config(config, name):
+    """
+    Builds the configuration of a hosted bot: the shared configuration overlaid with the bot's [bot.<name>]
+    section. Keys are routed to sections by their prefix, so mastodon.access_token in [bot.cosmos] replaces the
+    one in [mastodon] for that bot only.
+    :param config: The shared configuration
+    :param name: The bot name
+    :return: A configuration instance for the bot
+    """
+    section = "bot.%s" % name
+    if not config.has_section(section):
+        raise Exception("No configuration section [%s] for bot '%s'" % (section, name))
+
+    bot_config = ConfigParser(interpolation=None)
+    for shared_section in config.sections():
+        if shared_section.startswith("bot."):
+            continue
+        bot_config.add_section(shared_section)
+        for key, value in config.items(shared_section, raw=True):
+            bot_config.set(shared_section, key, value)
+
+    for key, value in config.items(section, raw=True):
+        key_section = key.split(".", 1)[0]
+        if not bot_config.has_section(key_section):
+            bot_config.add_section(key_section)
+        bot_config.set(key_section, key, value)
+    return bot_config
+
+
+def get_bot_names(config, bots):
+    """
+    :param bots: Comma separated bot names, or 'all' for every [bot.<name>] section
+    :return: A list of bot names
+    """
+    if bots == "all":
+        return [section[len("bot."):] for section in config.sections() if section.startswith("bot.")]
+    return [name.strip() for name in bots.split(",") if len(name.strip()) > 0]
 
-    return "\n".join(conditions)
+
+def get_bot_options(bot_config, name, args):
+    """
+    Builds the per-bot equivalent of the command line options from a bot's configuration
+    """
+    since_id_path = bot_config.get("bot", "bot.sinceid_path", fallback="last_mention_id_%s.txt" % name)
+    since_id = 0
+    if os.path.exists(since_id_path):
+        with open(since_id_path) as f:
+            since_id = int(f.read().strip() or 0)
+    return argparse.Namespace(name=name,
+                              sources=bot_config.get("bot", "bot.sources"),
+                              translations=bot_config.get("bot", "bot.translations", fallback=args.translations),
+                              destination=bot_config.get("bot", "bot.destination", fallback="mastodon"),
+                              sinceid=since_id,
+                              writeidto=since_id_path,
+                              respond=args.respond,
+                              post=args.post,
+                              update_index=args.update_index)
+
+
+def run_bot(config, flickr, options, state_name, health=None, index=None, loaded=None, transcoder=None):
+    """
+    Runs the requested steps for one bot
+    :param config: The bot's configuration
+    :param flickr: The Flickr client, shared by every bot in the process
+    :param options: Command line style options (sources, translations, destination, sinceid, writeidto,
+                    respond, post, update_index)
+    :param state_name: Name under which the bot's history, journal and outbox entries are kept
+    :param health: A source health tracker, or None if the circuit breaker is disabled
+    :param index: A search index, or None to search Flickr directly
+    :param loaded: Sources already loaded by other bots, see load_sources
+    :param transcoder: An image transcoder, or None to post images as downloaded
+    """
+    social = create_social(config, options.destination)
+
+    outbox = Outbox.from_config(config)
+    if outbox is not None:
+        # Posts go through the outbox, starting with whatever earlier runs failed to publish
+        social = QueuedPublisher(social, outbox, state_name)
+        with Trace.span("outbox_drain"):
+            social.drain()
+
+    with Trace.span("load_sources"):
+        sources = load_sources(options.sources, flickr, health=health, loaded=loaded)
+    with Trace.span("load_translations"):
+        translations = load_translations(options.translations)
+    history = PostedHistory.from_config(config, state_name)
+
+    if options.update_index is True and index is not None:
+        flickr.priority = RateLimiter.PRIORITY_SCHEDULED
+        with Trace.span("update_index"):
+            index.update(flickr, sources)
+
+    if options.respond is True:
+        # Mention replies draw from the Flickr rate limit at a lower priority than scheduled posts
+        flickr.priority = RateLimiter.PRIORITY_MENTION
+        journal = MentionJournal.from_config(config, state_name)
+        limiter = MentionLimiter.from_config(config, state_name)
+        last_id = respond_to_mentions(config, sources, translations, flickr, social, options.sinceid, history=history, journal=journal, health=health, index=index, transcoder=transcoder, limiter=limiter, options=options)
+        if last_id is not None and last_id > 0:
+            print(last_id)
+            if options.writeidto is not None:
+                with open(options.writeidto, "w") as f:
+                    f.write(str(last_id))
+
+    if options.post is True:
+        flickr.priority = RateLimiter.PRIORITY_SCHEDULED
+        find_and_post_image(config, sources, flickr, social, history=history, health=health, transcoder=transcoder)
 
 
 if __name__ == "__main__":
@@ -296,35 +835,88 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--test", help="Run a status check", action="store_true")
     parser.add_argument("-i", "--translations", help="Specify an alternate translations yaml file", required=False, type=str, default="translations.yaml")
     parser.add_argument("-d", "--destination", help="Destination social media (twitter, mastodon)", required=False, type=str, default="mastodon")
+    parser.add_argument("-x", "--update-index", help="Update the local search index used to answer search mentions", action="store_true")
+    parser.add_argument("-b", "--bots", help="Run the bots configured in [bot.<name>] sections, comma separated or 'all'", required=False, type=str)
+    parser.add_argument("--trace", help="Write a Chrome trace of the run's stages to a file. {pid} and {time} are substituted", required=False, type=str)
+    parser.add_argument("--record", help="Record the run's API traffic to a cassette file", required=False, type=str)
+    parser.add_argument("--replay", help="Replay a cassette file recorded with --record instead of calling the APIs", required=False, type=str)
+    parser.add_argument("--replay-scale", help="Multiplier of the recorded response times when replaying, 0 to answer immediately", required=False, type=float, default=1.0)
+    parser.add_argument("-l", "--log", help="Write logs to a rotating file, overriding logging.path", required=False, type=str)
+    parser.add_argument("--profile", help="Write cProfile statistics of the run to a file. {pid} and {time} are substituted", required=False, type=str)
     args = parser.parse_args()
 
+    # Installed before any client is created, so that every session records or replays through it
+    if args.record is not None or args.replay is not None:
+        from cassette import Cassette
+        Util.use_cassette(Cassette.record(args.record) if args.record is not None else Cassette.replay(args.replay, scale=args.replay_scale))
+
     if args.test:
         print(validate())
+        close_social_clients()
+        if Util.cassette is not None:
+            Util.cassette.close()
         sys.exit(0)
 
-    config = ConfigParser()
-    config.read(args.config)
+    if args.trace is not None:
+        Trace.enable()
 
-    flickr = Flickr(config)
-    if args.destination.lower() == "twitter":
-        social = Twitter(config)
-    elif args.destination.lower() == "mastodon":
-        social = MastodonClient(config)
-    else:
-        raise Exception("Unsupported social media: %s"%args.destination)
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    sources = load_sources(args.sources, flickr)
-    translations = load_translations(args.translations)
-    
-    if args.respond is True:
-        last_id = respond_to_mentions(config, sources, translations, flickr, social, args.sinceid)
-        if last_id is not None and last_id > 0:
-            print(last_id)
-            if args.writeidto is not None:
-                with open(args.writeidto, "w") as f:
-                    f.write(str(last_id))
-
-    if args.post is True:
-        find_and_post_image(config, sources, flickr, social)
-    
+    config = ConfigParser()
+    config.read(args.config)
+    if args.log is not None:
+        if not config.has_section("logging"):
+            config.add_section("logging")
+        config.set("logging", "logging.path", args.log)
+    Log.configure(config)
+
+    failed_bots = []
+    flickr = None
+    try:
+        # Shared by every bot: the Flickr client with its cache, rate limiter and image store, source health,
+        # the search index and the sources already looked up
+        flickr = Flickr(config)
+        health = SourceHealth.from_config(config)
+        index = SearchIndex.from_config(config)
+        transcoder = Transcoder.from_config(config)
 
+        if args.bots is None:
+            run_bot(config, flickr, args, args.destination.lower(), health=health, index=index, transcoder=transcoder)
+        else:
+            loaded = {}
+            for name in get_bot_names(config, args.bots):
+                bot_config = get_bot_config(config, name)
+                options = get_bot_options(bot_config, name, args)
+                logger.info("Running bot %s", name)
+                try:
+                    with Trace.span("bot", bot=name):
+                        run_bot(bot_config, flickr, options, "%s.%s" % (name, options.destination.lower()), health=health, index=index, loaded=loaded, transcoder=transcoder)
+                except Exception:
+                    logger.exception("Bot %s failed", name)
+                    failed_bots.append(name)
+    except Exception:
+        # Recorded in the log file as well as on standard error
+        logger.exception("Run failed")
+        raise
+    finally:
+        close_social_clients()
+        if flickr is not None:
+            flickr.close()
+        if Util.cassette is not None:
+            Util.cassette.close()
+        Metrics.write_from_config(config)
+
+        run_time = time.strftime("%Y%m%dT%H%M%S")
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile.format(pid=os.getpid(), time=run_time))
+        if args.trace is not None:
+            Trace.write(args.trace.format(pid=os.getpid(), time=run_time))
+        Log.shutdown()
+
+    if len(failed_bots) > 0:
+        sys.exit(1)
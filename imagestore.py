@@ -0,0 +1,106 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import hashlib
+
+from util import Util
+from metrics import Metrics
+
+
+class ImageStore:
+    """
+    Directory of downloaded images keyed by URL, shared by every bot and process using it, so an image picked
+    more than once is only downloaded once. The least recently used images are removed when the store grows
+    past max_size_bytes.
+    """
+
+    # Eviction scans the directory, so only every few stores
+    EVICT_EVERY = 16
+
+    def __init__(self, directory, max_size_bytes):
+        self.__directory = directory
+        self.__max_size_bytes = max_size_bytes
+        self.__stores = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds an image store from the [images] section of the configuration
+        :param config: A configuration instance
+        :return: An image store, or None if the store is disabled
+        """
+        max_size_mb = config.getfloat("images", "images.max_size_mb", fallback=128)
+        if max_size_mb <= 0:
+            return None
+        return ImageStore(config.get("images", "images.store_path", fallback="image_store"), int(max_size_mb * 1024 * 1024))
+
+    def path_for(self, url):
+        return os.path.join(self.__directory, "%s.jpg" % hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def fetch(self, url, path, timeout=None, hedger=None):
+        """
+        Copies an image to path, downloading it into the store first if it is not there yet
+        :param url: The image URL
+        :param path: Where the copy is written
+        :param timeout: Download timeout, see Util.fetch_image_to_path
+        :param hedger: Hedger for the download, or None
+        :return: path
+        """
+        stored_path = self.path_for(url)
+        if os.path.exists(stored_path):
+            Metrics.increment("image_store_hits_total")
+            os.utime(stored_path)
+        else:
+            tmp_path = "%s.%d.tmp" % (stored_path, os.getpid())
+            Util.fetch_image_to_path(url, tmp_path, timeout=timeout, hedger=hedger)
+            os.replace(tmp_path, stored_path)
+            self.__stores += 1
+            if self.__stores % ImageStore.EVICT_EVERY == 0:
+                self.evict()
+        shutil.copyfile(stored_path, path)
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used images until the store is within its size limit
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.__directory):
+            if not name.endswith(".jpg"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.__directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        for mtime, size, name in sorted(entries):
+            if total <= self.__max_size_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.__directory, name))
+            except OSError:
+                pass
+            total -= size
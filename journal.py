@@ -0,0 +1,148 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import time
+from log import get_logger
+
+logger = get_logger("journal")
+
+
+class MentionJournal:
+    """
+    Append-only, fsynced journal of the state of each mention. A mention is journaled as seen before any
+    work is done for it and as replied, ignored or failed once that work is finished, so a run that
+    crashes part way through can be restarted without replying to the same mention twice.
+    """
+
+    SEEN = "seen"
+    REPLIED = "replied"
+    IGNORED = "ignored"
+    FAILED = "failed"
+
+    FINISHED_STATES = (REPLIED, IGNORED, FAILED)
+
+    def __init__(self, path, max_attempts=2, max_entries=5000):
+        self.__path = path
+        self.__max_attempts = max_attempts
+        self.__max_entries = max_entries
+        self.__states = {}
+        self.__attempts = {}
+        self.__load()
+        self.__file = open(path, "a")
+        if self.__file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # Terminate a torn final write so the next entry starts on its own line
+                    self.__file.write("\n")
+
+    @staticmethod
+    def from_config(config, destination):
+        """
+        Builds a mention journal from the [journal] section of the configuration
+        :param config: A configuration instance
+        :param destination: The destination social media name
+        :return: A mention journal, or None if journaling is disabled
+        """
+        if not config.getboolean("journal", "journal.enabled", fallback=True):
+            return None
+        path = config.get("journal", "journal.path", fallback="mentions_{destination}.journal")
+        return MentionJournal(path.format(destination=destination.lower()),
+                              max_attempts=config.getint("journal", "journal.max_attempts", fallback=2))
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return
+
+        lines = 0
+        with open(self.__path) as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final write from a crash
+                    continue
+                self.__apply(entry)
+
+        if lines > self.__max_entries * 2:
+            self.__compact()
+
+    def __apply(self, entry):
+        mention_id = entry["id"]
+        self.__states[mention_id] = entry["state"]
+        if entry["state"] == MentionJournal.SEEN:
+            self.__attempts[mention_id] = self.__attempts.get(mention_id, 0) + 1
+
+    def __compact(self):
+        """
+        Rewrites the journal keeping unfinished mentions and the most recent finished ones
+        """
+        finished = sorted(i for i, state in self.__states.items() if state in MentionJournal.FINISHED_STATES)
+        dropped = set(finished[:max(0, len(finished) - self.__max_entries)])
+        for mention_id in dropped:
+            del self.__states[mention_id]
+            self.__attempts.pop(mention_id, None)
+
+        tmp_path = "%s.%d.tmp" % (self.__path, os.getpid())
+        with open(tmp_path, "w") as f:
+            for mention_id, state in sorted(self.__states.items()):
+                for i in range(0, self.__attempts.get(mention_id, 0)):
+                    f.write(json.dumps({"id": mention_id, "state": MentionJournal.SEEN}) + "\n")
+                if state != MentionJournal.SEEN:
+                    f.write(json.dumps({"id": mention_id, "state": state}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.__path)
+
+    def record(self, mention_id, state):
+        """
+        Durably appends a state change for a mention
+        :param mention_id: The mention's notification id
+        :param state: SEEN, REPLIED, IGNORED or FAILED
+        """
+        entry = {"id": mention_id, "state": state, "time": round(time.time(), 3)}
+        self.__file.write(json.dumps(entry) + "\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__apply(entry)
+
+    def state(self, mention_id):
+        return self.__states.get(mention_id)
+
+    def should_process(self, mention_id):
+        """
+        Checks whether a mention still needs work. Finished mentions are skipped, as are mentions whose
+        processing was interrupted max_attempts times, which are marked failed.
+        :param mention_id: The mention's notification id
+        :return: True if the mention should be processed
+        """
+        state = self.__states.get(mention_id)
+        if state in MentionJournal.FINISHED_STATES:
+            return False
+        if state == MentionJournal.SEEN and self.__attempts.get(mention_id, 0) >= self.__max_attempts:
+            logger.warning("Mention %s was interrupted %d times, giving up on it", mention_id, self.__attempts[mention_id])
+            self.record(mention_id, MentionJournal.FAILED)
+            return False
+        return True
+
+    def close(self):
+        self.__file.close()
@@ -0,0 +1,118 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import json
+import logging
+
+LOGGER_PREFIX = "hourlyplanet"
+
+# Attributes every log record has, anything else on a record was passed as extra fields
+RECORD_ATTRIBUTES = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()) | frozenset(["message", "asctime"])
+
+
+def get_logger(name):
+    """
+    :param name: The module name
+    :return: The module's logger
+    """
+    return logging.getLogger("%s.%s" % (LOGGER_PREFIX, name))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line, with any extra fields passed to the logging call
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name[len(LOGGER_PREFIX) + 1:],
+            "pid": record.process,
+            "message": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class Log:
+    """
+    Sets up the program's loggers from the [logging] section of the configuration. Records are passed through
+    a queue to a background thread which formats and writes them, so file I/O stays off the request path, and
+    a log file is rotated once it reaches its size limit. Calls below a logger's level cost almost nothing.
+    """
+
+    __listener = None
+
+    @staticmethod
+    def configure(config):
+        """
+        :param config: A configuration instance
+        """
+        import queue
+        import logging.handlers
+
+        Log.shutdown()
+
+        path = config.get("logging", "logging.path", fallback="")
+        if len(path) > 0:
+            handler = logging.handlers.RotatingFileHandler(path,
+                                                           maxBytes=int(config.getfloat("logging", "logging.max_size_mb", fallback=10) * 1024 * 1024),
+                                                           backupCount=config.getint("logging", "logging.backup_count", fallback=3))
+        else:
+            handler = logging.StreamHandler(sys.stdout)
+
+        if config.get("logging", "logging.format", fallback="text") == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+        records = queue.Queue(-1)
+        root = logging.getLogger(LOGGER_PREFIX)
+        root.handlers = [logging.handlers.QueueHandler(records)]
+        root.propagate = False
+        root.setLevel(config.get("logging", "logging.level", fallback="INFO").upper())
+
+        # Per-module levels, e.g. source:DEBUG,flickr:WARNING
+        for module_level in config.get("logging", "logging.levels", fallback="").split(","):
+            if ":" in module_level:
+                name, level = module_level.split(":", 1)
+                get_logger(name.strip()).setLevel(level.strip().upper())
+
+        Log.__listener = logging.handlers.QueueListener(records, handler)
+        Log.__listener.start()
+
+    @staticmethod
+    def shutdown():
+        """
+        Writes out the records still queued and closes the log file
+        """
+        if Log.__listener is not None:
+            root = logging.getLogger(LOGGER_PREFIX)
+            root.handlers = []
+            root.propagate = True
+            Log.__listener.stop()
+            for handler in Log.__listener.handlers:
+                handler.close()
+            Log.__listener = None
@@ -0,0 +1,131 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import sqlite3
+
+from ratelimit import RateLimiter, RateLimitExceededException
+from metrics import Metrics
+from log import get_logger
+
+logger = get_logger("mentionlimit")
+
+
+class MentionLimiter:
+    """
+    Decides whether a mention asking for an image gets the image pipeline. Each account draws from its own
+    token bucket and the same request from an account is only answered once within the duplicate window, so a
+    single account cannot use up the Flickr quota. A request counts towards the duplicate window once its image
+    reply has been posted, see record. Image replies as a whole draw from a shared bucket, and
+    mentions over it are shed with a short text reply instead. Buckets are kept in a SQLite file so one-shot
+    runs share them; a path of :memory: keeps them in the process.
+    """
+
+    ADMIT = "admit"
+    DUPLICATE = "duplicate"
+    USER_LIMITED = "user_limited"
+    SHED = "shed"
+
+    def __init__(self, path, name, user_per_hour=6, user_burst=3, per_hour=60, burst=20, duplicate_window_minutes=60):
+        self.__name = name
+        self.__duplicate_window = float(duplicate_window_minutes) * 60.0
+        self.__users = RateLimiter(path, "mentions.%s.user" % name, user_per_hour, user_burst, max_wait=0, mention_max_wait=0) if user_per_hour > 0 else None
+        self.__all = RateLimiter(path, "mentions.%s" % name, per_hour, burst, max_wait=0, mention_max_wait=0) if per_hour > 0 else None
+        self.__conn = sqlite3.connect(path, timeout=30)
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS mention_requests (
+                                    name TEXT NOT NULL,
+                                    user TEXT NOT NULL,
+                                    request TEXT NOT NULL,
+                                    requested_at REAL NOT NULL,
+                                    PRIMARY KEY (name, user, request))""")
+        self.__conn.execute("DELETE FROM mention_requests WHERE requested_at < ?", (time.time() - self.__duplicate_window,))
+        self.__conn.commit()
+
+    @staticmethod
+    def from_config(config, name):
+        """
+        Builds a mention limiter from the [mentions] section of the configuration
+        :param config: A configuration instance
+        :param name: Name under which the bot's buckets are kept
+        :return: A mention limiter, or None if mention limiting is disabled
+        """
+        if not config.getboolean("mentions", "mentions.enabled", fallback=True):
+            return None
+        return MentionLimiter(config.get("mentions", "mentions.path", fallback="mention_limits.db"),
+                              name,
+                              user_per_hour=config.getfloat("mentions", "mentions.user_per_hour", fallback=6),
+                              user_burst=config.getfloat("mentions", "mentions.user_burst", fallback=3),
+                              per_hour=config.getfloat("mentions", "mentions.per_hour", fallback=60),
+                              burst=config.getfloat("mentions", "mentions.burst", fallback=20),
+                              duplicate_window_minutes=config.getfloat("mentions", "mentions.duplicate_window_minutes", fallback=60))
+
+    def __is_duplicate(self, user, request, now):
+        row = self.__conn.execute("SELECT requested_at FROM mention_requests WHERE name = ? AND user = ? AND request = ?",
+                                  (self.__name, user, request)).fetchone()
+        return row is not None and now - row[0] < self.__duplicate_window
+
+    def check(self, user, search_term=None):
+        """
+        :param user: The account asking
+        :param search_term: What it asked for, or None for a random image
+        :return: ADMIT to reply with an image, SHED to reply with a short text, DUPLICATE or USER_LIMITED to not reply
+        """
+        user = user.lower()
+        request = "" if search_term is None else search_term.lower()
+        now = time.time()
+
+        decision = MentionLimiter.ADMIT
+        if self.__is_duplicate(user, request, now):
+            decision = MentionLimiter.DUPLICATE
+        else:
+            try:
+                if self.__users is not None:
+                    self.__users.acquire(bucket=user)
+            except RateLimitExceededException:
+                decision = MentionLimiter.USER_LIMITED
+            else:
+                try:
+                    if self.__all is not None:
+                        self.__all.acquire()
+                except RateLimitExceededException:
+                    decision = MentionLimiter.SHED
+                    # A shed request did not get its image, so it does not count against the account
+                    if self.__users is not None:
+                        self.__users.release(bucket=user)
+
+        Metrics.increment("mention_decisions_total", decision=decision)
+        return decision
+
+    def record(self, user, search_term=None):
+        """
+        Records that an admitted request was answered with an image, so that repeats of it within the duplicate
+        window are not answered again. Shed, failed or interrupted requests are not recorded and can be retried.
+        :param user: The account that asked
+        :param search_term: What it asked for, or None for a random image
+        """
+        request = "" if search_term is None else search_term.lower()
+        self.__conn.execute("INSERT OR REPLACE INTO mention_requests (name, user, request, requested_at) VALUES (?, ?, ?, ?)",
+                            (self.__name, user.lower(), request, time.time()))
+        self.__conn.commit()
+
+    def close(self):
+        self.__conn.close()
+        for limiter in (self.__users, self.__all):
+            if limiter is not None:
+                limiter.close()
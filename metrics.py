@@ -0,0 +1,240 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import json
+import time
+import fcntl
+from bisect import bisect_left
+from contextlib import contextmanager
+from log import get_logger
+
+logger = get_logger("metrics")
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram in the Prometheus style. Bucket bounds are upper bounds in seconds.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Process-wide metrics registry. Recording is a dict lookup and a few additions so it is always on; the
+    collected values are only written out when a snapshot is requested. Snapshots are merged into the
+    previous snapshot on disk so counters accumulate across cron runs.
+    """
+
+    __histograms = {}
+    __counters = {}
+
+    @staticmethod
+    def __key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    @staticmethod
+    def observe(name, value, **labels):
+        """
+        Records a value, in seconds, into a histogram
+        :param name: Metric name
+        :param value: Observed value
+        :param labels: Metric labels
+        """
+        key = Metrics.__key(name, labels)
+        histogram = Metrics.__histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            Metrics.__histograms[key] = histogram
+        histogram.observe(value)
+
+    @staticmethod
+    def increment(name, value=1, **labels):
+        """
+        Adds to a counter
+        :param name: Metric name
+        :param value: Amount to add
+        :param labels: Metric labels
+        """
+        key = Metrics.__key(name, labels)
+        Metrics.__counters[key] = Metrics.__counters.get(key, 0) + value
+
+    @staticmethod
+    @contextmanager
+    def timer(name, **labels):
+        """
+        Times the enclosed block into a histogram. The block is counted in <name>_errors_total if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except:
+            Metrics.increment("%s_errors_total" % name, **labels)
+            raise
+        finally:
+            Metrics.observe("%s_seconds" % name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def snapshot():
+        """
+        Returns the current values as a JSON-serializable dict
+        """
+        histograms = []
+        for (name, labels), histogram in Metrics.__histograms.items():
+            histograms.append({
+                "name": name,
+                "labels": dict(labels),
+                "buckets": list(histogram.buckets),
+                "counts": list(histogram.counts),
+                "sum": histogram.sum,
+                "count": histogram.count
+            })
+        counters = []
+        for (name, labels), value in Metrics.__counters.items():
+            counters.append({
+                "name": name,
+                "labels": dict(labels),
+                "value": value
+            })
+        return {"histograms": histograms, "counters": counters}
+
+    @staticmethod
+    def merge(previous, current):
+        """
+        Adds the values of one snapshot to another
+        :param previous: A snapshot previously written to disk
+        :param current: The snapshot of this process
+        :return: The merged snapshot
+        """
+        def key_of(entry):
+            return (entry["name"], tuple(sorted(entry["labels"].items())))
+
+        histograms = dict((key_of(h), h) for h in previous.get("histograms", []))
+        for h in current["histograms"]:
+            existing = histograms.get(key_of(h))
+            if existing is None or existing["buckets"] != h["buckets"]:
+                histograms[key_of(h)] = h
+            else:
+                existing["counts"] = [a + b for a, b in zip(existing["counts"], h["counts"])]
+                existing["sum"] += h["sum"]
+                existing["count"] += h["count"]
+
+        counters = dict((key_of(c), c) for c in previous.get("counters", []))
+        for c in current["counters"]:
+            existing = counters.get(key_of(c))
+            if existing is None:
+                counters[key_of(c)] = c
+            else:
+                existing["value"] += c["value"]
+
+        return {"histograms": list(histograms.values()), "counters": list(counters.values())}
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        """
+        Formats a snapshot in the Prometheus text exposition format
+        """
+        def format_labels(labels, extra=None):
+            items = sorted(labels.items())
+            if extra is not None:
+                items.append(extra)
+            if len(items) == 0:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items)
+
+        lines = []
+        typed = set()
+        for h in sorted(snapshot["histograms"], key=lambda e: e["name"]):
+            name = "hourlyplanet_%s" % h["name"]
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(h["buckets"], h["counts"]):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (name, format_labels(h["labels"], ("le", repr(float(bound)))), cumulative))
+            lines.append("%s_bucket%s %d" % (name, format_labels(h["labels"], ("le", "+Inf")), h["count"]))
+            lines.append("%s_sum%s %f" % (name, format_labels(h["labels"]), h["sum"]))
+            lines.append("%s_count%s %d" % (name, format_labels(h["labels"]), h["count"]))
+        for c in sorted(snapshot["counters"], key=lambda e: e["name"]):
+            name = "hourlyplanet_%s" % c["name"]
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, format_labels(c["labels"]), c["value"]))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __write_atomic(path, text):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def write_snapshot(json_path, prometheus_path=None):
+        """
+        Merges this process's metrics into the JSON snapshot on disk and optionally rewrites a Prometheus
+        text file from it, for example in a node exporter textfile collector directory.
+        :param json_path: Path of the cumulative JSON snapshot
+        :param prometheus_path: Path of the Prometheus text file, or None
+        """
+        with open("%s.lock" % json_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            previous = {}
+            if os.path.exists(json_path):
+                try:
+                    with open(json_path) as f:
+                        previous = json.load(f)
+                except ValueError:
+                    logger.warning("Discarding unreadable metrics snapshot %s", json_path)
+            merged = Metrics.merge(previous, Metrics.snapshot())
+            Metrics.__write_atomic(json_path, json.dumps(merged))
+            if prometheus_path is not None:
+                Metrics.__write_atomic(prometheus_path, Metrics.to_prometheus(merged))
+
+        Metrics.reset()
+
+    @staticmethod
+    def write_from_config(config):
+        """
+        Writes a snapshot to the paths in the [metrics] section of the configuration, if configured
+        """
+        json_path = config.get("metrics", "metrics.json_path", fallback="")
+        prometheus_path = config.get("metrics", "metrics.prometheus_path", fallback="")
+        if len(json_path) == 0:
+            return
+        Metrics.write_snapshot(json_path, prometheus_path if len(prometheus_path) > 0 else None)
+
+    @staticmethod
+    def reset():
+        Metrics.__histograms.clear()
+        Metrics.__counters.clear()
@@ -17,44 +17,130 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import sys
 import os
-import requests
-from configparser import ConfigParser
-import math
-import traceback
-import json
-import argparse
-import re
-import yaml
+import time
 
 from mastodon import Mastodon
+from mastodon.errors import MastodonError, MastodonNetworkError, MastodonRatelimitError, MastodonServerError
 from util import Util
+from metrics import Metrics
+from tracing import Trace
+from outbox import PublishException
+from log import get_logger
+
+logger = get_logger("mstdn")
+
 
 class MastodonClient:
+
+    destination = "mastodon"
+
     def __init__(self, config):
+        self.__session = Util.make_session(pool_size=config.getint("mastodon", "mastodon.pool_size", fallback=4))
         self.mastodon = Mastodon(
                                 access_token=config.get("mastodon", "mastodon.access_token"),
-                                api_base_url=config.get("mastodon", "mastodon.baseurl"))
+                                api_base_url=config.get("mastodon", "mastodon.baseurl"),
+                                request_timeout=config.getfloat("mastodon", "mastodon.request_timeout", fallback=30),
+                                session=self.__session)
+        self.__media_poll_interval = config.getfloat("mastodon", "mastodon.media_poll_interval", fallback=0.5)
+        self.__media_timeout = config.getfloat("mastodon", "mastodon.media_timeout", fallback=60)
+
+    def __call(self, endpoint, *args, **kwargs):
+        """
+        Calls a Mastodon.py API method by name, recording its latency and failures
+        """
+        with Metrics.timer("social_request", destination="mastodon", endpoint=endpoint), Trace.span("mastodon_api", endpoint=endpoint):
+            return getattr(self.mastodon, endpoint)(*args, **kwargs)
 
     def get_social_id_from_source(self, source):
         return source.get_mastodon_id()
 
     def verify_credentials(self):
-        pass
+        """
+        Validates current API credentials
+        :return: True if the access token is accepted by the instance
+        """
+        try:
+            self.__call("account_verify_credentials")
+        except MastodonError:
+            return False
+        return True
 
-    def post_text(self, status, respond_to_user=None, respond_to_id=None, media_id=None):
-        if respond_to_id is None:
-            self.mastodon.status_post(status, media_ids=[media_id])
-        else:
+    def get_rate_limit_reset(self):
+        """
+        :return: The epoch time at which an exhausted rate limit resets, or None if requests can still be made
+        """
+        if self.mastodon.ratelimit_remaining == 0 and self.mastodon.ratelimit_reset > time.time():
+            return self.mastodon.ratelimit_reset
+        return None
+
+    def compose_text(self, status, respond_to_user=None):
+        if respond_to_user is not None:
             status = "Hi, %s\n\n%s"%(respond_to_user, status)
-            if media_id is not None:
-                self.mastodon.status_reply(status, 
-                                            in_reply_to_id=respond_to_id,
-                                            media_ids=[media_id])
-            else:
-                self.mastodon.status_post(status, 
-                                            in_reply_to_id=respond_to_id)
+        return status
+
+    def compose_image_post(self, title, source, shortened_image_link, respond_to_user=None, respond_to_id=None):
+        """
+        Builds the text of an image toot. Images are posted as new statuses rather than replies.
+        :return: The toot text and the ID of the status it responds to
+        """
+        username = source.get_flickr_username()
+        mastodon_id = source.get_mastodon_id()
+        
+        mastodon_id = "" if mastodon_id is None or len(mastodon_id) == 0 else "(%s)"%mastodon_id
+        
+        if respond_to_user is None:
+            text = "%s - From %s %s - %s"%(title, username, mastodon_id, shortened_image_link)
+        else:
+            text = "Hi, %s\n\n%s - From %s %s - %s" % (respond_to_user, title, username, mastodon_id, shortened_image_link)
+        return text, None
+
+    def __wait_for_media(self, media):
+        """
+        Polls an attachment the instance is still processing until it is ready, doubling the wait between polls
+        :param media: The attachment returned by the upload
+        :return: The processed attachment
+        :raises PublishException: If processing has not finished within the media timeout
+        """
+        deadline = time.time() + self.__media_timeout
+        interval = self.__media_poll_interval
+        with Trace.span("mastodon_media_processing", media_id=str(media["id"])):
+            while media.get("url") is None:
+                if time.time() + interval > deadline:
+                    raise PublishException("Media %s was not processed within %.0f seconds" % (media["id"], self.__media_timeout))
+                time.sleep(interval)
+                interval = min(interval * 2, 5.0)
+                media = self.__call("media", media["id"])
+        return media
+
+    def publish(self, text, image_path=None, alt_text=None, respond_to_id=None):
+        """
+        Posts composed text, uploading an image first if one is given
+        :raises PublishException: If the upload or the status post fails
+        """
+        try:
+            media_ids = None
+            if image_path is not None:
+                if alt_text is not None and len(alt_text) > 1500:
+                    alt_text = "%s..."%alt_text[:1497]
+
+                Metrics.increment("upload_bytes_total", os.path.getsize(image_path), destination="mastodon")
+                # The upload returns as soon as the file is received, the instance may still be processing it
+                with open(image_path, "rb") as image_file:
+                    media = self.__call("media_post", image_file, "image/jpeg", description=alt_text,
+                                        file_name=os.path.basename(image_path), synchronous=False)
+                media_ids = [self.__wait_for_media(media)["id"]]
+            self.__call("status_post", text, in_reply_to_id=respond_to_id, media_ids=media_ids)
+        except MastodonRatelimitError as ex:
+            Metrics.increment("social_request_errors_total", destination="mastodon", endpoint="status_post")
+            raise PublishException("Rate limited: %s" % ex, retry_after=max(0.0, self.mastodon.ratelimit_reset - time.time()))
+        except (MastodonNetworkError, MastodonServerError) as ex:
+            Metrics.increment("social_request_errors_total", destination="mastodon", endpoint="status_post")
+            raise PublishException(str(ex))
+        except MastodonError as ex:
+            # Rejected requests (bad credentials, validation failures) fail the same way on retry
+            Metrics.increment("social_request_errors_total", destination="mastodon", endpoint="status_post")
+            raise PublishException(str(ex), permanent=True)
         """
         Mastodon.status_post(status, 
                                 in_reply_to_id=None, 
@@ -86,37 +172,30 @@ class MastodonClient:
                                 untag=False)
         """
 
-    def post_image(self, title, source, shortened_image_link, image_path="image.jpg", respond_to_user=None, respond_to_id=None, alt_text=None):
-
-        username = source.get_flickr_username()
-        mastodon_id = source.get_mastodon_id()
-        
-        mastodon_id = "" if mastodon_id is None or len(mastodon_id) == 0 else "(%s)"%mastodon_id
-        
-        if respond_to_user is None:
-            text = "%s - From %s %s - %s"%(title, username, mastodon_id, shortened_image_link)
-        else:
-            text = "Hi, %s\n\n%s - From %s %s - %s" % (respond_to_user, title, username, mastodon_id, shortened_image_link)
-
-        if len(alt_text) > 1500:
-            alt_text = "%s..."%alt_text[:1497]
-
-        media = self.mastodon.media_post(image_path, "image/jpeg", description=alt_text)
-        # TODO: Error checking? Returned dict doesn't appear to have a status
-        self.post_text(text, respond_to_user=None, respond_to_id=None, media_id=media["id"])
+    def post_text(self, status, respond_to_user=None, respond_to_id=None):
+        try:
+            self.publish(self.compose_text(status, respond_to_user=respond_to_user), respond_to_id=respond_to_id)
+        except PublishException as ex:
+            logger.error("UPDATE STATUS FAILURE: %s", ex)
+            return False
+        return True
 
-
-
-
-        
+    def post_image(self, title, source, shortened_image_link, image_path="image.jpg", respond_to_user=None, respond_to_id=None, alt_text=None):
+        text, respond_to_id = self.compose_image_post(title, source, shortened_image_link, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        try:
+            self.publish(text, image_path=image_path, alt_text=alt_text, respond_to_id=respond_to_id)
+        except PublishException as ex:
+            logger.error("UPDATE STATUS FAILURE: %s", ex)
+            return False
+        return True
 
     def get_mentions(self, since_id=None, count=100):
-        mentions_raw = self.mastodon.notifications(types=["mention"], limit=count, since_id=since_id)
+        mentions_raw = self.__call("notifications", types=["mention"], limit=count, since_id=since_id)
         mentions = []
         for  mention in mentions_raw:
             mentions.append({
                 "status_id": mention["status"]["id"],
-                "notification_id": mention["id"],
+                "notification_id": int(mention["id"]),
                 "text": mention["status"]["content"],
                 "user": {
                     "screen_name":  mention["account"]["acct"]
@@ -124,4 +203,5 @@ class MastodonClient:
             })
         return mentions
 
-
+    def close(self):
+        self.__session.close()
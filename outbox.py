@@ -0,0 +1,270 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import glob
+import time
+import random
+import shutil
+import sqlite3
+from log import get_logger
+
+logger = get_logger("outbox")
+
+
+class PublishException(Exception):
+    """
+    Raised by a destination when a post could not be published
+    :param retry_after: Seconds the destination asked us to wait before trying again, if it said
+    :param permanent: True if retrying cannot succeed, e.g. the post was rejected as invalid
+    """
+
+    def __init__(self, message, retry_after=None, permanent=False):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+        self.permanent = permanent
+
+
+class Outbox:
+    """
+    Durable queue of composed posts waiting to be published. Entries hold the final post text and a reference
+    to the media file, so a post that fails is retried later with exponential backoff instead of being lost
+    along with the Flickr work that selected it. Entries are leased while being published and the number of
+    leases per destination is limited, across every process sharing the database.
+    """
+
+    PENDING = "pending"
+    PUBLISHING = "publishing"
+    DONE = "done"
+    DEAD = "dead"
+
+    def __init__(self, path, media_dir, max_attempts=8, base_backoff=30.0, max_backoff=3600.0, concurrency=1, lease_seconds=300.0):
+        self.__media_dir = media_dir
+        self.__max_attempts = max_attempts
+        self.__base_backoff = base_backoff
+        self.__max_backoff = max_backoff
+        self.__concurrency = concurrency
+        self.__lease_seconds = lease_seconds
+        if not os.path.exists(media_dir):
+            os.makedirs(media_dir)
+        self.__conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    destination TEXT NOT NULL,
+                                    text TEXT NOT NULL,
+                                    media_path TEXT,
+                                    alt_text TEXT,
+                                    respond_to_id TEXT,
+                                    status TEXT NOT NULL,
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    next_attempt_at REAL NOT NULL,
+                                    lease_until REAL NOT NULL DEFAULT 0,
+                                    created_at REAL NOT NULL,
+                                    last_error TEXT)""")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS outbox_due_idx ON outbox (destination, status, next_attempt_at)")
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds an outbox from the [outbox] section of the configuration
+        :param config: A configuration instance
+        :return: An outbox, or None if the outbox is disabled
+        """
+        if not config.getboolean("outbox", "outbox.enabled", fallback=True):
+            return None
+        return Outbox(config.get("outbox", "outbox.path", fallback="outbox.db"),
+                      config.get("outbox", "outbox.media_dir", fallback="outbox_media"),
+                      max_attempts=config.getint("outbox", "outbox.max_attempts", fallback=8),
+                      base_backoff=config.getfloat("outbox", "outbox.base_backoff", fallback=30),
+                      max_backoff=config.getfloat("outbox", "outbox.max_backoff", fallback=3600),
+                      concurrency=config.getint("outbox", "outbox.concurrency", fallback=1))
+
+    def enqueue(self, destination, text, media_path=None, alt_text=None, respond_to_id=None):
+        """
+        Adds a composed post to the queue. The media file is moved into the outbox's media directory and
+        belongs to the outbox from then on.
+        :param destination: Destination social media name
+        :param text: The final post text
+        :param media_path: Path to an image to attach, or None for a text-only post
+        :param alt_text: Image description
+        :param respond_to_id: Status being replied to, or None
+        :return: The entry id
+        """
+        now = time.time()
+        cur = self.__conn.execute("""INSERT INTO outbox (destination, text, alt_text, respond_to_id, status, next_attempt_at, created_at)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                  (destination, text, alt_text, None if respond_to_id is None else str(respond_to_id), Outbox.PENDING, now, now))
+        entry_id = cur.lastrowid
+        if media_path is not None:
+            queued_path = os.path.join(self.__media_dir, "%d_%s" % (entry_id, os.path.basename(media_path)))
+            shutil.move(media_path, queued_path)
+            self.__conn.execute("UPDATE outbox SET media_path = ? WHERE id = ?", (queued_path, entry_id))
+        return entry_id
+
+    def claim(self, destination):
+        """
+        Leases the next due entry for a destination, unless the destination's concurrency limit is reached
+        :param destination: Destination social media name
+        :return: The entry as a dict, or None if nothing can be published right now
+        """
+        now = time.time()
+        self.__conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Leases from crashed publishers expire and their entries become due again
+            self.__conn.execute("UPDATE outbox SET status = ? WHERE status = ? AND lease_until < ?",
+                                (Outbox.PENDING, Outbox.PUBLISHING, now))
+            publishing = self.__conn.execute("SELECT COUNT(*) FROM outbox WHERE destination = ? AND status = ?",
+                                             (destination, Outbox.PUBLISHING)).fetchone()[0]
+            row = None
+            if publishing < self.__concurrency:
+                row = self.__conn.execute("""SELECT id, text, media_path, alt_text, respond_to_id, attempts FROM outbox
+                                             WHERE destination = ? AND status = ? AND next_attempt_at <= ?
+                                             ORDER BY next_attempt_at, id LIMIT 1""",
+                                          (destination, Outbox.PENDING, now)).fetchone()
+            if row is not None:
+                self.__conn.execute("UPDATE outbox SET status = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                    (Outbox.PUBLISHING, now + self.__lease_seconds, row[0]))
+            self.__conn.execute("COMMIT")
+        except:
+            self.__conn.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "text": row[1],
+            "media_path": row[2],
+            "alt_text": row[3],
+            "respond_to_id": row[4],
+            "attempts": row[5] + 1
+        }
+
+    def __finish(self, entry, status, error=None):
+        self.__conn.execute("UPDATE outbox SET status = ?, last_error = ? WHERE id = ?", (status, error, entry["id"]))
+        if entry["media_path"] is not None:
+            # Along with anything the destination kept next to the media, like upload progress
+            for path in glob.glob(glob.escape(entry["media_path"]) + "*"):
+                os.unlink(path)
+
+    def complete(self, entry):
+        self.__finish(entry, Outbox.DONE)
+
+    def fail(self, entry, ex):
+        """
+        Schedules a failed entry for another attempt, or gives up on it
+        :param entry: The claimed entry
+        :param ex: The PublishException raised by the destination
+        :return: True if the entry will be retried
+        """
+        if ex.permanent or entry["attempts"] >= self.__max_attempts:
+            logger.error("Giving up on outbox entry %s after %d attempts: %s", entry["id"], entry["attempts"], ex)
+            self.__finish(entry, Outbox.DEAD, str(ex))
+            return False
+
+        delay = min(self.__max_backoff, self.__base_backoff * (2 ** (entry["attempts"] - 1)))
+        delay = delay * (0.5 + random.random() / 2.0)
+        if ex.retry_after is not None:
+            delay = max(delay, ex.retry_after)
+        logger.warning("Outbox entry %s failed, retrying in %.0f seconds: %s", entry["id"], delay, ex)
+        self.__conn.execute("UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                            (Outbox.PENDING, time.time() + delay, str(ex), entry["id"]))
+        return True
+
+    def defer(self, destination, until):
+        """
+        Pushes back every pending entry of a destination, used when it reports that its rate limit is exhausted
+        """
+        self.__conn.execute("UPDATE outbox SET next_attempt_at = MAX(next_attempt_at, ?) WHERE destination = ? AND status = ?",
+                            (until, destination, Outbox.PENDING))
+
+    def drain(self, destination, social, entry_id=None):
+        """
+        Publishes due entries for a destination until none are left, one fails or the destination is rate limited
+        :param destination: Destination social media name
+        :param social: The destination's client
+        :param entry_id: An entry whose outcome the caller is waiting for
+        :return: True if entry_id was published during this drain
+        """
+        published = False
+        while True:
+            entry = self.claim(destination)
+            if entry is None:
+                break
+            try:
+                social.publish(entry["text"], image_path=entry["media_path"], alt_text=entry["alt_text"], respond_to_id=entry["respond_to_id"])
+            except PublishException as ex:
+                self.fail(entry, ex)
+                if ex.permanent:
+                    continue
+                # The destination is struggling, leave the rest of the queue for a later drain
+                if ex.retry_after is not None:
+                    self.defer(destination, time.time() + ex.retry_after)
+                break
+            except Exception as ex:
+                # Anything else, like a missing media file, fails the same way on every attempt
+                logger.exception("Publishing outbox entry %s failed", entry["id"])
+                self.fail(entry, PublishException(str(ex), permanent=True))
+                continue
+            self.complete(entry)
+            if entry["id"] == entry_id:
+                published = True
+
+            reset = social.get_rate_limit_reset()
+            if reset is not None:
+                logger.info("%s rate limit exhausted, deferring the outbox until %s", destination, time.ctime(reset))
+                self.defer(destination, reset)
+                break
+        return published
+
+    def close(self):
+        self.__conn.close()
+
+
+class QueuedPublisher:
+    """
+    Wraps a destination client so that posts are composed, queued in the outbox and then published from it.
+    Everything other than posting is passed through to the client.
+    """
+
+    def __init__(self, social, outbox, destination):
+        self.__social = social
+        self.__outbox = outbox
+        self.__destination = destination
+
+    def __getattr__(self, name):
+        return getattr(self.__social, name)
+
+    def drain(self):
+        return self.__outbox.drain(self.__destination, self.__social)
+
+    def post_text(self, status, respond_to_user=None, respond_to_id=None):
+        text = self.__social.compose_text(status, respond_to_user=respond_to_user)
+        entry_id = self.__outbox.enqueue(self.__destination, text, respond_to_id=respond_to_id)
+        return self.__outbox.drain(self.__destination, self.__social, entry_id=entry_id)
+
+    def post_image(self, title, source, shortened_image_link, image_path="image.jpg", respond_to_user=None, respond_to_id=None, alt_text=None):
+        """
+        Queues an image post and tries to publish it straight away
+        :return: True if the post was published now; a post that cannot be published now stays queued and is retried
+                 by later runs
+        """
+        text, respond_to_id = self.__social.compose_image_post(title, source, shortened_image_link, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        entry_id = self.__outbox.enqueue(self.__destination, text, media_path=image_path, alt_text=alt_text, respond_to_id=respond_to_id)
+        return self.__outbox.drain(self.__destination, self.__social, entry_id=entry_id)
@@ -0,0 +1,162 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sqlite3
+import time
+import threading
+from log import get_logger
+
+logger = get_logger("ratelimit")
+
+
+class RateLimitExceededException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter. Bucket state is kept in a SQLite database so every process using the same
+    database file draws from the same budget. Scheduled posts may use the whole bucket while mention replies
+    must leave a reserve untouched, and mention replies give up sooner when the bucket is empty.
+    """
+
+    PRIORITY_SCHEDULED = 0
+    PRIORITY_MENTION = 1
+
+    def __init__(self, path, name, calls_per_hour, burst, reserve=0, max_wait=60.0, mention_max_wait=5.0):
+        self.__path = path
+        self.__name = name
+        self.__rate = float(calls_per_hour) / 3600.0
+        self.__capacity = float(burst)
+        self.__reserve = min(float(reserve), self.__capacity)
+        self.__max_wait = {
+            RateLimiter.PRIORITY_SCHEDULED: float(max_wait),
+            RateLimiter.PRIORITY_MENTION: float(mention_max_wait)
+        }
+        # Hedged calls record throttling from their worker threads, so the connection is shared under a lock
+        self.__conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__lock = threading.Lock()
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                                    name TEXT PRIMARY KEY,
+                                    tokens REAL NOT NULL,
+                                    updated_at REAL NOT NULL)""")
+
+    @staticmethod
+    def from_config(config, name):
+        """
+        Builds a rate limiter from the [ratelimit] section of the configuration
+        :param config: A configuration instance
+        :param name: Name of the shared bucket
+        :return: A rate limiter, or None if rate limiting is disabled
+        """
+        calls_per_hour = config.getfloat("ratelimit", "ratelimit.calls_per_hour", fallback=3000)
+        if calls_per_hour <= 0:
+            return None
+        return RateLimiter(config.get("ratelimit", "ratelimit.path", fallback="ratelimit.db"),
+                           name,
+                           calls_per_hour,
+                           config.getfloat("ratelimit", "ratelimit.burst", fallback=100),
+                           reserve=config.getfloat("ratelimit", "ratelimit.reserve", fallback=20),
+                           max_wait=config.getfloat("ratelimit", "ratelimit.max_wait", fallback=60),
+                           mention_max_wait=config.getfloat("ratelimit", "ratelimit.mention_max_wait", fallback=5))
+
+    def __bucket_name(self, bucket):
+        return self.__name if bucket is None else "%s:%s" % (self.__name, bucket)
+
+    def __take(self, tokens, floor, name):
+        """
+        Refills the bucket and takes tokens from it if doing so would not drop it below the floor. Runs in an
+        immediate transaction so concurrent processes serialize on the database lock.
+        :return: Zero if the tokens were taken, otherwise the number of seconds until they will be available
+        """
+        with self.__lock:
+            now = time.time()
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.__conn.execute("SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    available = self.__capacity
+                else:
+                    available = min(self.__capacity, row[0] + max(0.0, now - row[1]) * self.__rate)
+
+                wait = 0.0
+                if available - tokens >= floor:
+                    available = min(self.__capacity, available - tokens)
+                else:
+                    wait = (floor + tokens - available) / self.__rate
+
+                self.__conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                                    (name, available, now))
+                self.__conn.execute("COMMIT")
+            except:
+                self.__conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def acquire(self, priority=PRIORITY_SCHEDULED, tokens=1, bucket=None, max_wait=None):
+        """
+        Takes tokens from the bucket, waiting for them to refill if needed. Raises RateLimitExceededException
+        if they will not be available within the maximum wait for the priority.
+        :param priority: PRIORITY_SCHEDULED or PRIORITY_MENTION
+        :param tokens: Number of tokens needed
+        :param bucket: Name of a separate bucket with the same rate and burst, e.g. one per user, or None for the
+                       limiter's own bucket
+        :param max_wait: Seconds to wait at most, or None for the maximum wait of the priority
+        """
+        name = self.__bucket_name(bucket)
+        floor = self.__reserve if priority == RateLimiter.PRIORITY_MENTION else 0.0
+        deadline = time.time() + (self.__max_wait[priority] if max_wait is None else max_wait)
+        while True:
+            wait = self.__take(tokens, floor, name)
+            if wait <= 0:
+                return
+            if time.time() + wait > deadline:
+                raise RateLimitExceededException("Rate limit for '%s' exhausted, retry in %.1f seconds" % (name, wait))
+            logger.info("Rate limit for '%s' reached, waiting %.1f seconds", name, wait)
+            time.sleep(wait)
+
+    def release(self, tokens=1, bucket=None):
+        """
+        Returns tokens taken for a call that was not made, up to the bucket's burst
+        :param tokens: Number of tokens to return
+        :param bucket: Name of a separate bucket, as passed to acquire, or None for the limiter's own bucket
+        """
+        self.__take(-tokens, float("-inf"), self.__bucket_name(bucket))
+
+    def penalize(self, seconds, bucket=None):
+        """
+        Empties the bucket so that no process makes calls for the given number of seconds. Used when the
+        remote service reports that we are being throttled.
+        :param seconds: Number of seconds to back off
+        :param bucket: Name of a separate bucket, as passed to acquire, or None for the limiter's own bucket
+        """
+        with self.__lock:
+            self.__conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.__conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                                    (self.__bucket_name(bucket), -float(seconds) * self.__rate, time.time()))
+                self.__conn.execute("COMMIT")
+            except:
+                self.__conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
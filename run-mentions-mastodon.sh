@@ -8,4 +8,4 @@ if [ -f "last_mention_id_mstdn.txt" ]; then
     sinceid=`cat last_mention_id_mstdn.txt`
 fi
 
-python3 hourlyplanet.py -r -s $sinceid -w last_mention_id_mstdn.txt -d mastodon $@ >> run_mastodon.log 2>&1
\ No newline at end of file
+python3 hourlyplanet.py -r -s $sinceid -w last_mention_id_mstdn.txt -d mastodon -l run-mentions-mastodon.log $@ 2>> run-mentions-mastodon.err
\ No newline at end of file
@@ -8,4 +8,4 @@ if [ -f "last_mention_id.txt" ]; then
     sinceid=`cat last_mention_id.txt`
 fi
 
-python3 hourlyplanet.py -r -s $sinceid -w last_mention_id.txt -d twitter $@ >> run.log 2>&1
+python3 hourlyplanet.py -r -s $sinceid -w last_mention_id.txt -d twitter -l run-mentions.log $@ 2>> run-mentions.err
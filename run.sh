@@ -1,4 +1,4 @@
 #!/bin/bash
 
 pushd /home/pi/repos/HourlyPlanet
-python3 hourlyplanet.py -p -d twitter >> run.log 2>&1 
+python3 hourlyplanet.py -p -d twitter -l run.log 2>> run.err
@@ -1,4 +1,4 @@
 #!/bin/bash
 
 pushd /home/pi/repos/HourlyPlanet
-python3 hourlyplanet.py -p -d mastodon >> run_mastodon.log 2>&1 
+python3 hourlyplanet.py -p -d mastodon -l run_mastodon.log 2>> run_mastodon.err
@@ -0,0 +1,270 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import re
+import json
+import time
+import sqlite3
+
+from metrics import Metrics
+from source import GroupSource
+from log import get_logger
+
+logger = get_logger("searchindex")
+
+# Mention search terms are lowercased with their leading article removed, see find_search_term
+TOKEN_PATTERN = re.compile(r"\w+")
+HTML_TAG_PATTERN = re.compile('<.*?>')
+STOP_WORDS = frozenset(["a", "an", "the"])
+
+
+def tokenize(text):
+    """
+    Splits text into the lowercased words the index is keyed on
+    :param text: Title, description, tags or a search term
+    :return: A list of words
+    """
+    if text is None:
+        return []
+    text = re.sub(HTML_TAG_PATTERN, " ", text).lower()
+    return [word for word in TOKEN_PATTERN.findall(text) if word not in STOP_WORDS]
+
+
+def source_key(source):
+    """
+    :param source: A user photostream or album source
+    :return: The key the source's photos are indexed under: its Flickr id, followed by its albums for an album
+             source, so bots listing the same account with different albums keep apart
+    """
+    if source.user_has_albums():
+        return "%s/%s" % (source.get_flickr_id(), ",".join(sorted(str(album_id) for album_id in source.get_album_list())))
+    return source.get_flickr_id()
+
+
+class SearchIndex:
+    """
+    Local inverted index over the titles, descriptions and tags of the photos of the configured sources. User
+    photostreams are kept current with min_upload_date deltas, album sources hold exactly the photos of their
+    albums and are refetched when an album changes. Sources are fully reindexed every full_refresh_days so
+    deleted photos drop out. Entries are keyed by source_key.
+    """
+
+    # Flickr search returns at most this many results for one query, however it is paged
+    SEARCH_RESULT_LIMIT = 4000
+    PAGE_SIZE = 500
+
+    def __init__(self, path, full_refresh_days=7):
+        self.__full_refresh_seconds = float(full_refresh_days) * 86400.0
+        # Sources already updated by this process, when several bots share them
+        self.__updated = set()
+        self.__conn = sqlite3.connect(path, timeout=30)
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS photos (
+                                    source_id TEXT NOT NULL,
+                                    album_id TEXT NOT NULL,
+                                    photo_id TEXT NOT NULL,
+                                    upload_date INTEGER NOT NULL,
+                                    data TEXT NOT NULL,
+                                    PRIMARY KEY (source_id, album_id, photo_id))""")
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS terms (
+                                    term TEXT NOT NULL,
+                                    source_id TEXT NOT NULL,
+                                    photo_id TEXT NOT NULL,
+                                    PRIMARY KEY (term, source_id, photo_id)) WITHOUT ROWID""")
+        self.__conn.execute("""CREATE TABLE IF NOT EXISTS synced (
+                                    source_id TEXT PRIMARY KEY,
+                                    max_upload_date INTEGER NOT NULL,
+                                    albums TEXT NOT NULL,
+                                    synced_at REAL NOT NULL,
+                                    full_synced_at REAL NOT NULL)""")
+        self.__conn.commit()
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds a search index from the [searchindex] section of the configuration
+        :param config: A configuration instance
+        :return: A search index, or None if the index is disabled
+        """
+        if not config.getboolean("searchindex", "searchindex.enabled", fallback=True):
+            return None
+        return SearchIndex(config.get("searchindex", "searchindex.path", fallback="search_index.db"),
+                           full_refresh_days=config.getfloat("searchindex", "searchindex.full_refresh_days", fallback=7))
+
+    def __add_photo(self, source_id, album_id, photo):
+        photo_id = str(photo["id"])
+        self.__conn.execute("INSERT OR REPLACE INTO photos (source_id, album_id, photo_id, upload_date, data) VALUES (?, ?, ?, ?, ?)",
+                            (source_id, album_id, photo_id, int(photo.get("dateupload", 0)), json.dumps(photo)))
+        description = photo["description"]["_content"] if isinstance(photo.get("description"), dict) else photo.get("description")
+        words = set(tokenize(photo.get("title")) + tokenize(description) + tokenize(photo.get("tags")))
+        self.__conn.executemany("INSERT OR IGNORE INTO terms (term, source_id, photo_id) VALUES (?, ?, ?)",
+                                [(word, source_id, photo_id) for word in words])
+
+    def __remove_orphaned_terms(self, source_id):
+        self.__conn.execute("""DELETE FROM terms WHERE source_id = ?
+                               AND photo_id NOT IN (SELECT photo_id FROM photos WHERE source_id = ?)""", (source_id, source_id))
+
+    def __clear_source(self, source_id):
+        self.__conn.execute("DELETE FROM photos WHERE source_id = ?", (source_id,))
+        self.__conn.execute("DELETE FROM terms WHERE source_id = ?", (source_id,))
+
+    def __sync_photostream(self, flickr, source_id, flickr_id, since):
+        """
+        Indexes photos uploaded at or after since, oldest first. A query is restarted from the newest upload seen
+        when it reaches Flickr's search result limit.
+        :return: The newest upload date seen
+        """
+        newest = since
+        page = 1
+        while True:
+            resp = flickr.get_photos_uploaded_since(flickr_id, since, page=page, page_size=SearchIndex.PAGE_SIZE)
+            photos = resp["photos"]["photo"]
+            for photo in photos:
+                self.__add_photo(source_id, "", photo)
+                newest = max(newest, int(photo.get("dateupload", 0)))
+            if len(photos) == 0 or page >= int(resp["photos"]["pages"]):
+                break
+            if (page + 1) * SearchIndex.PAGE_SIZE > SearchIndex.SEARCH_RESULT_LIMIT:
+                if newest == since:
+                    break
+                since = newest
+                page = 1
+            else:
+                page += 1
+        return newest
+
+    def __sync_album(self, flickr, source_id, flickr_id, album_id):
+        self.__conn.execute("DELETE FROM photos WHERE source_id = ? AND album_id = ?", (source_id, album_id))
+        page = 1
+        while True:
+            resp = flickr.get_album_photos(flickr_id, album_id, page)
+            photos = resp["photoset"]["photo"]
+            for photo in photos:
+                self.__add_photo(source_id, album_id, photo)
+            if len(photos) == 0 or page >= int(resp["photoset"]["pages"]):
+                break
+            page += 1
+
+    def update_source(self, flickr, source):
+        """
+        Brings the index of one user source up to date
+        :param flickr: An initialized Flickr instance
+        :param source: A user photostream or album source
+        """
+        source_id = source_key(source)
+        flickr_id = source.get_flickr_id()
+        now = time.time()
+        row = self.__conn.execute("SELECT max_upload_date, albums, full_synced_at FROM synced WHERE source_id = ?", (source_id,)).fetchone()
+        full = row is None or now - row[2] > self.__full_refresh_seconds
+        max_upload_date = 0 if full else row[0]
+        album_versions = {} if full else json.loads(row[1])
+        full_synced_at = now if full else row[2]
+
+        try:
+            if full:
+                self.__clear_source(source_id)
+
+            if source.user_has_albums():
+                # Photostream entries from before the source was restricted to albums
+                self.__conn.execute("DELETE FROM photos WHERE source_id = ? AND album_id = ''", (source_id,))
+                albums = list(source.get_album_list())
+                for album_id in albums:
+                    album_info = flickr.get_album_info(flickr_id, album_id)
+                    version = str(album_info["photoset"].get("date_update", ""))
+                    if version != "" and album_versions.get(album_id) == version:
+                        continue
+                    self.__sync_album(flickr, source_id, flickr_id, album_id)
+                    album_versions[album_id] = version
+                # Albums removed from the sources file
+                for album_id in set(album_versions.keys()) - set(albums):
+                    self.__conn.execute("DELETE FROM photos WHERE source_id = ? AND album_id = ?", (source_id, album_id))
+                    del album_versions[album_id]
+                self.__remove_orphaned_terms(source_id)
+            else:
+                if len(album_versions) > 0:
+                    # The source was restricted to albums until now
+                    self.__clear_source(source_id)
+                    album_versions = {}
+                max_upload_date = self.__sync_photostream(flickr, source_id, flickr_id, max_upload_date)
+
+            self.__conn.execute("INSERT OR REPLACE INTO synced (source_id, max_upload_date, albums, synced_at, full_synced_at) VALUES (?, ?, ?, ?, ?)",
+                                (source_id, max_upload_date, json.dumps(album_versions), now, full_synced_at))
+            self.__conn.commit()
+        except:
+            self.__conn.rollback()
+            raise
+
+    def update(self, flickr, sources):
+        """
+        Brings the index of every user and album source up to date. Group pools are too large to index and are
+        left to Flickr search.
+        :param flickr: An initialized Flickr instance
+        :param sources: A list of sources
+        :return: The number of sources that failed to update
+        """
+        failures = 0
+        for source in sources:
+            if isinstance(source, GroupSource) or source_key(source) in self.__updated:
+                continue
+            try:
+                with Metrics.timer("index_update"):
+                    self.update_source(flickr, source)
+                self.__updated.add(source_key(source))
+            except Exception as ex:
+                logger.warning("Failed to index source %s: %s", source_key(source), ex)
+                failures += 1
+        return failures
+
+    def is_indexed(self, source_id):
+        """
+        :param source_id: A source_key
+        """
+        return self.__conn.execute("SELECT 1 FROM synced WHERE source_id = ?", (source_id,)).fetchone() is not None
+
+    def search(self, text, source_ids=None):
+        """
+        Finds the photos whose title, description or tags contain every word of a search term
+        :param text: The search term
+        :param source_ids: Keys of the sources to search, see source_key, or None for all sources
+        :return: A dict of source key to the list of matching photo ids
+        """
+        words = sorted(set(tokenize(text)))
+        if len(words) == 0:
+            return {}
+
+        rows = self.__conn.execute("""SELECT source_id, photo_id FROM terms WHERE term IN (%s)
+                                      GROUP BY source_id, photo_id HAVING COUNT(*) = ?""" % ",".join("?" * len(words)),
+                                   words + [len(words)]).fetchall()
+        if source_ids is not None:
+            source_ids = set(source_ids)
+            rows = [row for row in rows if row[0] in source_ids]
+
+        matches = {}
+        for source_id, photo_id in rows:
+            matches.setdefault(source_id, []).append(photo_id)
+        return matches
+
+    def get_photo(self, source_id, photo_id):
+        """
+        :return: The indexed Flickr photo, as returned by the listing it was indexed from
+        """
+        row = self.__conn.execute("SELECT data FROM photos WHERE source_id = ? AND photo_id = ? LIMIT 1", (source_id, str(photo_id))).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        self.__conn.close()
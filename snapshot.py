@@ -0,0 +1,101 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import pickle
+import hashlib
+from log import get_logger
+
+logger = get_logger("snapshot")
+
+
+class Snapshot:
+    """
+    Caches the parsed and validated form of a configuration file in a pickle stored next to it, named
+    .<file name>.snapshot. A snapshot is reused while the file's modification time and size are unchanged, or
+    when they changed but the content hash did not. Otherwise the file is parsed again.
+    """
+
+    # Bump when the structure of a snapshotted value changes
+    VERSION = 1
+
+    @staticmethod
+    def path_for(path):
+        directory, name = os.path.split(os.path.abspath(path))
+        return os.path.join(directory, ".%s.snapshot" % name)
+
+    @staticmethod
+    def __read(snapshot_path):
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get("version") != Snapshot.VERSION:
+            return None
+        return snapshot
+
+    @staticmethod
+    def __write(snapshot_path, snapshot):
+        tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+        except (IOError, OSError):
+            # A read-only config directory only costs us the cache
+            logger.warning("Unable to write configuration snapshot %s", snapshot_path)
+
+    @staticmethod
+    def load(path, kind, build):
+        """
+        Returns the parsed form of a file, from its snapshot when still valid
+        :param path: Path of the source file
+        :param kind: Name of the parser, so one file parsed two ways keeps separate snapshots
+        :param build: Function taking the file content as bytes and returning the parsed value
+        :return: The parsed value
+        """
+        stat = os.stat(path)
+        snapshot_path = Snapshot.path_for(path)
+        snapshot = Snapshot.__read(snapshot_path)
+        if snapshot is not None and snapshot["kind"] != kind:
+            snapshot = None
+
+        if snapshot is not None and snapshot["mtime_ns"] == stat.st_mtime_ns and snapshot["size"] == stat.st_size:
+            return snapshot["value"]
+
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        if snapshot is not None and snapshot["sha256"] == digest:
+            value = snapshot["value"]
+        else:
+            value = build(content)
+
+        Snapshot.__write(snapshot_path, {
+            "version": Snapshot.VERSION,
+            "kind": kind,
+            "path": os.path.abspath(path),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": digest,
+            "value": value
+        })
+        return value
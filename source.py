@@ -17,19 +17,19 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import sys
-import os
-import requests
-from configparser import ConfigParser
 import math
-import traceback
-import json
-import argparse
-import re
-import yaml
-import unidecode
 
-from flickr import *
+from util import Util
+from flickr import NoPhotosFoundException, NoSearchResultsException, NoAlbumsFoundException
+from ratelimit import RateLimitExceededException
+from log import get_logger
+
+logger = get_logger("source")
+
+
+class NoSourcesFoundException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
 
 
 class Source:
@@ -40,10 +40,11 @@ class Source:
 
         try:
             self.__user_info = flickr.get_user_info(self.get_flickr_id())
+        except RateLimitExceededException:
+            raise
         except:
-            print("Failed to retrieve user information from Flickr")
-            traceback.print_exc()
-            raise Exception()
+            logger.exception("Failed to retrieve user information from Flickr")
+            raise Exception("Failed to retrieve user information from Flickr")
 
     def get_album_list(self):
         if "albums" not in self.__source:
@@ -90,6 +91,8 @@ class Source:
         using the 'username' property.
         :return: The Flickr user's username
         """
+        import unidecode
+
         if self.__user_info["person"]["realname"]["_content"] is None or len(self.__user_info["person"]["realname"]["_content"]) == 0:
             return unidecode.unidecode(self.__user_info["person"]["username"]["_content"])
         else:
@@ -130,23 +133,24 @@ class Source:
     def get_random_search_image(self, text):
         search_photos = self.__flickr.search_user_photos(self.get_flickr_id(), text, page_size=0)
         num_photos = int(search_photos["photos"]["total"])
+        if num_photos == 0:
+            raise NoSearchResultsException("User has no images matching search")
         random_page = Util.randint(0, int(math.ceil(float(num_photos) / float(self.__flickr.page_size))))
         user_name = self.get_flickr_username()
         
-        print("Flickr user %s has %s images matching search, selected page %s" % (user_name, num_photos, random_page))
+        logger.info("Flickr user %s has %s images matching search, selected page %s", user_name, num_photos, random_page, extra={"flickr_id": self.get_flickr_id(), "page": random_page})
 
         try:
             ps_page = self.__flickr.search_user_photos(self.__user_info["person"]["id"], text, random_page)
         except:
-            print("Failed to retrieve user search from Flickr")
-            traceback.print_exc()
+            logger.exception("Failed to retrieve user search from Flickr")
             raise Exception("Failed to retrieve user search from Flickr")
 
         
 
         num_images = len(ps_page["photos"]["photo"])
         if num_images == 0:
-            print("Page has zero images, cannot continue")
+            logger.warning("Page has zero images, cannot continue")
             raise NoPhotosFoundException("Page has zero images, cannot continue")
 
         random_image_num = Util.randint(0, num_images - 1)
@@ -167,18 +171,17 @@ class Source:
         random_page = Util.randint(0, int(math.ceil(float(num_photos) / float(self.__flickr.page_size))))
         user_name = self.get_flickr_username()
 
-        print("Flickr user %s has %s images, selected page %s" % (user_name, num_photos, random_page))
+        logger.info("Flickr user %s has %s images, selected page %s", user_name, num_photos, random_page, extra={"flickr_id": self.get_flickr_id(), "page": random_page})
 
         try:
             ps_page = self.__flickr.get_photostream(self.__user_info["person"]["id"], random_page)
         except:
-            print("Failed to retrieve user Photostream from Flickr")
-            traceback.print_exc()
+            logger.exception("Failed to retrieve user Photostream from Flickr")
             raise Exception("Failed to retrieve user Photostream from Flickr")
 
         num_images = len(ps_page["photos"]["photo"])
         if num_images == 0:
-            print("Page has zero images, cannot continue")
+            logger.warning("Page has zero images, cannot continue")
             raise NoPhotosFoundException("Page has zero images, cannot continue")
 
         random_image_num = Util.randint(0, num_images - 1)
@@ -192,21 +195,131 @@ class Source:
 
         user_name = self.get_flickr_username()
         album_name = album_info["photoset"]["title"]["_content"]
-        print("Flickr album %s for user %s has %s images, selected page %s" % (
-        album_name, user_name, num_photos, random_page))
+        logger.info("Flickr album %s for user %s has %s images, selected page %s", album_name, user_name, num_photos, random_page, extra={"flickr_id": self.get_flickr_id(), "page": random_page})
 
         try:
             al_page = self.__flickr.get_album_photos(self.__user_info["person"]["id"], album_info["photoset"]["id"], random_page)
         except:
-            print("Failed to retrieve user album from Flickr")
+            logger.error("Failed to retrieve user album from Flickr")
             raise Exception("Failed to retrieve user album from Flickr")
 
         num_images = len(al_page["photoset"]["photo"])
         if num_images == 0:
-            print("Page has zero images, cannot continue")
+            logger.warning("Page has zero images, cannot continue")
             raise NoPhotosFoundException("Page has zero images, cannot continue")
 
         random_image_num = Util.randint(0, num_images - 1)
         random_image = al_page["photoset"]["photo"][random_image_num]
 
         return random_image
+
+
+class GroupSource:
+    """
+    A Flickr group pool used as a source. The pool size comes from the group's information, which is cached for
+    a day, so each pick costs a single page fetch no matter how large the pool is. Photos are credited to
+    their owners rather than to the group.
+    """
+
+    def __init__(self, source, flickr):
+        self.__source = source
+        self.__flickr = flickr
+        self.__owner_name = None
+
+        try:
+            self.__group_info = flickr.get_group_info(self.get_flickr_id())
+        except RateLimitExceededException:
+            raise
+        except:
+            logger.exception("Failed to retrieve group information from Flickr")
+            raise Exception("Failed to retrieve group information from Flickr")
+
+    def get_twitter_id(self):
+        if "twitter_id" in self.__source:
+            return self.__source["twitter_id"]
+        else:
+            return ""
+
+    def get_mastodon_id(self):
+        if "mastodon_id" in self.__source:
+            return self.__source["mastodon_id"]
+        else:
+            return ""
+
+    def get_flickr_id(self):
+        """
+        Returns the group's id
+        :return: The group's id
+        """
+        return self.__source["group_id"]
+
+    def get_group_name(self):
+        return self.__group_info["group"]["name"]["_content"]
+
+    def get_flickr_username(self):
+        """
+        Returns the owner's name of the most recently picked photo, or the group's name if none was picked yet
+        :return: The name to credit
+        """
+        import unidecode
+
+        if self.__owner_name is None or len(self.__owner_name) == 0:
+            return unidecode.unidecode(self.get_group_name())
+        return unidecode.unidecode(self.__owner_name)
+
+    def user_has_albums(self):
+        return False
+
+    def get_pool_count(self):
+        return int(self.__group_info["group"]["pool_count"]["_content"])
+
+    def __pick_from_page(self, photos):
+        """
+        Picks a random photo from a page, keeping only the configured licenses if any
+        """
+        if "licenses" in self.__source:
+            photos = [photo for photo in photos if str(photo.get("license")) in self.__source["licenses"]]
+        if len(photos) == 0:
+            logger.warning("Page has zero usable images, cannot continue")
+            raise NoPhotosFoundException("Page has zero usable images, cannot continue")
+
+        random_image = photos[Util.randint(0, len(photos) - 1)]
+        self.__owner_name = random_image.get("ownername")
+        return random_image
+
+    def get_random_image(self):
+        num_photos = self.get_pool_count()
+        if num_photos == 0:
+            raise NoPhotosFoundException("Group pool has no images")
+        random_page = Util.randint(1, int(math.ceil(float(num_photos) / float(self.__flickr.page_size))))
+
+        logger.info("Flickr group %s has %s images, selected page %s", self.get_group_name(), num_photos, random_page, extra={"group_id": self.get_flickr_id(), "page": random_page})
+
+        try:
+            pool_page = self.__flickr.get_group_photos(self.get_flickr_id(), random_page)
+        except RateLimitExceededException:
+            raise
+        except:
+            logger.exception("Failed to retrieve group pool from Flickr")
+            raise Exception("Failed to retrieve group pool from Flickr")
+
+        return self.__pick_from_page(pool_page["photos"]["photo"])
+
+    def get_random_search_image(self, text):
+        search_photos = self.__flickr.search_group_photos(self.get_flickr_id(), text, page_size=0)
+        num_photos = int(search_photos["photos"]["total"])
+        if num_photos == 0:
+            raise NoSearchResultsException("Group has no images matching search")
+        random_page = Util.randint(1, int(math.ceil(float(num_photos) / float(self.__flickr.page_size))))
+
+        logger.info("Flickr group %s has %s images matching search, selected page %s", self.get_group_name(), num_photos, random_page, extra={"group_id": self.get_flickr_id(), "page": random_page})
+
+        try:
+            ps_page = self.__flickr.search_group_photos(self.get_flickr_id(), text, random_page)
+        except RateLimitExceededException:
+            raise
+        except:
+            logger.exception("Failed to retrieve group search from Flickr")
+            raise Exception("Failed to retrieve group search from Flickr")
+
+        return self.__pick_from_page(ps_page["photos"]["photo"])
@@ -1,7 +1,36 @@
 import re
 import os
+import time
+import json
+import gzip
+import argparse
+import importlib.util
 import hourlyplanet as hp
 import unittest
+from history import PostedHistory
+from ratelimit import RateLimiter, RateLimitExceededException
+from hedge import Hedger
+from fastjson import FastJson, PHOTO_FIELDS
+from cache import ResponseCache
+from metrics import Metrics
+from tracing import Trace
+from fakeservers import FakeImageCDN, FakeFlickr, FakeTwitter, FakeMastodon
+from configparser import ConfigParser
+from source import GroupSource
+from flickr import NoPhotosFoundException, NoSearchResultsException
+from imagestore import ImageStore
+from snapshot import Snapshot
+from journal import MentionJournal
+from outbox import Outbox, QueuedPublisher, PublishException
+from health import SourceHealth
+from searchindex import SearchIndex, tokenize
+from source import NoSourcesFoundException
+from transcode import Transcoder, TranscodeException
+from mentionlimit import MentionLimiter
+from log import Log, get_logger
+import twitter
+import mstdn
+import benchmark
 
 
 
@@ -9,7 +38,7 @@ class TestUtils(unittest.TestCase):
 
     def test_base_58(self):
         self.assertEqual(hp.Util.encode_base58(1234567), "7jZD")
-        self.assertEqual(hp.Util.encode_base58(1234567l), "7jZD")
+        self.assertEqual(hp.Util.encode_base58(52345678901), "2nKBhDc")
         self.assertEqual(hp.Util.encode_base58(0), "")
         self.assertEqual(hp.Util.encode_base58(-1234567), "")
         with self.assertRaises(TypeError):
@@ -49,6 +78,1222 @@ class TestUtils(unittest.TestCase):
         os.unlink("test-image.jpg")
 
 
+class TestPostedHistory(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-history.db"):
+            os.unlink("test-history.db")
+
+    def tearDown(self):
+        if os.path.exists("test-history.db"):
+            os.unlink("test-history.db")
+
+    def test_recently_posted(self):
+        history = PostedHistory("test-history.db", "mastodon", window_hours=24)
+        self.assertFalse(history.was_recently_posted("12345"))
+        history.record(12345)
+        self.assertTrue(history.was_recently_posted("12345"))
+        history.close()
+
+        history = PostedHistory("test-history.db", "mastodon", window_hours=24)
+        self.assertTrue(history.was_recently_posted(12345))
+        history.close()
+
+        history = PostedHistory("test-history.db", "twitter", window_hours=24)
+        self.assertFalse(history.was_recently_posted(12345))
+        history.close()
+
+    def test_window_expiry(self):
+        history = PostedHistory("test-history.db", "mastodon", window_hours=0.0001)
+        history.record(12345)
+        history.close()
+        time.sleep(0.5)
+        history = PostedHistory("test-history.db", "mastodon", window_hours=0.0001)
+        self.assertFalse(history.was_recently_posted(12345))
+        history.close()
+
+        # The window also ends for a photo recorded by a process that is still running
+        history = PostedHistory("test-history.db", "mastodon", window_hours=0.0001)
+        history.record(12345)
+        self.assertTrue(history.was_recently_posted(12345))
+        time.sleep(0.5)
+        self.assertFalse(history.was_recently_posted(12345))
+        history.close()
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-ratelimit.db"):
+            os.unlink("test-ratelimit.db")
+
+    def tearDown(self):
+        if os.path.exists("test-ratelimit.db"):
+            os.unlink("test-ratelimit.db")
+
+    def test_shared_bucket(self):
+        a = RateLimiter("test-ratelimit.db", "flickr", 3600, 2, max_wait=0, mention_max_wait=0)
+        b = RateLimiter("test-ratelimit.db", "flickr", 3600, 2, max_wait=0, mention_max_wait=0)
+        a.acquire()
+        b.acquire()
+        with self.assertRaises(RateLimitExceededException):
+            a.acquire()
+        a.close()
+        b.close()
+
+    def test_mention_reserve(self):
+        limiter = RateLimiter("test-ratelimit.db", "flickr", 3600, 3, reserve=2, max_wait=0, mention_max_wait=0)
+        limiter.acquire(RateLimiter.PRIORITY_MENTION)
+        with self.assertRaises(RateLimitExceededException):
+            limiter.acquire(RateLimiter.PRIORITY_MENTION)
+        limiter.acquire(RateLimiter.PRIORITY_SCHEDULED)
+        limiter.close()
+
+    def test_waits_for_refill(self):
+        limiter = RateLimiter("test-ratelimit.db", "flickr", 36000, 1, max_wait=1)
+        limiter.acquire()
+        start = time.time()
+        limiter.acquire()
+        self.assertGreater(time.time() - start, 0.05)
+        limiter.close()
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        for path in ("test-cache.db", "test-cache.db-wal", "test-cache.db-shm"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    tearDown = setUp
+
+    def test_key_normalization(self):
+        a = ResponseCache.make_key("flickr.people.getInfo", {"method": "flickr.people.getInfo", "api_key": "abc", "user_id": "123@N05", "format": "json"})
+        b = ResponseCache.make_key("flickr.people.getInfo", {"user_id": "123@N05", "api_key": "def", "nojsoncallback": 1})
+        self.assertEqual(a, b)
+
+    def test_shared_get_put(self):
+        writer = ResponseCache("test-cache.db", 1024 * 1024)
+        reader = ResponseCache("test-cache.db", 1024 * 1024)
+        params = {"user_id": "123@N05"}
+        self.assertIsNone(reader.get("flickr.people.getInfo", params))
+        writer.put("flickr.people.getInfo", params, '{"stat": "ok"}')
+        self.assertEqual(reader.get("flickr.people.getInfo", params), {"stat": "ok"})
+
+        # Methods without a TTL are never cached
+        writer.put("flickr.test.echo", params, '{"stat": "ok"}')
+        self.assertIsNone(reader.get("flickr.test.echo", params))
+        writer.close()
+        reader.close()
+
+    def test_size_eviction(self):
+        cache = ResponseCache("test-cache.db", 100)
+        cache.put("flickr.people.getInfo", {"user_id": "1"}, '{"stat": "ok", "pad": "%s"}' % ("x" * 50))
+        time.sleep(0.01)
+        cache.put("flickr.people.getInfo", {"user_id": "2"}, '{"stat": "ok", "pad": "%s"}' % ("x" * 50))
+        cache.evict()
+        self.assertIsNone(cache.get("flickr.people.getInfo", {"user_id": "1"}))
+        self.assertIsNotNone(cache.get("flickr.people.getInfo", {"user_id": "2"}))
+        cache.close()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        Metrics.reset()
+        for path in ("test-metrics.json", "test-metrics.json.lock", "test-metrics.prom"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    tearDown = setUp
+
+    def test_snapshot_accumulates(self):
+        Metrics.observe("flickr_request_seconds", 0.2, method="flickr.people.getInfo")
+        Metrics.increment("image_download_bytes_total", 1000)
+        Metrics.write_snapshot("test-metrics.json", "test-metrics.prom")
+
+        Metrics.observe("flickr_request_seconds", 3.0, method="flickr.people.getInfo")
+        Metrics.increment("image_download_bytes_total", 500)
+        Metrics.write_snapshot("test-metrics.json", "test-metrics.prom")
+
+        with open("test-metrics.prom") as f:
+            prom = f.read()
+        self.assertIn('hourlyplanet_flickr_request_seconds_count{method="flickr.people.getInfo"} 2', prom)
+        self.assertIn('hourlyplanet_flickr_request_seconds_bucket{method="flickr.people.getInfo",le="0.25"} 1', prom)
+        self.assertIn("hourlyplanet_image_download_bytes_total 1500", prom)
+
+    def test_timer_counts_errors(self):
+        with self.assertRaises(ValueError):
+            with Metrics.timer("image_download"):
+                raise ValueError()
+        snapshot = Metrics.snapshot()
+        self.assertEqual(snapshot["counters"][0]["name"], "image_download_errors_total")
+        self.assertEqual(snapshot["histograms"][0]["count"], 1)
+
+
+class TestTrace(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists("test-trace.json"):
+            os.unlink("test-trace.json")
+
+    def test_write_spans(self):
+        Trace.enable()
+        with Trace.span("publish", kind="post"):
+            with Trace.span("image_download"):
+                pass
+        with self.assertRaises(ValueError):
+            with Trace.span("flickr_listing"):
+                raise ValueError()
+        Trace.write("test-trace.json")
+
+        with open("test-trace.json") as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual([e["name"] for e in events], ["publish", "image_download", "flickr_listing"])
+        self.assertEqual(events[0]["args"]["kind"], "post")
+        self.assertEqual(events[2]["args"]["error"], "ValueError")
+        self.assertGreaterEqual(events[0]["dur"], events[1]["dur"])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(benchmark.percentile(values, 50), 50.0)
+        self.assertEqual(benchmark.percentile(values, 99), 99.0)
+        self.assertEqual(benchmark.percentile([], 99), 0.0)
+
+    def test_compare_to_baseline(self):
+        baseline = {"results": [{"name": "find_and_post_image", "p50": 0.1, "p99": 0.2, "throughput": 10.0}]}
+        self.assertEqual(benchmark.compare_to_baseline([{"name": "find_and_post_image", "p50": 0.11, "p99": 0.2, "throughput": 9.5}], baseline, 0.25), [])
+        self.assertEqual(len(benchmark.compare_to_baseline([{"name": "find_and_post_image", "p50": 0.2, "p99": 0.2, "throughput": 5.0}], baseline, 0.25)), 2)
+        # Small absolute changes are noise
+        self.assertEqual(benchmark.compare_to_baseline([{"name": "find_and_post_image", "p50": 0.2, "p99": 0.2, "throughput": 5.0}], baseline, 0.25, 0.2), [])
+
+        # Parse times are compared as the projected parse's fraction of the full parse
+        baseline = {"results": [{"name": "parse_100_json", "p50": 0.001, "p99": 0.002, "throughput": 1000.0},
+                                {"name": "parse_100_projected", "p50": 0.0005, "p99": 0.001, "throughput": 2000.0}]}
+        slower = [{"name": "parse_100_json", "p50": 0.002, "p99": 0.006, "throughput": 500.0},
+                  {"name": "parse_100_projected", "p50": 0.001, "p99": 0.003, "throughput": 1000.0}]
+        self.assertEqual(benchmark.compare_to_baseline(slower, baseline, 0.25), [])
+        slower[1]["p50"] = 0.0015
+        self.assertEqual(len(benchmark.compare_to_baseline(slower, baseline, 0.25)), 1)
+
+    def test_startup_defers_heavy_imports(self):
+        times, imported = benchmark.measure_startup(runs=1)
+        self.assertEqual(len(times), 1)
+        for module in benchmark.DEFERRED_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_fake_image_cdn(self):
+        cdn = FakeImageCDN(payload_size=7191).start()
+        try:
+            hp.Util.fetch_image_to_path(cdn.image_url("1234"), "test-image.jpg")
+            self.assertEqual(os.path.getsize("test-image.jpg"), 7191)
+        finally:
+            cdn.stop()
+            if os.path.exists("test-image.jpg"):
+                os.unlink("test-image.jpg")
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        for path in ("test-sources.yaml", Snapshot.path_for("test-sources.yaml")):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    tearDown = setUp
+
+    def test_snapshot_reuse(self):
+        builds = []
+
+        def build(content):
+            builds.append(content)
+            return hp.build_source_entries(content)
+
+        with open("test-sources.yaml", "w") as f:
+            f.write("sources:\n  - flickr_id: '123@N05'\n    albums:\n      - 72157712420147562\n  - flickr_id: '456@N05'\n    disabled: true\n")
+
+        entries = Snapshot.load("test-sources.yaml", "sources", build)
+        self.assertEqual(entries, [{"flickr_id": "123@N05", "albums": ["72157712420147562"]}])
+        self.assertEqual(Snapshot.load("test-sources.yaml", "sources", build), entries)
+        self.assertEqual(len(builds), 1)
+
+        # Touching the file without changing it is caught by the content hash
+        os.utime("test-sources.yaml", (time.time() + 10, time.time() + 10))
+        Snapshot.load("test-sources.yaml", "sources", build)
+        self.assertEqual(len(builds), 1)
+
+        with open("test-sources.yaml", "w") as f:
+            f.write("sources:\n  - flickr_id: '789@N05'\n")
+        self.assertEqual(Snapshot.load("test-sources.yaml", "sources", build), [{"flickr_id": "789@N05"}])
+        self.assertEqual(len(builds), 2)
+
+
+class TestMentionJournal(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-mentions.journal"):
+            os.unlink("test-mentions.journal")
+
+    tearDown = setUp
+
+    def test_resume(self):
+        journal = MentionJournal("test-mentions.journal")
+        self.assertTrue(journal.should_process(1))
+        journal.record(1, MentionJournal.SEEN)
+        journal.record(1, MentionJournal.REPLIED)
+        journal.record(2, MentionJournal.SEEN)
+        journal.close()
+
+        # Simulate a torn write from a crash
+        with open("test-mentions.journal", "a") as f:
+            f.write('{"id": 3, "sta')
+
+        journal = MentionJournal("test-mentions.journal", max_attempts=2)
+        self.assertFalse(journal.should_process(1))
+        self.assertTrue(journal.should_process(2))
+        self.assertTrue(journal.should_process(3))
+        journal.record(2, MentionJournal.SEEN)
+        journal.close()
+
+        # Interrupted twice, so it is given up on
+        journal = MentionJournal("test-mentions.journal", max_attempts=2)
+        self.assertFalse(journal.should_process(2))
+        self.assertEqual(journal.state(2), MentionJournal.FAILED)
+        journal.close()
+
+    def test_compaction(self):
+        journal = MentionJournal("test-mentions.journal", max_entries=5)
+        for mention_id in range(0, 20):
+            journal.record(mention_id, MentionJournal.SEEN)
+            journal.record(mention_id, MentionJournal.REPLIED)
+        journal.record(20, MentionJournal.SEEN)
+        journal.close()
+
+        journal = MentionJournal("test-mentions.journal", max_entries=5)
+        self.assertIsNone(journal.state(0))
+        self.assertEqual(journal.state(19), MentionJournal.REPLIED)
+        self.assertEqual(journal.state(20), MentionJournal.SEEN)
+        journal.close()
+        with open("test-mentions.journal") as f:
+            self.assertEqual(len(f.readlines()), 11)
+
+
+class FakePublisher:
+
+    def __init__(self, failures=None):
+        self.failures = failures if failures is not None else []
+        self.published = []
+
+    def publish(self, text, image_path=None, alt_text=None, respond_to_id=None):
+        if len(self.failures) > 0:
+            raise self.failures.pop(0)
+        self.published.append((text, image_path is not None and os.path.exists(image_path), respond_to_id))
+
+    def get_rate_limit_reset(self):
+        return None
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-outbox.db"):
+            os.unlink("test-outbox.db")
+        if os.path.exists("test-outbox-media"):
+            for name in os.listdir("test-outbox-media"):
+                os.unlink(os.path.join("test-outbox-media", name))
+            os.rmdir("test-outbox-media")
+
+    tearDown = setUp
+
+    def test_publish_with_media(self):
+        outbox = Outbox("test-outbox.db", "test-outbox-media")
+        with open("test-outbox-image.jpg", "wb") as f:
+            f.write(b"jpeg")
+        entry_id = outbox.enqueue("twitter", "Hello", media_path="test-outbox-image.jpg", respond_to_id=42)
+        self.assertFalse(os.path.exists("test-outbox-image.jpg"))
+
+        social = FakePublisher()
+        self.assertTrue(outbox.drain("twitter", social, entry_id=entry_id))
+        self.assertEqual(social.published, [("Hello", True, "42")])
+        self.assertEqual(os.listdir("test-outbox-media"), [])
+        self.assertIsNone(outbox.claim("twitter"))
+        outbox.close()
+
+    def test_retry_and_give_up(self):
+        outbox = Outbox("test-outbox.db", "test-outbox-media", max_attempts=2, base_backoff=0)
+        outbox.enqueue("twitter", "Transient")
+        outbox.enqueue("twitter", "Rejected")
+        social = FakePublisher([PublishException("503"), PublishException("403", permanent=True)])
+
+        outbox.drain("twitter", social)
+        outbox.drain("twitter", social)
+        self.assertEqual(social.published, [("Transient", False, None)])
+        self.assertIsNone(outbox.claim("twitter"))
+        outbox.close()
+
+    def test_unexpected_error(self):
+        # An entry that fails with something other than a PublishException is given up on, not left leased
+        outbox = Outbox("test-outbox.db", "test-outbox-media", max_attempts=8, base_backoff=0)
+        outbox.enqueue("twitter", "Broken")
+        outbox.enqueue("twitter", "Hello")
+        social = FakePublisher([IOError("No such file")])
+        outbox.drain("twitter", social)
+        self.assertEqual(social.published, [("Hello", False, None)])
+        self.assertIsNone(outbox.claim("twitter"))
+        outbox.close()
+
+    def test_queued_image_post(self):
+        class FakeComposer(FakePublisher):
+            def compose_image_post(self, title, source, shortened_image_link, respond_to_user=None, respond_to_id=None):
+                return title, respond_to_id
+
+        outbox = Outbox("test-outbox.db", "test-outbox-media", base_backoff=0)
+        social = FakeComposer([PublishException("503")])
+        publisher = QueuedPublisher(social, outbox, "twitter")
+        for expected in (False, True):
+            with open("test-outbox-image.jpg", "wb") as f:
+                f.write(b"jpeg")
+            self.assertEqual(publisher.post_image("Saturn", None, "https://flic.kr/p/1", image_path="test-outbox-image.jpg"), expected)
+        outbox.close()
+
+    def test_retry_after(self):
+        outbox = Outbox("test-outbox.db", "test-outbox-media", base_backoff=0)
+        outbox.enqueue("mastodon", "First")
+        outbox.enqueue("mastodon", "Second")
+        social = FakePublisher([PublishException("429", retry_after=60)])
+
+        outbox.drain("mastodon", social)
+        self.assertEqual(social.published, [])
+        self.assertIsNone(outbox.claim("mastodon"))
+        outbox.close()
+
+    def test_concurrency(self):
+        outbox = Outbox("test-outbox.db", "test-outbox-media", concurrency=1)
+        other = Outbox("test-outbox.db", "test-outbox-media", concurrency=1)
+        outbox.enqueue("twitter", "First")
+        outbox.enqueue("twitter", "Second")
+        outbox.enqueue("mastodon", "Third")
+
+        entry = outbox.claim("twitter")
+        self.assertEqual(entry["text"], "First")
+        self.assertIsNone(other.claim("twitter"))
+        self.assertEqual(other.claim("mastodon")["text"], "Third")
+        outbox.complete(entry)
+        self.assertEqual(other.claim("twitter")["text"], "Second")
+        outbox.close()
+        other.close()
+
+
+class FakeSource:
+
+    def __init__(self, flickr_id):
+        self.flickr_id = flickr_id
+
+    def get_flickr_id(self):
+        return self.flickr_id
+
+
+class TestSourceHealth(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-health.db"):
+            os.unlink("test-health.db")
+
+    tearDown = setUp
+
+    def test_circuit(self):
+        health = SourceHealth("test-health.db", failure_threshold=2, cooldown_hours=0.0003)
+        health.record_failure("1@N00")
+        self.assertTrue(health.is_available("1@N00"))
+        health.record_failure("1@N00")
+        self.assertEqual(health.state("1@N00"), SourceHealth.OPEN)
+        self.assertFalse(health.is_available("1@N00"))
+        health.close()
+
+        # Persisted across runs, and probed once the cooldown has passed
+        health = SourceHealth("test-health.db", failure_threshold=2, cooldown_hours=0.0003)
+        self.assertFalse(health.is_available("1@N00"))
+        time.sleep(1.2)
+        self.assertTrue(health.is_available("1@N00"))
+        self.assertEqual(health.state("1@N00"), SourceHealth.HALF_OPEN)
+        self.assertFalse(SourceHealth("test-health.db").is_available("1@N00"))
+
+        # A failed probe reopens with a longer cooldown
+        health.record_failure("1@N00")
+        self.assertEqual(health.state("1@N00"), SourceHealth.OPEN)
+        time.sleep(1.2)
+        self.assertFalse(health.is_available("1@N00"))
+        time.sleep(1.2)
+        self.assertTrue(health.is_available("1@N00"))
+        health.record_success("1@N00")
+        self.assertEqual(health.state("1@N00"), SourceHealth.CLOSED)
+        health.close()
+
+    def test_random_source(self):
+        health = SourceHealth("test-health.db", failure_threshold=1)
+        sources = [FakeSource("1@N00"), FakeSource("2@N00")]
+        health.record_failure("1@N00")
+        for i in range(0, 10):
+            self.assertEqual(hp.get_random_source(sources, health=health).get_flickr_id(), "2@N00")
+        with self.assertRaises(NoSourcesFoundException):
+            hp.get_random_source(sources, health=health, exclude=set([sources[1]]))
+        health.close()
+
+    def test_empty_pages_are_not_failures(self):
+        class EmptySource(FakeSource):
+            def get_random_image(self):
+                raise NoPhotosFoundException("No photos under the source's licenses")
+
+        config = ConfigParser()
+        config.read_dict({"flickr": {"flickr.max_attempts": "4"}})
+        health = SourceHealth("test-health.db", failure_threshold=2)
+        with self.assertRaises(Exception):
+            hp.find_and_post_image(config, [EmptySource("1@N00")], None, None, health=health)
+        self.assertTrue(health.is_available("1@N00"))
+        health.close()
+
+    def test_search_misses(self):
+        class SearchSource(FakeSource):
+            def __init__(self, flickr_id, ex):
+                FakeSource.__init__(self, flickr_id)
+                self.ex = ex
+                self.searches = 0
+
+            def get_random_search_image(self, text):
+                self.searches += 1
+                raise self.ex
+
+        class FakeSocial:
+            def post_text(self, status, respond_to_user=None, respond_to_id=None):
+                self.status = status
+
+        # A source without any match is not searched again for the reply, an album restricted source whose pick
+        # was outside its albums is
+        config = ConfigParser()
+        config.read_dict({"flickr": {"flickr.max_attempts": "6"}})
+        for ex, searches in ((NoSearchResultsException("User has no images matching search"), 1),
+                             (NoPhotosFoundException("Found image is not part of valid album"), 6)):
+            source = SearchSource("1@N00", ex)
+            social = FakeSocial()
+            hp.find_and_post_image(config, [source], None, social, search_term="saturn", respond_to_id=1)
+            self.assertEqual(source.searches, searches)
+            self.assertEqual(social.status, "Couldn't find your image. Try again!")
+
+
+class TestStatusProbes(unittest.TestCase):
+
+    def test_run_probes(self):
+        def fail():
+            raise Exception("Down")
+
+        probes = [
+            ("Slow", lambda: time.sleep(5)),
+            ("Fast", lambda: ["Fast: OK", "Fast Test: OK"]),
+            ("Broken", fail)
+        ]
+        start = time.time()
+        conditions = hp.run_probes(probes, 0.5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(conditions, ["Slow: TIMEOUT", "Fast: OK", "Fast Test: OK", "Broken: FAIL"])
+
+
+class TestGroupSource(unittest.TestCase):
+
+    def setUp(self):
+        self.cdn = FakeImageCDN(payload_size=100).start()
+        self.server = FakeFlickr(self.cdn, photos_per_user=250000).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        config = ConfigParser()
+        config.read_dict({
+            "flickr": {"flickr.key": "test", "flickr.secret": "test", "flickr.page_size": "100"},
+            "ratelimit": {"ratelimit.calls_per_hour": "0"},
+            "cache": {"cache.max_size_mb": "0"}
+        })
+        self.flickr = hp.Flickr(config)
+
+    def tearDown(self):
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+
+    def test_sources_file(self):
+        entries = hp.build_source_entries(b"sources:\n  - group_id: 123@N01\n    licenses: [4, 9]\n  - flickr_id: 1@N00\n")
+        self.assertEqual(entries[0], {"group_id": "123@N01", "licenses": ["4", "9"]})
+        self.assertEqual(hp.get_source_entry_id(entries[0]), "123@N01")
+        with self.assertRaises(Exception):
+            hp.build_source_entries(b"sources:\n  - group_id: 123@N01\n    flickr_id: 1@N00\n")
+
+    def test_single_page_sampling(self):
+        source = GroupSource({"group_id": "123@N01", "licenses": ["4", "9"]}, self.flickr)
+        self.assertEqual(source.get_pool_count(), 250000)
+        requests = self.server.requests
+        image = source.get_random_image()
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertIn(image["license"], ("4", "9"))
+        self.assertEqual(source.get_flickr_username(), "User 123@N01")
+
+        source = GroupSource({"group_id": "123@N01", "licenses": ["99"]}, self.flickr)
+        with self.assertRaises(NoPhotosFoundException):
+            source.get_random_image()
+
+
+class FakeIndexedSource(FakeSource):
+
+    def __init__(self, flickr_id, albums=None):
+        FakeSource.__init__(self, flickr_id)
+        self.albums = albums
+
+    def user_has_albums(self):
+        return self.albums is not None
+
+    def get_album_list(self):
+        return self.albums
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-index.db"):
+            os.unlink("test-index.db")
+        self.cdn = FakeImageCDN(payload_size=100).start()
+        self.server = FakeFlickr(self.cdn, photos_per_user=1200, albums_per_user=4).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        config = ConfigParser()
+        config.read_dict({
+            "flickr": {"flickr.key": "test", "flickr.secret": "test", "flickr.page_size": "100"},
+            "ratelimit": {"ratelimit.calls_per_hour": "0"},
+            "cache": {"cache.max_size_mb": "0"}
+        })
+        self.flickr = hp.Flickr(config)
+
+    def tearDown(self):
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+        if os.path.exists("test-index.db"):
+            os.unlink("test-index.db")
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("The <b>Pillars</b> of Creation, M16"), ["pillars", "of", "creation", "m16"])
+
+    def test_incremental_update(self):
+        index = SearchIndex("test-index.db")
+        source = FakeIndexedSource("1@N00")
+        limit = SearchIndex.SEARCH_RESULT_LIMIT
+        SearchIndex.SEARCH_RESULT_LIMIT = 1000
+        try:
+            index.update(self.flickr, [source])
+        finally:
+            SearchIndex.SEARCH_RESULT_LIMIT = limit
+        self.assertTrue(index.is_indexed("1@N00"))
+        self.assertEqual(len(index.search("saturn")["1@N00"]), 1200)
+        self.assertEqual(index.search("photo 7 of"), {"1@N00": [self.server.photo("1@N00", 7)["id"]]})
+        self.assertEqual(index.get_photo("1@N00", self.server.photo("1@N00", 7)["id"])["title"], "Photo 7 of 1@N00")
+
+        # Only the newest uploads are fetched by a later run
+        index.close()
+        index = SearchIndex("test-index.db")
+        self.server.photos_per_user = 1300
+        requests = self.server.requests
+        index.update(self.flickr, [source])
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(len(index.search("saturn")["1@N00"]), 1300)
+        self.assertEqual(index.search("pluto"), {})
+        index.close()
+
+    def test_albums_and_picking(self):
+        index = SearchIndex("test-index.db")
+        sources = [FakeIndexedSource("1@N00", albums=["72157700000000001"]), FakeIndexedSource("2@N00")]
+        index.update(self.flickr, sources)
+        self.assertEqual(len(index.search("saturn")["1@N00/72157700000000001"]), 300)
+
+        source, image = hp.find_indexed_image(index, sources, "photo 7", health=None)
+        self.assertIsNotNone(image)
+        self.assertIn(image["title"], ("Photo 7 of 72157700000000001", "Photo 7 of 2@N00"))
+        self.assertEqual(hp.find_indexed_image(index, sources, "pluto"), (None, None))
+        index.close()
+
+    def test_bots_sharing_an_account(self):
+        index = SearchIndex("test-index.db")
+        photostream = FakeIndexedSource("1@N00")
+        album = FakeIndexedSource("1@N00", albums=["72157700000000001"])
+        index.update(self.flickr, [photostream])
+        index.update(self.flickr, [album])
+        self.assertEqual(len(index.search("saturn")["1@N00"]), 1200)
+        self.assertEqual(len(index.search("saturn")["1@N00/72157700000000001"]), 300)
+
+        for i in range(0, 10):
+            source, image = hp.find_indexed_image(index, [album], "photo 7")
+            self.assertIs(source, album)
+            self.assertEqual(image["title"], "Photo 7 of 72157700000000001")
+        index.close()
+
+
+class TestBotHosting(unittest.TestCase):
+
+    def test_bot_config(self):
+        config = ConfigParser()
+        config.read_dict({
+            "mastodon": {"mastodon.baseurl": "https://example.social", "mastodon.access_token": "shared"},
+            "history": {"history.window_hours": "24"},
+            "bot.cosmos": {"bot.sources": "cosmos.yaml", "mastodon.access_token": "cosmos", "history.window_hours": "48"},
+            "bot.planets": {"bot.sources": "planets.yaml"}
+        })
+        self.assertEqual(hp.get_bot_names(config, "all"), ["cosmos", "planets"])
+        self.assertEqual(hp.get_bot_names(config, "planets, cosmos"), ["planets", "cosmos"])
+
+        bot_config = hp.get_bot_config(config, "cosmos")
+        self.assertEqual(bot_config.get("mastodon", "mastodon.access_token"), "cosmos")
+        self.assertEqual(bot_config.get("mastodon", "mastodon.baseurl"), "https://example.social")
+        self.assertEqual(bot_config.getfloat("history", "history.window_hours"), 48)
+        self.assertEqual(bot_config.get("bot", "bot.sources"), "cosmos.yaml")
+        self.assertFalse(bot_config.has_section("bot.planets"))
+        self.assertEqual(hp.get_bot_config(config, "planets").get("mastodon", "mastodon.access_token"), "shared")
+        with self.assertRaises(Exception):
+            hp.get_bot_config(config, "missing")
+
+    def test_bot_status_check(self):
+        config = ConfigParser()
+        config.read_dict({
+            "health": {"health.failure_threshold": "0"},
+            "status": {"status.cache_ttl": "0", "status.timeout": "5"},
+            "bot.cosmos": {"bot.sources": "test-cosmos.yaml", "bot.translations": "test-missing.yaml"}
+        })
+        with open("test-cosmos.yaml", "w") as f:
+            f.write("sources:\n  - flickr_id: 1@N00\n  - flickr_id: 2@N00\n")
+        try:
+            bot_config = hp.get_bot_config(config, "cosmos")
+            status = hp.validate(bot_config, hp.get_bot_options(bot_config, "cosmos", argparse.Namespace(
+                translations="translations.yaml", respond=True, post=False, update_index=False)))
+        finally:
+            for path in ("test-cosmos.yaml", Snapshot.path_for("test-cosmos.yaml")):
+                if os.path.exists(path):
+                    os.unlink(path)
+        self.assertIn("Sources: OK", status)
+        self.assertIn("Translations: FAIL", status)
+
+    def test_shared_image_store(self):
+        cdn = FakeImageCDN(payload_size=1000).start()
+        store = ImageStore("test-image-store", 1500)
+        try:
+            for i in range(0, 2):
+                store.fetch(cdn.image_url("1"), "test-image.jpg")
+            self.assertEqual(cdn.requests, 1)
+            self.assertEqual(os.path.getsize("test-image.jpg"), 1000)
+            store.fetch(cdn.image_url("2"), "test-image.jpg")
+            store.evict()
+            self.assertEqual(os.listdir("test-image-store"), [os.path.basename(store.path_for(cdn.image_url("2")))])
+        finally:
+            cdn.stop()
+            for name in os.listdir("test-image-store"):
+                os.unlink(os.path.join("test-image-store", name))
+            os.rmdir("test-image-store")
+            os.unlink("test-image.jpg")
+
+
+@unittest.skipIf(importlib.util.find_spec("PIL") is None, "Pillow is not installed")
+class TestTranscode(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+        image = Image.effect_noise((1200, 900), 64).convert("RGB")
+        exif = Image.Exif()
+        exif[0x010f] = "Test Camera"
+        image.save("test-transcode.jpg", "JPEG", quality=100, exif=exif)
+        self.transcoder = Transcoder("test-transcoded", 10 * 1024 * 1024,
+                                     profiles={"twitter": {"max_bytes": 200000, "max_pixels": 640 * 480}})
+
+    def tearDown(self):
+        for name in os.listdir("test-transcoded"):
+            os.unlink(os.path.join("test-transcoded", name))
+        os.rmdir("test-transcoded")
+        os.unlink("test-transcode.jpg")
+
+    def test_prepare(self):
+        from PIL import Image
+        self.assertFalse(self.transcoder.fits("test-transcode.jpg", "twitter"))
+        self.assertTrue(self.transcoder.fits("test-transcode.jpg", "mastodon"))
+        self.assertTrue(self.transcoder.prepare("test-transcode.jpg", "1", "twitter"))
+        self.assertTrue(self.transcoder.fits("test-transcode.jpg", "twitter"))
+        with Image.open("test-transcode.jpg") as image:
+            self.assertEqual(len(image.getexif()), 0)
+            self.assertLessEqual(image.width * image.height, 640 * 480)
+        self.assertFalse(self.transcoder.prepare("test-transcode.jpg", "1", "twitter"))
+
+    def test_unreachable_limit(self):
+        transcoder = Transcoder("test-transcoded", 10 * 1024 * 1024, profiles={"twitter": {"max_bytes": 100}})
+        with self.assertRaises(TranscodeException):
+            transcoder.prepare("test-transcode.jpg", "1", "twitter")
+        self.assertEqual(os.listdir("test-transcoded"), [])
+
+    def test_cache(self):
+        self.transcoder.prepare("test-transcode.jpg", "1", "twitter")
+        self.setUp()
+        Metrics.reset()
+        self.assertTrue(self.transcoder.prepare("test-transcode.jpg", "1", "twitter"))
+        counters = Metrics.snapshot()["counters"]
+        self.assertEqual([counter["name"] for counter in counters], ["transcode_cache_hits_total"])
+        Metrics.reset()
+        self.assertEqual(len(os.listdir("test-transcoded")), 1)
+
+
+class TestChunkedUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeTwitter().start()
+        self.twitter_api = twitter.TwitterAPI
+        benchmark.LocalTwitterAPI.base_url = self.server.url
+        twitter.TwitterAPI = benchmark.LocalTwitterAPI
+        config = ConfigParser()
+        config.read_dict({
+            "twitter": {"twitter.consumer_key": "test", "twitter.consumer_secret": "test", "twitter.access_token": "test",
+                        "twitter.access_secret": "test", "twitter.upload_chunk_kb": "1", "twitter.upload_retries": "1"}
+        })
+        self.twitter = twitter.Twitter(config)
+        with open("test-upload.jpg", "wb") as f:
+            f.write(os.urandom(3000))
+
+    def tearDown(self):
+        twitter.TwitterAPI = self.twitter_api
+        self.server.stop()
+        for path in ("test-upload.jpg", "test-upload.jpg.upload"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_resume(self):
+        self.server.failing_segments = set([2])
+        with self.assertRaises(PublishException) as cm:
+            self.twitter.publish("Saturn", image_path="test-upload.jpg")
+        self.assertFalse(cm.exception.permanent)
+        self.assertEqual(self.server.commands, [("INIT", None), ("APPEND", "0"), ("APPEND", "1"), ("APPEND", "2"), ("APPEND", "2")])
+        self.assertTrue(os.path.exists("test-upload.jpg.upload"))
+
+        self.server.failing_segments = set()
+        self.server.commands = []
+        self.twitter.publish("Saturn", image_path="test-upload.jpg")
+        self.assertEqual(self.server.commands, [("APPEND", "2"), ("FINALIZE", None)])
+        self.assertEqual(self.server.uploads, [3000])
+        self.assertEqual(len(self.server.statuses), 1)
+        self.assertFalse(os.path.exists("test-upload.jpg.upload"))
+
+    def test_changed_file_restarts(self):
+        self.server.failing_segments = set([1])
+        with self.assertRaises(PublishException):
+            self.twitter.upload_media("test-upload.jpg")
+        with open("test-upload.jpg", "wb") as f:
+            f.write(os.urandom(1500))
+        self.server.failing_segments = set()
+        self.server.commands = []
+        self.twitter.upload_media("test-upload.jpg")
+        self.assertEqual(self.server.commands, [("INIT", None), ("APPEND", "0"), ("APPEND", "1"), ("FINALIZE", None)])
+        self.assertEqual(self.server.uploads, [1500])
+
+
+class TestMastodonMedia(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeMastodon(processing_polls=2).start()
+        with open("test-media.jpg", "wb") as f:
+            f.write(os.urandom(2000))
+
+    def tearDown(self):
+        self.server.stop()
+        os.unlink("test-media.jpg")
+
+    def make_client(self, media_timeout):
+        config = ConfigParser()
+        config.read_dict({
+            "mastodon": {"mastodon.baseurl": self.server.url, "mastodon.access_token": "test",
+                         "mastodon.media_poll_interval": "0.01", "mastodon.media_timeout": media_timeout}
+        })
+        return mstdn.MastodonClient(config)
+
+    def test_waits_for_processing(self):
+        self.make_client("5").publish("Saturn", image_path="test-media.jpg", alt_text="Rings")
+        self.assertEqual(self.server.media_polls, 3)
+        self.assertEqual(len(self.server.statuses), 1)
+
+    def test_processing_timeout(self):
+        self.server.processing_polls = 1000
+        with self.assertRaises(PublishException) as cm:
+            self.make_client("0.1").publish("Saturn", image_path="test-media.jpg")
+        self.assertFalse(cm.exception.permanent)
+        self.assertEqual(len(self.server.statuses), 0)
+
+
+class TestPooledClients(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeTwitter().start()
+        self.twitter_api = twitter.TwitterAPI
+        benchmark.LocalTwitterAPI.base_url = self.server.url
+        twitter.TwitterAPI = benchmark.LocalTwitterAPI
+        self.config = ConfigParser()
+        self.config.read_dict({
+            "twitter": {"twitter.consumer_key": "test", "twitter.consumer_secret": "test", "twitter.access_token": "test",
+                        "twitter.access_secret": "test"}
+        })
+
+    def tearDown(self):
+        hp.close_social_clients()
+        twitter.TwitterAPI = self.twitter_api
+        self.server.stop()
+
+    def test_connections_reused(self):
+        social = hp.create_social(self.config, "twitter")
+        self.assertIs(hp.create_social(self.config, "Twitter"), social)
+        for i in range(0, 3):
+            self.assertTrue(hp.check_social(self.config, "twitter")[1].endswith("OK"))
+        social.publish("Saturn")
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(self.server.connections, 1)
+
+        other = ConfigParser()
+        other.read_dict({"twitter": dict(self.config.items("twitter"), **{"twitter.access_token": "other"})})
+        self.assertIsNot(hp.create_social(other, "twitter"), social)
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.cdn = FakeImageCDN(payload_size=500, latency=0.05).start()
+        self.server = FakeFlickr(self.cdn).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        self.config = ConfigParser()
+        self.config.read_dict({
+            "flickr": {"flickr.key": "secret-key", "flickr.secret": "test", "flickr.page_size": "100"},
+            "ratelimit": {"ratelimit.calls_per_hour": "0"},
+            "cache": {"cache.max_size_mb": "0"},
+            "images": {"images.max_size_mb": "0"}
+        })
+
+    def tearDown(self):
+        hp.Util.use_cassette(None)
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+        for path in ("test-run.cassette", "test-image.jpg"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def run_once(self):
+        flickr = hp.Flickr(self.config)
+        source = hp.Source({"flickr_id": "1@N00"}, flickr)
+        image = source.get_random_image()
+        flickr.fetch_image_to_path(image["url_z"], "test-image.jpg")
+        with open("test-image.jpg", "rb") as f:
+            return image, f.read()
+
+    def test_record_and_replay(self):
+        from cassette import Cassette, CassetteException
+
+        hp.Util.use_cassette(Cassette.record("test-run.cassette"))
+        recorded = self.run_once()
+        hp.Util.cassette.close()
+        requests = self.server.requests + self.cdn.requests
+        with gzip.open("test-run.cassette", "rt") as f:
+            self.assertNotIn("secret-key", f.read())
+
+        hp.Util.use_cassette(Cassette.replay("test-run.cassette", scale=0))
+        start = time.time()
+        self.assertEqual(self.run_once(), recorded)
+        self.assertLess(time.time() - start, 0.05)
+        self.assertEqual(self.server.requests + self.cdn.requests, requests)
+        with self.assertRaises(CassetteException):
+            hp.Flickr(self.config).get_user_info("1@N00")
+
+
+class TestLog(unittest.TestCase):
+
+    def tearDown(self):
+        Log.shutdown()
+        for name in os.listdir("."):
+            if name.startswith("test-log.json"):
+                os.unlink(name)
+
+    def test_json_rotation(self):
+        config = ConfigParser()
+        config.read_dict({
+            "logging": {"logging.path": "test-log.json", "logging.format": "json", "logging.max_size_mb": "0.01",
+                        "logging.backup_count": "2", "logging.levels": "test:WARNING"}
+        })
+        Log.configure(config)
+        logger = get_logger("source")
+        for i in range(0, 200):
+            logger.info("Selected page %d", i, extra={"flickr_id": "1@N00", "page": i})
+        get_logger("test").info("Not written")
+        Log.shutdown()
+
+        self.assertEqual(sorted(name for name in os.listdir(".") if name.startswith("test-log.json")),
+                         ["test-log.json", "test-log.json.1", "test-log.json.2"])
+        for name in ("test-log.json", "test-log.json.1"):
+            self.assertLessEqual(os.path.getsize(name), 0.01 * 1024 * 1024)
+        with open("test-log.json") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[-1]["message"], "Selected page 199")
+        self.assertEqual(lines[-1]["logger"], "source")
+        self.assertEqual(lines[-1]["page"], 199)
+        self.assertEqual(lines[-1]["flickr_id"], "1@N00")
+
+
+class TestMentionLimiter(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-mentions.db"):
+            os.unlink("test-mentions.db")
+
+    tearDown = setUp
+
+    def test_decisions(self):
+        limiter = MentionLimiter("test-mentions.db", "twitter", user_per_hour=1, user_burst=2, per_hour=1, burst=3)
+        self.assertEqual(limiter.check("spammer", "saturn"), MentionLimiter.ADMIT)
+        limiter.record("spammer", "saturn")
+        self.assertEqual(limiter.check("Spammer", "Saturn"), MentionLimiter.DUPLICATE)
+        self.assertEqual(limiter.check("spammer", "mars"), MentionLimiter.ADMIT)
+        self.assertEqual(limiter.check("spammer", "jupiter"), MentionLimiter.USER_LIMITED)
+        self.assertEqual(limiter.check("alice"), MentionLimiter.ADMIT)
+        limiter.record("alice")
+        self.assertEqual(limiter.check("bob"), MentionLimiter.SHED)
+        limiter.close()
+
+        # One-shot runs share the buckets and recent requests. Requests that were not answered with an image, like
+        # spammer's mars or bob's shed one, are not duplicates, and the shed one kept bob's tokens.
+        limiter = MentionLimiter("test-mentions.db", "twitter", user_per_hour=1, user_burst=2, per_hour=1, burst=3)
+        self.assertEqual(limiter.check("alice"), MentionLimiter.DUPLICATE)
+        self.assertEqual(limiter.check("spammer", "mars"), MentionLimiter.USER_LIMITED)
+        for i in range(0, 3):
+            self.assertEqual(limiter.check("bob"), MentionLimiter.SHED)
+        limiter.close()
+
+    def test_respond_to_mention(self):
+        class FakeSocial:
+            def __init__(self):
+                self.posts = []
+
+            def post_text(self, status, respond_to_user=None, respond_to_id=None):
+                self.posts.append(status)
+
+        limiter = MentionLimiter("test-mentions.db", "twitter", user_per_hour=0, per_hour=1, burst=1)
+        limiter.check("alice", "mars")
+        social = FakeSocial()
+        translations = {"translations": {"please": ["please"], "of": ["of"]}}
+        mention = {"text": "A picture of saturn please", "status_id": 1, "user": {"screen_name": "bob"}}
+        self.assertTrue(hp.respond_to_mention(None, [], translations, None, social, mention, limiter=limiter))
+        self.assertEqual(social.posts, [hp.BUSY_REPLY])
+        # A shed request is answered as busy again when it is repeated
+        mention["status_id"] = 2
+        self.assertTrue(hp.respond_to_mention(None, [], translations, None, social, mention, limiter=limiter))
+        self.assertEqual(social.posts, [hp.BUSY_REPLY, hp.BUSY_REPLY])
+        limiter.close()
+
+
+class TestApiKeyPool(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-keys.db"):
+            os.unlink("test-keys.db")
+        self.cdn = FakeImageCDN(payload_size=100).start()
+        self.server = FakeFlickr(self.cdn).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        self.config = ConfigParser()
+        self.config.read_dict({
+            "flickr": {"flickr.keys": "key-a, key-b, key-c", "flickr.secret": "test", "flickr.page_size": "100"},
+            "ratelimit": {"ratelimit.path": "test-keys.db", "ratelimit.calls_per_hour": "1", "ratelimit.burst": "2",
+                          "ratelimit.max_wait": "0"},
+            "cache": {"cache.max_size_mb": "0"}
+        })
+
+    def tearDown(self):
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+        if os.path.exists("test-keys.db"):
+            os.unlink("test-keys.db")
+
+    def test_rotation(self):
+        flickr = hp.Flickr(self.config)
+        for i in range(0, 6):
+            self.assertTrue(flickr.verify_credentials())
+        self.assertEqual(self.server.key_requests, {"key-a": 2, "key-b": 2, "key-c": 2})
+        # Every key's bucket is empty
+        with self.assertRaises(RateLimitExceededException):
+            flickr.verify_credentials()
+        self.assertNotIn("key-a", str(flickr.keys.usage()))
+        self.assertEqual([key["requests"] for key in flickr.keys.usage()], [2, 2, 2])
+        flickr.close()
+
+    def test_unhealthy_keys_leave_rotation(self):
+        self.config.set("ratelimit", "ratelimit.calls_per_hour", "0")
+        self.server.invalid_keys.add("key-b")
+        self.server.throttled_keys.add("key-c")
+        flickr = hp.Flickr(self.config)
+        for i in range(0, 6):
+            flickr.verify_credentials()
+        self.assertEqual(self.server.key_requests, {"key-a": 4, "key-b": 1, "key-c": 1})
+        self.assertEqual([key["available"] for key in flickr.keys.usage()], [True, False, False])
+        self.assertEqual([key["errors"] for key in flickr.keys.usage()], [0, 1, 1])
+        flickr.close()
+
+        # A later run leaves the same keys out of rotation without trying them
+        flickr = hp.Flickr(self.config)
+        self.assertEqual([key["available"] for key in flickr.keys.usage()], [True, False, False])
+        flickr.verify_credentials()
+        self.assertEqual(self.server.key_requests, {"key-a": 5, "key-b": 1, "key-c": 1})
+        flickr.close()
+
+        # A single key keeps working through its errors
+        self.config.set("flickr", "flickr.keys", "key-b")
+        flickr = hp.Flickr(self.config)
+        flickr.verify_credentials()
+        flickr.verify_credentials()
+        self.assertEqual(self.server.key_requests["key-b"], 3)
+
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists("test-hedge.db"):
+            os.unlink("test-hedge.db")
+        self.cdn = FakeImageCDN(payload_size=100).start()
+        self.server = FakeFlickr(self.cdn).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        self.config = ConfigParser()
+        self.config.read_dict({
+            "flickr": {"flickr.key": "test", "flickr.secret": "test", "flickr.page_size": "100",
+                       "flickr.read_timeout": "0.3"},
+            "ratelimit": {"ratelimit.path": "test-hedge.db", "ratelimit.calls_per_hour": "1", "ratelimit.burst": "2",
+                          "ratelimit.max_wait": "0"},
+            "cache": {"cache.max_size_mb": "0"},
+            "images": {"images.max_size_mb": "0"}
+        })
+
+    def tearDown(self):
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+        for path in ("test-hedge.db", "test-image.jpg"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_timeout(self):
+        import requests
+
+        flickr = hp.Flickr(self.config)
+        self.server.stalls.append(2.0)
+        start = time.time()
+        with self.assertRaises(requests.exceptions.Timeout):
+            flickr.verify_credentials()
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_hedged_requests(self):
+        self.config.read_dict({"hedge": {"hedge.enabled": "true", "hedge.flickr.initial_delay": "0.1",
+                                         "hedge.image.initial_delay": "0.1"},
+                               "flickr": {"flickr.read_timeout": "5"}})
+        flickr = hp.Flickr(self.config)
+        self.server.stalls.append(1.0)
+        start = time.time()
+        self.assertTrue(flickr.verify_credentials())
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(self.server.requests, 2)
+        # The duplicate drew the second token of the bucket
+        with self.assertRaises(RateLimitExceededException):
+            flickr.verify_credentials()
+
+        self.cdn.stalls.append(1.0)
+        start = time.time()
+        flickr.fetch_image_to_path(self.cdn.image_url("1"), "test-image.jpg")
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(os.path.getsize("test-image.jpg"), 100)
+        self.assertEqual(self.cdn.requests, 2)
+        flickr.close()
+
+    def test_hedged_throttling(self):
+        # The hedged attempt records the 429 from a worker thread, which penalizes the rate limit bucket
+        self.config.read_dict({"hedge": {"hedge.enabled": "true"}})
+        self.server.throttled_keys.add("test")
+        flickr = hp.Flickr(self.config)
+        self.assertFalse(flickr.verify_credentials())
+        with self.assertRaises(RateLimitExceededException):
+            flickr.verify_credentials()
+        flickr.close()
+
+    def test_delay_follows_latency(self):
+        hedger = Hedger("test", quantile=0.9, initial_delay=1.0, min_delay=0.01, min_samples=10)
+        self.assertEqual(hedger.delay(), 1.0)
+        for i in range(0, 10):
+            self.assertEqual(hedger.call(lambda arg: arg, i), i)
+        self.assertEqual(hedger.delay(), 0.01)
+
+        # Failed attempts count towards the latencies too
+        def fail(arg):
+            time.sleep(0.05)
+            raise IOError("timed out")
+        for i in range(0, 10):
+            with self.assertRaises(IOError):
+                hedger.call(fail, i)
+        self.assertGreaterEqual(hedger.delay(), 0.05)
+        hedger.close()
+
+
+class TestProjectedParsing(unittest.TestCase):
+
+    def setUp(self):
+        for path in ("test-parse.db", "test-parse.db-wal", "test-parse.db-shm"):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.cdn = FakeImageCDN(payload_size=100).start()
+        self.server = FakeFlickr(self.cdn).start()
+        self.rest_base_url = hp.Flickr.REST_BASE_URL
+        hp.Flickr.REST_BASE_URL = self.server.rest_url
+        self.config = ConfigParser()
+        self.config.read_dict({
+            "flickr": {"flickr.key": "test", "flickr.secret": "test", "flickr.page_size": "100",
+                       "flickr.image_url_attribute": "url_l"},
+            "ratelimit": {"ratelimit.calls_per_hour": "0"},
+            "cache": {"cache.path": "test-parse.db"}
+        })
+
+    def tearDown(self):
+        hp.Flickr.REST_BASE_URL = self.rest_base_url
+        self.server.stop()
+        self.cdn.stop()
+        for path in ("test-parse.db", "test-parse.db-wal", "test-parse.db-shm"):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_listing_is_projected(self):
+        flickr = hp.Flickr(self.config)
+        page = flickr.get_photostream("1@N00")
+        self.assertEqual(len(page["photos"]["photo"]), 100)
+        self.assertEqual(page["photos"]["total"], "1000")
+        photo = page["photos"]["photo"][0]
+        self.assertEqual(sorted(photo.keys()), sorted(PHOTO_FIELDS + ("url_l",)))
+        self.assertEqual(flickr.make_image_link(photo), "https://www.flickr.com/photos/1@N00/%s" % photo["id"])
+
+        # Cached pages are stored projected
+        requests = self.server.requests
+        self.assertEqual(flickr.get_photostream("1@N00"), page)
+        self.assertEqual(self.server.requests, requests)
+
+        self.config.set("flickr", "flickr.project_fields", "false")
+        self.config.set("cache", "cache.max_size_mb", "0")
+        photo = hp.Flickr(self.config).get_photostream("1@N00")["photos"]["photo"][0]
+        self.assertIn("width_o", photo)
+
+    def test_codecs_agree(self):
+        body = json.dumps({"photos": self.server.page_of("1@N00", 10, 1, 10), "stat": "ok"})
+        self.assertEqual(FastJson.loads(body.encode("utf-8")), json.loads(body))
+        self.assertEqual(json.loads(FastJson.dumps(json.loads(body))), json.loads(body))
+
+
 class TestSearchTermMatching(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,119 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+class Span:
+    """
+    A timed region of a run. Trace viewers nest spans of the same thread by their start and end times.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        Trace.record(self, duration)
+        return False
+
+
+class NullSpan:
+    """
+    Span used when tracing is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class Trace:
+    """
+    Records timed spans of a run and writes them in the Chrome trace event format, which can be loaded into
+    chrome://tracing or https://ui.perfetto.dev. Spans cost almost nothing while tracing is disabled.
+    """
+
+    __enabled = False
+    __origin = 0.0
+    __events = []
+    __null_span = NullSpan()
+
+    @staticmethod
+    def enable():
+        Trace.__enabled = True
+        Trace.__origin = time.perf_counter()
+        Trace.__events = []
+
+    @staticmethod
+    def is_enabled():
+        return Trace.__enabled
+
+    @staticmethod
+    def span(name, **args):
+        """
+        Opens a span, to be used as a context manager
+        :param name: Name of the stage
+        :param args: Extra values to attach to the span
+        """
+        if not Trace.__enabled:
+            return Trace.__null_span
+        return Span(name, args)
+
+    @staticmethod
+    def record(span, duration):
+        Trace.__events.append({
+            "name": span.name,
+            "ph": "X",
+            "ts": round((span.start - Trace.__origin) * 1000000.0, 1),
+            "dur": round(duration * 1000000.0, 1),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict((k, str(v)) for k, v in span.args.items())
+        })
+
+    @staticmethod
+    def write(path):
+        """
+        Writes the recorded spans as a Chrome trace file
+        :param path: Output file path
+        """
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": sorted(Trace.__events, key=lambda e: e["ts"]),
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "argv": " ".join(sys.argv),
+                    "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - (time.perf_counter() - Trace.__origin)))
+                }
+            }, f)
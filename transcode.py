@@ -0,0 +1,158 @@
+"""
+Copyright 2021 Kevin M. Gill
+Twitter: @kevinmgill
+Instagram: @apoapsys
+Flickr: https://www.flickr.com/photos/kevinmgill/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import importlib.util
+
+from imagestore import ImageStore
+from metrics import Metrics
+from tracing import Trace
+from log import get_logger
+
+logger = get_logger("transcode")
+
+# Upload limits of each destination
+PROFILES = {
+    "twitter": {"max_bytes": 5 * 1024 * 1024, "max_pixels": 8192 * 8192},
+    "mastodon": {"max_bytes": 8 * 1024 * 1024, "max_pixels": 3840 * 2160}
+}
+
+JPEG_QUALITIES = (90, 85, 80, 70, 60)
+
+# Images are not downscaled below this many pixels on their shorter edge
+MIN_EDGE = 64
+
+
+class TranscodeException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def transcode_image(source_path, dest_path, max_bytes, max_pixels):
+    """
+    Downscales and re-encodes an image as a JPEG without metadata until it fits the limits
+    :param source_path: The downloaded image
+    :param dest_path: Where the transcoded image is written
+    :param max_bytes: Maximum encoded size
+    :param max_pixels: Maximum width times height
+    :return: The encoded size
+    :raises TranscodeException: If the image does not fit max_bytes even at the lowest quality and MIN_EDGE
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+
+    if image.width * image.height > max_pixels:
+        scale = (float(max_pixels) / (image.width * image.height)) ** 0.5
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+    tmp_path = "%s.%d.tmp" % (dest_path, os.getpid())
+    while True:
+        for quality in JPEG_QUALITIES:
+            # Saving without exif or icc_profile drops the metadata
+            image.save(tmp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+            size = os.path.getsize(tmp_path)
+            if size <= max_bytes:
+                os.replace(tmp_path, dest_path)
+                return size
+        if min(image.width, image.height) * 0.75 < MIN_EDGE:
+            os.unlink(tmp_path)
+            raise TranscodeException("Image does not fit in %d bytes at %dx%d" % (max_bytes, image.width, image.height))
+        image = image.resize((max(1, int(image.width * 0.75)), max(1, int(image.height * 0.75))), Image.LANCZOS)
+
+
+class Transcoder:
+    """
+    Shrinks downloaded images that are over a destination's upload limits before they are posted. Images that
+    fit are recognized from their header alone. The work runs in the calling thread, Pillow releasing the
+    interpreter lock while it resizes and encodes, and results are cached per photo and destination so a photo
+    posted again, or by several bots, is only transcoded once.
+    """
+
+    def __init__(self, cache_path, max_cache_bytes, profiles=None):
+        self.__cache = ImageStore(cache_path, max_cache_bytes)
+        self.__stores = 0
+        self.__profiles = dict((name, dict(profile)) for name, profile in PROFILES.items())
+        if profiles is not None:
+            for name, profile in profiles.items():
+                self.__profiles.setdefault(name, {}).update(profile)
+
+    @staticmethod
+    def from_config(config):
+        """
+        Builds a transcoder from the [transcode] section of the configuration
+        :param config: A configuration instance
+        :return: A transcoder, or None if transcoding is disabled or Pillow is not installed
+        """
+        if not config.getboolean("transcode", "transcode.enabled", fallback=True):
+            return None
+        if importlib.util.find_spec("PIL") is None:
+            logger.warning("Pillow is not installed, images will be posted without transcoding")
+            return None
+
+        profiles = {}
+        for name in PROFILES.keys():
+            for limit in ("max_bytes", "max_pixels"):
+                key = "transcode.%s.%s" % (name, limit)
+                if config.has_option("transcode", key):
+                    profiles.setdefault(name, {})[limit] = config.getint("transcode", key)
+        return Transcoder(config.get("transcode", "transcode.cache_path", fallback="transcoded"),
+                          int(config.getfloat("transcode", "transcode.cache_max_size_mb", fallback=128) * 1024 * 1024),
+                          profiles=profiles)
+
+    def fits(self, path, destination):
+        """
+        Checks whether an image is within a destination's limits, reading only the image header
+        """
+        from PIL import Image
+
+        profile = self.__profiles[destination]
+        if os.path.getsize(path) > profile["max_bytes"]:
+            return False
+        with Image.open(path) as image:
+            return image.width * image.height <= profile["max_pixels"]
+
+    def prepare(self, path, photo_id, destination):
+        """
+        Replaces a downloaded image with a version that fits a destination's limits, if it does not already fit
+        :param path: The downloaded image, rewritten in place
+        :param photo_id: The Flickr photo id, which keys the cache
+        :param destination: Destination social media name
+        :return: True if the image was replaced
+        :raises TranscodeException: If the image cannot be made to fit
+        """
+        if destination not in self.__profiles or self.fits(path, destination):
+            return False
+
+        profile = self.__profiles[destination]
+        cached_path = self.__cache.path_for("%s/%s/%d/%d" % (photo_id, destination, profile["max_bytes"], profile["max_pixels"]))
+        if os.path.exists(cached_path):
+            Metrics.increment("transcode_cache_hits_total", destination=destination)
+            os.utime(cached_path)
+        else:
+            with Metrics.timer("transcode", destination=destination), Trace.span("transcode", destination=destination):
+                size = transcode_image(path, cached_path, profile["max_bytes"], profile["max_pixels"])
+            logger.info("Transcoded image %s for %s from %d to %d bytes", photo_id, destination, os.path.getsize(path), size)
+            self.__stores += 1
+            if self.__stores % ImageStore.EVICT_EVERY == 0:
+                self.__cache.evict()
+        shutil.copyfile(cached_path, path)
+        return True
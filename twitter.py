@@ -17,29 +17,66 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import sys
 import os
-import requests
-from configparser import ConfigParser
-import math
-import traceback
 import json
+import time
+
+import requests
 from TwitterAPI import TwitterAPI
-import argparse
-import re
-import yaml
+from TwitterAPI.constants import ENDPOINTS
+from TwitterAPI.TwitterError import TwitterConnectionError
 from util import Util
+from metrics import Metrics
+from tracing import Trace
+from outbox import PublishException
+from log import get_logger
+
+logger = get_logger("twitter")
+
 
 class Twitter:
     """
     Simplified proxy to TwitterAPI implementing functions required by the application
     """
 
+    destination = "twitter"
+
     def __init__(self, config):
         self.__api = TwitterAPI(config.get("twitter", "twitter.consumer_key"),
                                 config.get("twitter", "twitter.consumer_secret"),
                                 config.get("twitter", "twitter.access_token"),
                                 config.get("twitter", "twitter.access_secret"))
+        # TwitterAPI opens a new session for every request, so requests are sent on our own pooled session
+        self.__session = Util.make_session(pool_size=config.getint("twitter", "twitter.pool_size", fallback=4),
+                                           user_agent=self.__api.USER_AGENT)
+        self.__session.auth = self.__api.auth
+        self.__timeout = (config.getfloat("twitter", "twitter.connect_timeout", fallback=5),
+                          config.getfloat("twitter", "twitter.read_timeout", fallback=30))
+        self.__rate_limit_reset = None
+        self.__upload_chunk_size = int(config.getfloat("twitter", "twitter.upload_chunk_kb", fallback=1024) * 1024)
+        self.__upload_retries = config.getint("twitter", "twitter.upload_retries", fallback=2)
+
+    def __request(self, resource, params=None, files=None):
+        """
+        Issues a Twitter API request on the pooled session, recording its latency and failures
+        :raises TwitterConnectionError: If the request could not be sent or timed out
+        """
+        method, subdomain = ENDPOINTS[resource]
+        if isinstance(method, list):
+            method = method[0]
+        url = self.__api._prepare_url(subdomain, resource)
+        with Metrics.timer("social_request", destination="twitter", endpoint=resource), Trace.span("twitter_api", endpoint=resource):
+            try:
+                r = self.__session.request(method, url,
+                                           data=params if method == "POST" else None,
+                                           params=params if method != "POST" else None,
+                                           files=files,
+                                           timeout=self.__timeout)
+            except requests.exceptions.RequestException as ex:
+                raise TwitterConnectionError(ex)
+        if not 200 <= r.status_code < 300:
+            Metrics.increment("social_request_errors_total", destination="twitter", endpoint=resource)
+        return r
 
     def get_social_id_from_source(self, source):
         return  source.get_twitter_id()
@@ -49,34 +86,155 @@ class Twitter:
         Validates current API credentials
         :return: True if an HTTP status code of 200 is returned from Twitter
         """
-        r = self.__api.request('account/verify_credentials')
+        r = self.__request('account/verify_credentials')
         return r.status_code == 200
 
-    def post_text(self, status, respond_to_user=None, respond_to_id=None):
+    def __send(self, resource, params=None, files=None):
         """
-        Sends a text-only tweet
-        :param status: The tweet text to be posted
-        :param respond_to_user: User being responded to. None if not a response.
-        :param respond_to_id: Tweet being responded to. None if not a response.
-        :return: True if the Twitter API returned an HTTP 200 status.
+        Issues a publishing request, raising PublishException if it fails and remembering when the
+        destination's rate limit window resets if it has been used up
+        """
+        try:
+            r = self.__request(resource, params, files)
+        except TwitterConnectionError as ex:
+            raise PublishException("%s failed: %s" % (resource, ex))
+
+        if r.headers.get("x-rate-limit-remaining") == "0" and r.headers.get("x-rate-limit-reset") is not None:
+            self.__rate_limit_reset = float(r.headers["x-rate-limit-reset"])
+
+        if not 200 <= r.status_code < 300:
+            retry_after = None
+            if r.status_code == 429:
+                reset = r.headers.get("x-rate-limit-reset")
+                retry_after = max(0.0, float(reset) - time.time()) if reset is not None else 900.0
+            # Anything else in the 4xx range (duplicate status, text too long, bad credentials) fails again on retry
+            permanent = 400 <= r.status_code < 500 and r.status_code not in (408, 429)
+            raise PublishException("%s failed with HTTP %d: %s" % (resource, r.status_code, r.text), retry_after=retry_after, permanent=permanent)
+        return r
+
+    def get_rate_limit_reset(self):
         """
+        :return: The epoch time at which an exhausted rate limit resets, or None if requests can still be made
+        """
+        if self.__rate_limit_reset is not None and self.__rate_limit_reset > time.time():
+            return self.__rate_limit_reset
+        return None
+
+    @staticmethod
+    def __upload_state_path(image_path):
+        return "%s.upload" % image_path
+
+    def __load_upload_state(self, image_path):
+        """
+        :return: The progress of an earlier upload of the same file that can still be resumed, or None
+        """
+        state_path = Twitter.__upload_state_path(image_path)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        stat = os.stat(image_path)
+        if state.get("size") != stat.st_size or state.get("mtime") != stat.st_mtime or state.get("expires_at", 0) <= time.time():
+            return None
+        return state
+
+    @staticmethod
+    def __save_upload_state(image_path, state):
+        with open(Twitter.__upload_state_path(image_path), "w") as f:
+            json.dump(state, f)
+
+    @staticmethod
+    def __discard_upload_state(image_path):
+        state_path = Twitter.__upload_state_path(image_path)
+        if os.path.exists(state_path):
+            os.unlink(state_path)
+
+    def __append(self, media_id, segment_index, chunk):
+        """
+        Sends one chunk, retrying it on its own a few times before giving up on the attempt
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.__send('media/upload', {'command': 'APPEND', 'media_id': media_id, 'segment_index': segment_index}, {'media': chunk})
+            except PublishException as ex:
+                attempt += 1
+                if ex.permanent or ex.retry_after is not None or attempt > self.__upload_retries:
+                    raise
+                logger.warning("Retrying segment %d of media %s: %s", segment_index, media_id, ex)
+
+    def __upload(self, image_path, state, media_type):
+        if state is None:
+            stat = os.stat(image_path)
+            r = self.__send('media/upload', {'command': 'INIT', 'media_type': media_type, 'total_bytes': stat.st_size})
+            init = r.json()
+            state = {
+                "media_id": init["media_id_string"],
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "chunk_size": self.__upload_chunk_size,
+                "expires_at": time.time() + float(init.get("expires_after_secs", 86400)),
+                "segments": 0
+            }
+            Twitter.__save_upload_state(image_path, state)
+
+        # Chunks are read from disk one at a time rather than loading the whole image
+        with open(image_path, "rb") as f:
+            f.seek(state["segments"] * state["chunk_size"])
+            while True:
+                chunk = f.read(state["chunk_size"])
+                if len(chunk) == 0:
+                    break
+                self.__append(state["media_id"], state["segments"], chunk)
+                Metrics.increment("upload_bytes_total", len(chunk), destination="twitter")
+                state["segments"] += 1
+                Twitter.__save_upload_state(image_path, state)
+
+        r = self.__send('media/upload', {'command': 'FINALIZE', 'media_id': state["media_id"]})
+        Twitter.__discard_upload_state(image_path)
+        return r.json()["media_id_string"]
+
+    def upload_media(self, image_path, media_type="image/jpeg"):
+        """
+        Uploads an image in chunks with the INIT, APPEND and FINALIZE commands. Progress is saved next to the
+        image after every acknowledged chunk, so an upload that fails part way is resumed from the next chunk by
+        the following attempt instead of being sent again from the start.
+        :param image_path: A path to the image
+        :param media_type: The image's MIME type
+        :return: The media id
+        :raises PublishException: If the upload fails
+        """
+        if not os.path.exists(image_path):
+            raise IOError("Path not found: %s, Cannot load image" % image_path)
+
+        state = self.__load_upload_state(image_path)
+        if state is not None:
+            logger.info("Resuming upload of %s at segment %d", image_path, state["segments"])
+            Metrics.increment("upload_resumed_total", destination="twitter")
+        try:
+            return self.__upload(image_path, state, media_type)
+        except PublishException as ex:
+            if not ex.permanent:
+                raise
+            Twitter.__discard_upload_state(image_path)
+            if state is None:
+                raise
+            # Twitter may have dropped the partial upload, e.g. after a failed FINALIZE
+            logger.warning("Resumed upload of %s was rejected, starting over: %s", image_path, ex)
+            return self.__upload(image_path, None, media_type)
+
+    def compose_text(self, status, respond_to_user=None):
         if respond_to_user is not None:
             status = "Hi, %s\n\n%s"%(respond_to_user, status)
-        r = self.__api.request('statuses/update',
-                               {'status': status, 'in_reply_to_status_id': respond_to_id})
-        print('UPDATE STATUS SUCCESS' if r.status_code == 200 else 'UPDATE STATUS FAILURE: ' + r.text)
-
+        return status
 
-    def post_image(self, title, source, shortened_image_link, image_path="image.jpg", respond_to_user=None, respond_to_id=None, alt_text=None):
+    def compose_image_post(self, title, source, shortened_image_link, respond_to_user=None, respond_to_id=None):
         """
-        Tweets an image and Flickr photo title
-        :param title: The photo title
-        :param source: The Flickr source dict
-        :param shortened_image_link: A URL to the source image on Flickr
-        :param image_path: A path to the image to be tweeted
-        :param respond_to_user: A user to be responded to. None if not a response.
-        :param respond_to_id: ID of the tweet being responded to. None if not a response.
-        :return: True if the Twitter API returned an HTTP 200 status.
+        Builds the text of an image tweet
+        :return: The tweet text and the ID of the tweet it responds to
         """
         username = source.get_flickr_username()
         twitter_id = source.get_twitter_id()
@@ -87,14 +245,25 @@ class Twitter:
             text = "%s - From %s %s - %s"%(title, username, twitter_id, shortened_image_link)
         else:
             text = "Hi, %s\n\n%s - From %s %s - %s" % (respond_to_user, title, username, twitter_id, shortened_image_link)
+        return text, respond_to_id
 
-        data = Util.load_image_data(image_path)
-
-        r = self.__api.request('media/upload', None, {'media': data})
-        print('UPLOAD MEDIA SUCCESS' if r.status_code == 200 else 'UPLOAD MEDIA FAILURE: ' + r.text)
-
-        if r.status_code == 200:
-            media_id = r.json()['media_id']
+    def publish(self, text, image_path=None, alt_text=None, respond_to_id=None):
+        """
+        Tweets composed text, uploading an image first if one is given
+        :param text: The final tweet text
+        :param image_path: A path to the image to be tweeted, or None
+        :param alt_text: Image description
+        :param respond_to_id: ID of the tweet being responded to. None if not a response.
+        :raises PublishException: If the upload or the status update fails
+        """
+        params = {'status': text, 'in_reply_to_status_id': respond_to_id}
+        if image_path is not None:
+            try:
+                media_id = self.upload_media(image_path)
+            except PublishException:
+                logger.error('UPLOAD MEDIA FAILURE')
+                raise
+            logger.info('UPLOAD MEDIA SUCCESS')
 
             if alt_text is not None:
                 if len(alt_text) > 1000:
@@ -102,8 +271,46 @@ class Twitter:
                 # Currently getting 'Invalid json payload' on this. Not sure why yet.
                 #r = self.__api.request('media/metadata/create', {'media_id': media_id, "alt_text": {"text":alt_text}})
                 #print(json.dumps(r.json(), indent=4, sort_keys=True, default=str))
-            r = self.__api.request('statuses/update', {'status': text, 'media_ids': media_id, 'in_reply_to_status_id': respond_to_id})
-            print('UPDATE STATUS SUCCESS' if r.status_code == 200 else 'UPDATE STATUS FAILURE: ' + r.text)
+            params['media_ids'] = media_id
+
+        try:
+            self.__send('statuses/update', params)
+        except PublishException as ex:
+            logger.error('UPDATE STATUS FAILURE: %s', ex)
+            raise
+        logger.info('UPDATE STATUS SUCCESS')
+
+    def post_text(self, status, respond_to_user=None, respond_to_id=None):
+        """
+        Sends a text-only tweet
+        :param status: The tweet text to be posted
+        :param respond_to_user: User being responded to. None if not a response.
+        :param respond_to_id: Tweet being responded to. None if not a response.
+        :return: True if the Twitter API returned an HTTP 200 status.
+        """
+        try:
+            self.publish(self.compose_text(status, respond_to_user=respond_to_user), respond_to_id=respond_to_id)
+        except PublishException:
+            return False
+        return True
+
+    def post_image(self, title, source, shortened_image_link, image_path="image.jpg", respond_to_user=None, respond_to_id=None, alt_text=None):
+        """
+        Tweets an image and Flickr photo title
+        :param title: The photo title
+        :param source: The Flickr source dict
+        :param shortened_image_link: A URL to the source image on Flickr
+        :param image_path: A path to the image to be tweeted
+        :param respond_to_user: A user to be responded to. None if not a response.
+        :param respond_to_id: ID of the tweet being responded to. None if not a response.
+        :return: True if the Twitter API returned an HTTP 200 status.
+        """
+        text, respond_to_id = self.compose_image_post(title, source, shortened_image_link, respond_to_user=respond_to_user, respond_to_id=respond_to_id)
+        try:
+            self.publish(text, image_path=image_path, alt_text=alt_text, respond_to_id=respond_to_id)
+        except PublishException:
+            return False
+        return True
 
     def get_mentions(self, since_id=None, count=100):
         """
@@ -116,9 +323,9 @@ class Twitter:
         if since_id is not None and since_id > 0:
             params["since_id"] = since_id
 
-        r = self.__api.request('statuses/mentions_timeline', params)
+        r = self.__request('statuses/mentions_timeline', params)
         if r.status_code != 200:
-            print('retrieval failure: ' + r.text)
+            logger.error('retrieval failure: %s', r.text)
             raise Exception('retrieval failure: ' + r.text)
 
         mentions = []
@@ -133,4 +340,5 @@ class Twitter:
             })
         return mentions
 
-
+    def close(self):
+        self.__session.close()
@@ -17,16 +17,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import sys
 import os
-import requests
-from configparser import ConfigParser
-import math
-import traceback
-import json
-import argparse
-import re
-import yaml
+from metrics import Metrics
+from log import get_logger
+
+logger = get_logger("util")
 
 
 class Util:
@@ -37,23 +32,33 @@ class Util:
     __alphabet = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
     __base_count = len(__alphabet)
 
+    # Cassette recording or replaying this process's API traffic and random picks, see cassette.py
+    cassette = None
+    __session = None
+
+    # Connect and read timeouts of image downloads, in seconds
+    DEFAULT_TIMEOUT = (5.0, 60.0)
+
     @staticmethod
     def randint(min=0, max=255):
         """
         Returns a random integer between the specified min and max, inclusive of both
         """
-        print("Finding random between %f and %f"%(min, max))
+        logger.debug("Finding random between %f and %f", min, max)
         if min == max:
-            return min
+            value = min
         elif max == 0:
-            return 0
+            value = 0
         else:
-            return int(round((os.urandom(1)[0]) / 255.0 * (max - min) + min))
+            value = int(round((os.urandom(1)[0]) / 255.0 * (max - min) + min))
+        if Util.cassette is not None:
+            value = Util.cassette.random_value(value, min, max)
+        return value
 
     # https://gist.github.com/ianoxley/865912
     @staticmethod
     def encode_base58(num):
-        if type(num) != int and type(num) != long :
+        if type(num) != int:
             raise TypeError("Value must be an integer")
         encode = ''
         if num < 0:
@@ -62,7 +67,7 @@ class Util:
         while num >= Util.__base_count:
             mod = num % Util.__base_count
             encode = Util.__alphabet[int(mod)] + encode
-            num = num / Util.__base_count
+            num = num // Util.__base_count
 
         if num:
             encode = Util.__alphabet[int(num)] + encode
@@ -80,11 +85,62 @@ class Util:
         return data
 
     @staticmethod
-    def fetch_image_to_path(url, path):
-        print("Fetching %s to %s"%(url, path))
-        r = requests.get(url, params={})
+    def use_cassette(cassette):
+        """
+        Records or replays the traffic of sessions created from now on through a cassette, see cassette.py
+        :param cassette: A cassette, or None to stop using one
+        """
+        Util.cassette = cassette
+        Util.__session = None
+
+    @staticmethod
+    def make_session(pool_size=4, user_agent=None):
+        """
+        Creates an HTTP session which keeps up to pool_size connections per host alive, so that a client making
+        several requests reuses warm connections instead of reconnecting for each one
+        :param pool_size: Connections kept per host
+        :param user_agent: User-Agent header sent with every request, or None for the default
+        :return: A requests session
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        if Util.cassette is not None:
+            adapter = Util.cassette.adapter(pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if user_agent is not None:
+            session.headers["User-Agent"] = user_agent
+        return session
+
+    @staticmethod
+    def fetch_image_to_path(url, path, timeout=None, hedger=None):
+        """
+        Downloads an image
+        :param url: The image URL
+        :param path: Where the image is written
+        :param timeout: Connect and read timeouts in seconds, or None for DEFAULT_TIMEOUT
+        :param hedger: Hedger sending a duplicate request when the download is slow, or None
+        :return: path
+        """
+        if Util.__session is None:
+            Util.__session = Util.make_session()
+        session = Util.__session
+        timeout = Util.DEFAULT_TIMEOUT if timeout is None else timeout
+
+        logger.debug("Fetching %s to %s", url, path)
+        with Metrics.timer("image_download"):
+            if hedger is None:
+                r = session.get(url, params={}, timeout=timeout)
+            else:
+                r = hedger.call(lambda arg: session.get(url, params={}, timeout=timeout))
         if r.status_code != 200:
+            Metrics.increment("image_download_errors_total")
             raise Exception("Error fetching image. Status code: %s"%(r.status_code))
+        Metrics.increment("image_download_bytes_total", len(r.content))
         with open(path, "wb") as f:
             f.write(r.content)
         return path